@@ -0,0 +1,62 @@
+import re
+import sys
+import ast
+import argparse
+import subprocess
+import numpy as np
+
+EPOCH_PATTERN = re.compile(r"In (\d+)-th stage, Training (\d+)/\d+, .*time: ([0-9.]+)s")
+RESULT_PATTERN = re.compile(r"The result list is (.*)$")
+
+
+def run(script, script_args, amp):
+    """
+    Run one training script and collect the per-epoch training times and the final result list
+    ([dataset, stage, last acc, current acc, overall acc] per stage) from its output.
+    """
+    cmd = [sys.executable, script] + list(script_args) + (["--amp"] if amp else [])
+    print("running {}".format(" ".join(cmd)))
+    epoch_times = {}
+    results = []
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    for line in proc.stdout:
+        match = EPOCH_PATTERN.search(line)
+        if match:
+            epoch_times[(int(match.group(1)), int(match.group(2)))] = float(match.group(3))
+        match = RESULT_PATTERN.search(line)
+        if match:
+            # numpy scalars may print as np.float64(x)
+            results = ast.literal_eval(re.sub(r"np\.\w+\(([^()]*)\)", r"\1", match.group(1)))
+    if proc.wait() != 0:
+        raise RuntimeError("{} exited with {}".format(" ".join(cmd), proc.returncode))
+    return epoch_times, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='fp32 vs bf16 autocast (--amp) training comparison',
+                                     epilog='arguments after "--" are passed to the training script')
+    parser.add_argument('--script', type=str, default='train_single_incle_prca.py')
+    args, script_args = parser.parse_known_args()
+    script_args = [a for a in script_args if a != '--']
+
+    fp32_times, fp32_results = run(args.script, script_args, amp=False)
+    amp_times, amp_results = run(args.script, script_args, amp=True)
+
+    epochs = sorted(set(fp32_times) & set(amp_times))
+    print("\n{:>6} {:>6} {:>10} {:>10} {:>8}".format("stage", "epoch", "fp32 (s)", "amp (s)", "speedup"))
+    for stage, epoch in epochs:
+        t32, tamp = fp32_times[(stage, epoch)], amp_times[(stage, epoch)]
+        print("{:>6} {:>6} {:>10.3f} {:>10.3f} {:>7.2f}x".format(stage, epoch, t32, tamp, t32 / tamp))
+    if epochs:
+        total32 = np.sum([fp32_times[e] for e in epochs])
+        total_amp = np.sum([amp_times[e] for e in epochs])
+        # the first epoch of a run includes warm-up, the median is the steady-state figure
+        median = np.median([fp32_times[e] / amp_times[e] for e in epochs])
+        print("total {:.2f}s vs {:.2f}s, speedup {:.2f}x (median per epoch {:.2f}x)".format(
+            total32, total_amp, total32 / total_amp, median))
+
+    print("\n{:>20} {:>6} {:>22} {:>22} {:>22}".format("dataset", "stage", "last acc fp32/amp",
+                                                       "current acc fp32/amp", "overall acc fp32/amp"))
+    for r32, ramp in zip(fp32_results, amp_results):
+        accs = ["{:.4f}/{:.4f}".format(a, b) for a, b in zip(r32[2:5], ramp[2:5])]
+        print("{:>20} {:>6} {:>22} {:>22} {:>22}".format(str(r32[0]), r32[1], *accs))
@@ -0,0 +1,56 @@
+import argparse
+import torch
+import torch.nn as nn
+from layers import ZINBHead, zinb_head_hook, MeanAct, DispAct, PiAct
+from bench_zinb import timeit
+
+
+class ThreeHeads(nn.Module):
+    # the previous decoder heads of AutoEncoder, kept for comparison
+    def __init__(self, input_dim, output_dim):
+        super(ThreeHeads, self).__init__()
+        self._dec_mean = nn.Sequential(nn.Linear(input_dim, output_dim), MeanAct())
+        self._dec_disp = nn.Sequential(nn.Linear(input_dim, output_dim), DispAct())
+        self._dec_pi = nn.Sequential(nn.Linear(input_dim, output_dim), PiAct())
+
+    def forward(self, h):
+        return self._dec_mean(h), self._dec_disp(h), self._dec_pi(h)
+
+
+class FusedHead(nn.Module):
+    def __init__(self, input_dim, output_dim):
+        super(FusedHead, self).__init__()
+        self._dec_zinb = ZINBHead(input_dim, output_dim)
+        self._register_load_state_dict_pre_hook(zinb_head_hook("_dec_zinb"))
+
+    def forward(self, h):
+        return self._dec_zinb(h)
+
+
+def step(head, h):
+    mean, disp, pi = head(h)
+    (mean.mean() + disp.mean() + pi.mean()).backward()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ZINB decoder head microbenchmark')
+    parser.add_argument('--genes', type=int, nargs='+', default=[2000, 20000])
+    parser.add_argument('--hidden', type=int, default=512)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    for genes in args.genes:
+        three = ThreeHeads(args.hidden, genes).to(device)
+        fused = FusedHead(args.hidden, genes).to(device)
+        fused.load_state_dict(three.state_dict())
+        h = torch.randn(args.batch_size, args.hidden, device=device, requires_grad=True)
+        with torch.no_grad():
+            max_diff = max((a - b).abs().max().item() for a, b in zip(three(h), fused(h)))
+        three_time = timeit(lambda: step(three, h), args.repeats, device)
+        fused_time = timeit(lambda: step(fused, h), args.repeats, device)
+        print("genes {:6d}, batch {}: three heads {:.3f} ms, fused {:.3f} ms, speedup {:.2f}x, "
+              "max abs diff {:.2e}".format(genes, args.batch_size, three_time * 1e3, fused_time * 1e3,
+                                          three_time / fused_time, max_diff))
@@ -0,0 +1,88 @@
+import time
+import argparse
+import numpy as np
+import torch
+from layers import ZINBLoss
+
+
+def reference_zinb_loss(x, mean, disp, pi, scale_factor, ridge_lambda=1.0):
+    # the previous layers.ZINBLoss.forward, kept for comparison
+    eps = 1e-10
+    scale_factor = torch.matmul(scale_factor, torch.ones_like(torch.sum(mean, dim=0)).view(1, -1))
+    mean = mean * scale_factor
+
+    t1 = torch.lgamma(disp+eps) + torch.lgamma(x+1.0) - torch.lgamma(x+disp+eps)
+    t2 = (disp+x) * torch.log(1.0 + (mean/(disp+eps))) + (x * (torch.log(disp+eps) - torch.log(mean+eps)))
+    nb_final = t1 + t2
+
+    nb_final = torch.where(torch.isnan(nb_final), torch.zeros_like(nb_final) + np.inf, nb_final)
+
+    nb_case = nb_final - torch.log(1.0-pi+eps)
+    zero_nb = torch.pow(disp/(disp+mean+eps), disp)
+    zero_case = -torch.log(pi + ((1.0-pi)*zero_nb)+eps)
+    result = torch.where(torch.le(x, 1e-8), zero_case, nb_case)
+
+    if ridge_lambda > 0:
+        ridge = ridge_lambda*torch.square(pi)
+        result += ridge
+
+    result = torch.mean(result)
+
+    result = torch.where(torch.isnan(result), torch.zeros_like(result) + np.inf, result)
+
+    return result
+
+
+def make_batch(batch_size, genes, device, seed=0):
+    torch.manual_seed(seed)
+    # sparse, overdispersed counts as in scRNA-seq UMI matrices
+    rate = torch.distributions.Gamma(0.3, 0.3).sample((batch_size, genes))
+    x = torch.poisson(rate)
+    x[torch.rand(batch_size, genes) < 0.7] = 0
+    mean = torch.rand(batch_size, genes) * 5 + 1e-3
+    disp = torch.rand(batch_size, genes) * 10 + 1e-2
+    pi = torch.rand(batch_size, genes) * 0.9
+    sf = torch.rand(batch_size, 1) + 0.5
+    return [t.to(device) for t in (x, mean, disp, pi, sf)]
+
+
+def timeit(fn, repeats, device):
+    for _ in range(3):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+def step(loss_fn, x, mean, disp, pi, sf):
+    mean, disp, pi = [t.detach().requires_grad_() for t in (mean, disp, pi)]
+    loss = loss_fn(x=x, mean=mean, disp=disp, pi=pi, scale_factor=sf)
+    loss.backward()
+    return loss
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ZINB loss microbenchmark')
+    parser.add_argument('--genes', type=int, nargs='+', default=[2000, 20000])
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    for genes in args.genes:
+        x, mean, disp, pi, sf = make_batch(args.batch_size, genes, device)
+        fused = ZINBLoss(max_count=int(x.max().item())).to(device)
+        ref_loss = reference_zinb_loss(x, mean, disp, pi, sf).item()
+        fused_loss = fused(x, mean, disp, pi, sf).item()
+        ref_time = timeit(lambda: step(reference_zinb_loss, x, mean, disp, pi, sf), args.repeats, device)
+        fused_time = timeit(lambda: step(fused, x, mean, disp, pi, sf), args.repeats, device)
+        print("genes {:6d}, batch {}: reference {:.3f} ms, fused {:.3f} ms, speedup {:.2f}x, "
+              "loss {:.6f} vs {:.6f} (rel diff {:.2e})".format(genes, args.batch_size, ref_time * 1e3, fused_time * 1e3,
+                                                                ref_time / fused_time, ref_loss, fused_loss,
+                                                                abs(ref_loss - fused_loss) / abs(ref_loss)))
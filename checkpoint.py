@@ -0,0 +1,132 @@
+import os
+import re
+import random
+import numpy as np
+import torch
+from data_cache import config_key, acquire_lock, release_lock
+
+# arguments that do not change what a run trains, left out of its checkpoint key
+RUN_ONLY_ARGS = ("gpu_id", "cache_dir", "chunk_size", "load_workers", "interval", "eval_memory", "eval_per_class",
+                 "eval_budget", "background_eval", "export_format", "checkpoint_dir", "resume", "encoder_cache",
+                 "order")
+
+
+def rng_state():
+    return {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"].cpu())
+    if state["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
+def save_state(state, path):
+    # written next to `path` and renamed into place, a half-written checkpoint is never visible
+    tmp_path = path + ".tmp.{}".format(os.getpid())
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_state(path, device=None):
+    try:
+        return torch.load(path, map_location=device, weights_only=False)
+    except TypeError:  # torch < 1.13
+        return torch.load(path, map_location=device)
+
+
+def run_directory(root, script, args, **extra):
+    """
+    Checkpoint directory of one run: the script name and a hash of the arguments that affect training
+    (all of args but RUN_ONLY_ARGS) and of `extra` (e.g. the dataset names).
+    """
+    config = {k: v for k, v in vars(args).items() if k not in RUN_ONLY_ARGS}
+    config.update(extra)
+    name = os.path.splitext(os.path.basename(script))[0]
+    return os.path.join(root, "{}-{}".format(name, config_key(config)))
+
+
+class StageCheckpointer(object):
+    """
+    Checkpoints written at the end of every stage of a run, as `directory`/stage_<k>.pt. A checkpoint holds
+    the given state (model, prototypes, optimizer, class_number_set, exemplar memory indexes, results...)
+    and the python, numpy, torch and cuda RNG states, so that the stages after it can be replayed exactly.
+    # Arguments
+        stage_keys: what every stage trains on (e.g. the dataset order of the real series). The checkpoint
+            of stage k is then keyed by stage_keys[:k + 1] and shared by the runs with the same first stages.
+    """
+    def __init__(self, directory, stage_keys=None):
+        self.directory = directory
+        self.stage_keys = list(stage_keys) if stage_keys is not None else None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, stage):
+        if self.stage_keys is None:
+            return os.path.join(self.directory, "stage_{}.pt".format(stage))
+        prefix = config_key(list(self.stage_keys[:stage + 1]))
+        return os.path.join(self.directory, "stage_{}-{}.pt".format(stage, prefix))
+
+    def save(self, stage, **state):
+        state["stage"] = stage
+        state["rng"] = rng_state()
+        save_state(state, self.path(stage))
+
+    def stages(self):
+        if self.stage_keys is not None:
+            return [stage for stage in range(len(self.stage_keys)) if os.path.exists(self.path(stage))]
+        matches = [re.match(r"stage_(\d+)\.pt$", name) for name in os.listdir(self.directory)]
+        return sorted(int(m.group(1)) for m in matches if m)
+
+    def latest(self, device=None):
+        # state of the last checkpointed stage, None without checkpoint
+        stages = self.stages()
+        if not stages:
+            return None
+        print("resuming from checkpoint {}".format(self.path(stages[-1])))
+        return load_state(self.path(stages[-1]), device)
+
+
+class EncoderCache(object):
+    """
+    The autoencoder after the ZINB-only pretraining epochs of stage 0, shared by every strategy script.
+    Entries are keyed by `key` (the digests of the expression data and of the stage-0 training cells, the
+    preprocessing, architecture, seed, pretraining epochs and anything else the pretraining depends on) and
+    hold the model, optimizer and RNG states.
+    Between a missed restore() and store() the entry is locked, concurrent runs with the same key wait
+    for it instead of pretraining again. Callers release() it in a finally block, so that a pretraining that
+    fails does not leave the lock to later runs of the same process.
+    """
+    def __init__(self, directory, **key):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "pretrain-{}.pt".format(config_key(key)))
+        self.locked = False
+
+    def restore(self, model, optimizer, device=None):
+        # True if the cache had the entry, model, optimizer and RNG are then those at the end of pretraining
+        acquire_lock(self.path)
+        if not os.path.exists(self.path):
+            self.locked = True
+            return False
+        release_lock(self.path)
+        state = load_state(self.path, device)
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        set_rng_state(state["rng"])
+        print("loaded the pretrained encoder from cache {}".format(self.path))
+        return True
+
+    def store(self, model, optimizer):
+        if not os.path.exists(self.path):
+            save_state({"model": model.state_dict(), "optimizer": optimizer.state_dict(), "rng": rng_state()},
+                       self.path)
+            print("saved the pretrained encoder to cache {}".format(self.path))
+        self.release()
+
+    def release(self):
+        # gives up the lock taken by a missed restore(), no-op otherwise
+        if self.locked:
+            self.locked = False
+            release_lock(self.path)
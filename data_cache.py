@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import contextlib
+import numpy as np
+import scipy.sparse
+
+
+def file_digest(path, memo_dir=None, block_size=1 << 20):
+    # sha1 of the file content. With memo_dir it is remembered there, keyed by the path, size and mtime of the
+    # file, so big stores are only hashed once; nothing is written next to the (possibly shared) data file
+    stat = os.stat(path)
+    memo_path = None
+    if memo_dir:
+        memo_path = os.path.join(memo_dir, "sha1-{}.json".format(
+            config_key([os.path.abspath(path), stat.st_size, stat.st_mtime])))
+        if os.path.exists(memo_path):
+            try:
+                with open(memo_path, "r") as f:
+                    return json.load(f)["sha1"]
+            except (ValueError, KeyError):
+                pass
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    digest = sha1.hexdigest()
+    if memo_path is not None:
+        try:
+            os.makedirs(memo_dir, exist_ok=True)
+            with open(memo_path, "w") as f:
+                json.dump({"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime,
+                           "sha1": digest}, f)
+        except OSError:
+            pass
+    return digest
+
+
+def config_key(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def array_digest(*arrays):
+    # sha1 of the shapes and contents of in-memory arrays (object arrays hashed as strings)
+    sha1 = hashlib.sha1()
+    for arr in arrays:
+        arr = np.asarray(arr)
+        if arr.dtype == object:
+            arr = arr.astype(str)
+        sha1.update(str(arr.shape).encode("utf-8"))
+        sha1.update(np.ascontiguousarray(arr).tobytes())
+    return sha1.hexdigest()
+
+
+def matrix_digest(*matrices, chunk_size=1 << 24):
+    """
+    sha1 of (possibly memory-mapped or sparse) expression matrices, read `chunk_size` elements at a time so
+    that a mapped matrix is never copied whole. sc_utils.RowView hashes its base and rows, tuples (e.g. a
+    lazy scaler) their items, None is skipped.
+    """
+    sha1 = hashlib.sha1()
+
+    def update(arr):
+        arr = np.asarray(arr).reshape(-1)
+        sha1.update("{}{}".format(arr.dtype, arr.shape).encode("utf-8"))
+        for start in range(0, len(arr), chunk_size):
+            sha1.update(np.ascontiguousarray(arr[start:start + chunk_size]).tobytes())
+
+    def visit(mat):
+        if mat is None:
+            return
+        if isinstance(mat, (tuple, list)):
+            for item in mat:
+                visit(item)
+        elif hasattr(mat, "base") and hasattr(mat, "rows"):  # sc_utils.RowView
+            visit(mat.base)
+            update(mat.rows)
+        elif scipy.sparse.issparse(mat):
+            mat = scipy.sparse.csr_matrix(mat, copy=False)
+            sha1.update(str(mat.shape).encode("utf-8"))
+            for arr in (mat.data, mat.indices, mat.indptr):
+                update(arr)
+        else:
+            update(mat)
+
+    for mat in matrices:
+        visit(mat)
+    return sha1.hexdigest()
+
+
+def _lock_owner_alive(lock_path):
+    try:
+        with open(lock_path, "r") as f:
+            pid = int(f.read() or 0)
+    except (OSError, ValueError):
+        return True
+    if not pid:  # created, pid not written yet
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def acquire_lock(path, poll=1.):
+    """
+    Inter-process lock on the cache entry `path` (a `path`.lock file holding the owner's pid), so that among
+    concurrent runs one builds the entry and the others wait for it. A lock left by a dead process is taken over.
+    """
+    lock_path = path + ".lock"
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if _lock_owner_alive(lock_path):
+                time.sleep(poll)
+            else:
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+            continue
+        with os.fdopen(fd, "w") as f:
+            f.write(str(os.getpid()))
+        return
+
+
+def release_lock(path):
+    os.remove(path + ".lock")
+
+
+@contextlib.contextmanager
+def entry_lock(path):
+    acquire_lock(path)
+    try:
+        yield
+    finally:
+        release_lock(path)
+
+
+class ArrayWriter(object):
+    """
+    Incrementally written cache entry. Fields are plain .npy files (sparse matrices as their CSR data,
+    indices and indptr) so that load_arrays can memory-map every one of them. The entry is written to a
+    temporary directory and renamed into place by close(), a half-written entry is never visible.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp.{}".format(os.getpid())
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+        self.kinds = {}
+
+    def _file(self, name):
+        return os.path.join(self.tmp_path, name + ".npy")
+
+    def dense(self, name, shape, dtype):
+        self.kinds[name] = {"kind": "dense"}
+        return np.lib.format.open_memmap(self._file(name), mode="w+", dtype=dtype, shape=tuple(shape))
+
+    def csr(self, name, shape, nnz, dtype, index_dtype=None):
+        # returns writable (data, indices, indptr) memmaps to be filled by the caller. Indexes are int32
+        # when nnz and the column count fit, as scipy would otherwise copy int64 ones down on load
+        if index_dtype is None:
+            index_dtype = np.int32 if max(int(nnz), int(shape[1])) <= np.iinfo(np.int32).max else np.int64
+        self.kinds[name] = {"kind": "csr", "shape": [int(n) for n in shape]}
+        data = np.lib.format.open_memmap(self._file(name + ".data"), mode="w+", dtype=dtype, shape=(int(nnz),))
+        indices = np.lib.format.open_memmap(self._file(name + ".indices"), mode="w+", dtype=index_dtype, shape=(int(nnz),))
+        indptr = np.lib.format.open_memmap(self._file(name + ".indptr"), mode="w+", dtype=index_dtype, shape=(int(shape[0]) + 1,))
+        return data, indices, indptr
+
+    def save(self, name, arr):
+        if scipy.sparse.issparse(arr):
+            arr = scipy.sparse.csr_matrix(arr)
+            np.save(self._file(name + ".data"), arr.data)
+            np.save(self._file(name + ".indices"), arr.indices)
+            np.save(self._file(name + ".indptr"), arr.indptr)
+            self.kinds[name] = {"kind": "csr", "shape": list(arr.shape)}
+        else:
+            arr = np.asarray(arr)
+            kind = "dense"
+            if arr.dtype == object:  # object arrays can not be memory-mapped
+                arr = arr.astype(str)
+                kind = "object"
+            np.save(self._file(name), arr)
+            self.kinds[name] = {"kind": kind}
+
+    def close(self, meta=None):
+        with open(os.path.join(self.tmp_path, "meta.json"), "w") as f:
+            json.dump({"arrays": self.kinds, "meta": meta if meta is not None else {}}, f)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path, self.path)
+
+
+def save_arrays(path, arrays, meta=None):
+    writer = ArrayWriter(path)
+    for name, arr in arrays.items():
+        writer.save(name, arr)
+    writer.close(meta)
+
+
+def load_arrays(path, mmap=True):
+    mmap_mode = "r" if mmap else None
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        d = json.load(f)
+    arrays = {}
+    for name, info in d["arrays"].items():
+        if info["kind"] == "csr":
+            data = np.load(os.path.join(path, name + ".data.npy"), mmap_mode=mmap_mode)
+            indices = np.load(os.path.join(path, name + ".indices.npy"), mmap_mode=mmap_mode)
+            indptr = np.load(os.path.join(path, name + ".indptr.npy"), mmap_mode=mmap_mode)
+            arrays[name] = scipy.sparse.csr_matrix((data, indices, indptr), shape=tuple(info["shape"]), copy=False)
+        else:
+            arrays[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+            if info["kind"] == "object":
+                arrays[name] = np.array(arrays[name], dtype=object)
+    return arrays, d["meta"]
+
+
+# entries already loaded by this process (memory-mapped and read-only), reused by later runs in the same
+# process, see run_strategies.py
+_loaded = {}
+
+
+def cached_store(config, write_fn, cache_dir):
+    """
+    Content-addressed cache: `config` (json-able, should contain the digests of the input files)
+    is hashed into the entry name. write_fn(path, config) writes the entry itself (see ArrayWriter)
+    and is only called on a miss, by one process at a time.
+    """
+    path = os.path.join(cache_dir, config_key(config))
+    if path in _loaded:
+        return _loaded[path]
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    with entry_lock(path):
+        if os.path.exists(os.path.join(path, "meta.json")):
+            print("loading preprocessed data from cache {}".format(path))
+        else:
+            write_fn(path, config)
+            print("saved preprocessed data to cache {}".format(path))
+    _loaded[path] = load_arrays(path)
+    return _loaded[path]
+
+
+def cached_arrays(config, build_fn, cache_dir):
+    """
+    Like cached_store for an in-memory build_fn() -> (arrays, meta). An empty/None cache_dir disables caching.
+    """
+    if not cache_dir:
+        return build_fn()
+
+    def write(path, config):
+        arrays, meta = build_fn()
+        save_arrays(path, arrays, dict(meta, config=config))
+
+    return cached_store(config, write, cache_dir)
@@ -0,0 +1,270 @@
+import numpy as np
+import scipy.sparse
+import torch
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler, \
+    WeightedRandomSampler
+from sc_utils import RowView
+
+
+# torch has no uint16/uint32 tensors: compact counts are moved as the signed type of the same width
+# and the bits are reinterpreted by widen_counts
+_SIGNED_VIEW = {np.dtype(np.uint16): np.int16, np.dtype(np.uint32): np.int32}
+_UNSIGNED_MASK = {torch.int16: (torch.int32, 0xFFFF), torch.int32: (torch.int64, 0xFFFFFFFF)}
+
+
+def widen_counts(raw_x):
+    # float32 counts of a (device) batch returned by CellDataset, right before the ZINB loss
+    if raw_x.dtype in _UNSIGNED_MASK:
+        dtype, mask = _UNSIGNED_MASK[raw_x.dtype]
+        raw_x = raw_x.to(dtype) & mask
+    return raw_x.float()
+
+
+def dense_rows(mat, index):
+    if isinstance(mat, RowView):
+        mat, index = mat.base, mat.rows[index]
+    rows = mat[index]
+    if scipy.sparse.issparse(rows):
+        rows = rows.toarray()
+    return np.asarray(rows)
+
+
+class CellDataset(Dataset):
+    """
+    Drop-in replacement of TensorDataset(x, raw_x, sf, y, arange(n)) for expression matrices that may be
+    scipy sparse. The dataset is indexed with a whole minibatch of positions (see cell_dataloader), so a
+    dense block is only materialized for the cells of the current batch.
+    # Arguments
+        x: (normalized) expression matrix, numpy array, scipy sparse matrix or sc_utils.RowView of either
+        raw_x: raw count matrix with the same shape as x, numpy array or scipy sparse matrix, preferably
+            sc_utils.compact_counts(); batches keep the integer type, see widen_counts
+        sf: size factors with shape `(n_samples, 1)`
+        y: labels with shape `(n_samples,)`
+        scaler: optional (mean, std) applied to x per batch, see preprocessing.get_scaler
+    """
+    def __init__(self, x, raw_x, sf, y, scaler=None):
+        assert x.shape[0] == raw_x.shape[0] == sf.shape[0] == y.shape[0]
+        self.x = x
+        self.raw_x = raw_x
+        self.sf = np.asarray(sf)
+        self.y = np.asarray(y)
+        self.scaler = scaler
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def __getitem__(self, index):
+        index = np.atleast_1d(np.asarray(index, dtype=np.int64))
+        x = dense_rows(self.x, index).astype(np.float32)
+        if self.scaler is not None:
+            x -= self.scaler[0]
+            x /= self.scaler[1]
+        raw_x = dense_rows(self.raw_x, index)
+        if raw_x.dtype in _SIGNED_VIEW:
+            raw_x = raw_x.view(_SIGNED_VIEW[raw_x.dtype])
+        return torch.from_numpy(x), torch.from_numpy(raw_x), torch.from_numpy(self.sf[index]), \
+               torch.from_numpy(self.y[index]), torch.from_numpy(index)
+
+    def subset(self, rows):
+        # the cells `rows` as a CellDataset of row views, indexed 0..len(rows)-1
+        rows = np.asarray(rows, dtype=np.int64)
+        return CellDataset(RowView(self.x, rows), RowView(self.raw_x, rows), self.sf[rows], self.y[rows],
+                           scaler=self.scaler)
+
+    def to_device(self, device, chunk_size=8192):
+        """
+        The dataset as (dense, scaled) tensors on `device`, built chunk by chunk on the host. When x and raw_x
+        are row views of the same rows, their base matrices are uploaded once and shared by every dataset of
+        rows of them (see _device_bases); the DeviceCellDataset then only holds its rows, size factors and labels.
+        """
+        if isinstance(self.x, RowView) and isinstance(self.raw_x, RowView) and \
+                np.array_equal(self.x.rows, self.raw_x.rows):
+            x, raw_x = _device_bases(self.x.base, self.raw_x.base, self.scaler, device, chunk_size)
+            return DeviceCellDataset(x, raw_x, torch.as_tensor(np.array(self.sf), device=device),
+                                     torch.as_tensor(np.array(self.y), device=device),
+                                     rows=torch.as_tensor(self.x.rows, device=device))
+        return DeviceCellDataset(*_device_tensors(self, device, chunk_size))
+
+
+def _device_tensors(dataset, device, chunk_size):
+    chunks = [dataset[np.arange(start, min(start + chunk_size, len(dataset)))]
+              for start in range(0, len(dataset), chunk_size)]
+    return [torch.cat([chunk[i] for chunk in chunks]).to(device) for i in range(4)]
+
+
+# the last (x, raw_x) base matrices uploaded by CellDataset.to_device: the datasets of a run are row views of
+# the same bases, only one copy of them is kept on the device
+_uploaded = {}
+
+
+def _device_bases(x, raw_x, scaler, device, chunk_size):
+    key = (id(x), id(raw_x), id(scaler), str(device))
+    if _uploaded.get("key") != key:
+        _uploaded.clear()  # the previous bases are freed before the next upload
+        n = x.shape[0]
+        bases = CellDataset(x, raw_x, np.zeros((n, 1), dtype=np.float32), np.zeros(n, dtype=np.int64), scaler=scaler)
+        # the base objects are kept alive with their upload, so that their ids are not reused
+        _uploaded.update(key=key, refs=(x, raw_x, scaler), tensors=_device_tensors(bases, device, chunk_size)[:2])
+    return _uploaded["tensors"]
+
+
+class DeviceCellDataset(object):
+    """
+    CellDataset whose tensors (x, raw_x, sf, y) live on the training device, see CellDataset.to_device.
+    Batches are gathered with index_select on the device by DeviceBatchLoader.
+    # Arguments
+        rows: optional rows of x and raw_x holding the cells of the dataset (x and raw_x being shared base
+            tensors), sf and y have one row per cell of the dataset
+    """
+    def __init__(self, x, raw_x, sf, y, rows=None):
+        assert sf.shape[0] == y.shape[0] == (x.shape[0] if rows is None else rows.shape[0])
+        assert x.shape[0] == raw_x.shape[0]
+        self.tensors = (x, raw_x, sf, y)
+        self.rows = rows
+        self.device = x.device
+
+    def __len__(self):
+        return self.tensors[3].shape[0]
+
+    def __getitem__(self, index):
+        index = torch.as_tensor(index, dtype=torch.long, device=self.device).reshape(-1)
+        x, raw_x, sf, y = self.tensors
+        rows = index if self.rows is None else self.rows.index_select(0, index)
+        return x.index_select(0, rows), raw_x.index_select(0, rows), sf.index_select(0, index), \
+               y.index_select(0, index), index
+
+    def subset(self, rows):
+        # a view of the cells `rows`, sharing the x and raw_x tensors
+        index = torch.as_tensor(rows, dtype=torch.long, device=self.device).reshape(-1)
+        x, raw_x, sf, y = self.tensors
+        return DeviceCellDataset(x, raw_x, sf.index_select(0, index), y.index_select(0, index),
+                                 rows=index if self.rows is None else self.rows.index_select(0, index))
+
+
+class DeviceBatchLoader(object):
+    """
+    DataLoader replacement for a DeviceCellDataset: the epoch's index order (sequential, randperm, or
+    multinomial draws for class weights) is generated on the device and batches are sliced from it, so an
+    epoch runs without collation and without per-batch host->device copies.
+    # Arguments
+        weights: optional per-sample weights, samples num_samples indexes (default len(dataset)) with
+            replacement as WeightedRandomSampler does
+        batch_sampler: optional sampler of whole batches (ClassBalancedBatchSampler) on the same device
+    """
+    def __init__(self, dataset, batch_size, shuffle=False, drop_last=False, weights=None, num_samples=None,
+                 replacement=True, batch_sampler=None):
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.weights = None if weights is None else \
+            torch.as_tensor(weights, dtype=torch.double).to(dataset.device)
+        self.num_samples = len(dataset) if num_samples is None else num_samples
+        self.replacement = replacement
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def _order(self):
+        device = self.dataset.device
+        if self.weights is not None:
+            return torch.multinomial(self.weights, self.num_samples, self.replacement)
+        if self.shuffle:
+            return torch.randperm(self.num_samples, device=device)
+        return torch.arange(self.num_samples, device=device)
+
+    def __iter__(self):
+        if self.batch_sampler is not None:
+            for index in self.batch_sampler:
+                yield self.dataset[index]
+            return
+        order = self._order()
+        for batch in range(len(self)):
+            yield self.dataset[order[batch * self.batch_size:(batch + 1) * self.batch_size]]
+
+
+class ClassBalancedBatchSampler(object):
+    """
+    Vectorized replacement of WeightedRandomSampler(1 / class frequency): every draw picks one of the present
+    classes uniformly and then one of its cells uniformly, with replacement. The cells are kept grouped by class
+    in one index tensor and a whole epoch is drawn with two RNG calls, then cut into batches of indexes.
+    # Arguments
+        labels: class label per cell
+        num_samples: draws per epoch, len(labels) by default
+        strata: optional stratum per cell (e.g. 0 new stage, 1 exemplar memory); each batch then takes a
+            fixed share of its draws from every stratum, given by strata_weights, class-balanced within it
+    """
+    def __init__(self, labels, batch_size, num_samples=None, drop_last=True, strata=None, strata_weights=None,
+                 device=None):
+        labels = np.asarray(labels)
+        self.batch_size = batch_size
+        self.num_samples = len(labels) if num_samples is None else num_samples
+        self.drop_last = drop_last
+        strata = np.zeros(len(labels), dtype=np.int64) if strata is None else np.asarray(strata)
+        self.strata = []
+        for stratum in np.unique(strata):
+            cells = np.where(strata == stratum)[0]
+            _, codes, counts = np.unique(labels[cells], return_inverse=True, return_counts=True)
+            order = cells[np.argsort(codes, kind="stable")]
+            offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            self.strata.append([torch.from_numpy(order), torch.from_numpy(offsets), torch.from_numpy(counts)])
+        if strata_weights is None:
+            strata_weights = [1.0 / len(self.strata)] * len(self.strata) if len(self.strata) > 1 else [1.0]
+        assert len(strata_weights) == len(self.strata)
+        shares = np.floor(np.asarray(strata_weights, dtype=np.float64) / np.sum(strata_weights) * batch_size)
+        shares[-1] = batch_size - shares[:-1].sum()
+        self.shares = [int(share) for share in shares]
+        if device is not None:
+            self.to(device)
+
+    def to(self, device):
+        self.strata = [[tensor.to(device) for tensor in stratum] for stratum in self.strata]
+        return self
+
+    def __len__(self):
+        if self.drop_last or len(self.strata) > 1:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def _draw(self, stratum, n):
+        order, offsets, counts = stratum
+        group = torch.randint(len(counts), (n,), device=order.device)
+        within = (torch.rand(n, device=order.device) * counts[group]).long()
+        return order[offsets[group] + within]
+
+    def __iter__(self):
+        n_batches = len(self)
+        if len(self.strata) == 1:
+            n = self.num_samples if not self.drop_last else n_batches * self.batch_size
+            draws = self._draw(self.strata[0], n)
+            return iter(draws.split(self.batch_size))
+        draws = torch.cat([self._draw(stratum, n_batches * share).view(n_batches, share)
+                           for stratum, share in zip(self.strata, self.shares)], dim=1)
+        return iter(draws.unbind(0))
+
+
+def cell_dataloader(dataset, batch_size, shuffle=False, drop_last=False, sampler=None, device=None,
+                    batch_sampler=None):
+    # batches are fetched with a single dataset[list_of_indices] call instead of per-cell collation;
+    # with a device the dataset is moved there once and batched by DeviceBatchLoader.
+    # batch_sampler (e.g. ClassBalancedBatchSampler) yields whole batches of indexes
+    if batch_sampler is not None:
+        if device is not None:
+            return DeviceBatchLoader(dataset.to_device(device), batch_size, batch_sampler=batch_sampler.to(device))
+        return DataLoader(dataset, sampler=batch_sampler, batch_size=None)
+    if device is not None:
+        weights, num_samples, replacement = None, None, True
+        if isinstance(sampler, WeightedRandomSampler):
+            weights, num_samples, replacement = sampler.weights, sampler.num_samples, sampler.replacement
+        else:
+            assert sampler is None
+        return DeviceBatchLoader(dataset.to_device(device), batch_size, shuffle=shuffle, drop_last=drop_last,
+                                 weights=weights, num_samples=num_samples, replacement=replacement)
+    if sampler is None:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last), batch_size=None)
@@ -0,0 +1,242 @@
+import contextlib
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from layers import GaussianNoise
+from metrics import ConfusionMatrix
+
+
+def _generator_device(device):
+    # generators of host tensors are plain "cpu" ones whatever index the device carries
+    if device is None or torch.device(device).type == "cpu":
+        return "cpu"
+    return torch.device(device)
+
+
+class ReplicaStreams(object):
+    """
+    Independent RNG streams of K replicas trained in lockstep. Replica k has its own torch CPU RNG state for
+    the initialization of its modules (see init()) and its own generators for the sampler order and the
+    noise layers, all seeded from seeds[k].
+    # Arguments
+        sampler_device: device of the training rows (the data device with --device-data, else the host)
+    """
+    def __init__(self, seeds, device, sampler_device=None):
+        self.seeds = list(seeds)
+        self.states = []
+        for seed in self.seeds:
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(seed)
+                self.states.append(torch.get_rng_state())
+        self.sampler = [torch.Generator(_generator_device(sampler_device)) for _ in self.seeds]
+        self.noise = [torch.Generator(_generator_device(device)) for _ in self.seeds]
+        for seed, sampler, noise in zip(self.seeds, self.sampler, self.noise):
+            sampler.manual_seed(seed)
+            noise.manual_seed(seed)
+
+    def __len__(self):
+        return len(self.seeds)
+
+    @contextlib.contextmanager
+    def init(self, k):
+        # modules built in this block are initialized from (and advance) the stream of replica k
+        with torch.random.fork_rng(devices=[]):
+            torch.set_rng_state(self.states[k])
+            yield
+            self.states[k] = torch.get_rng_state()
+
+
+class StackedLinear(nn.Module):
+    """
+    K nn.Linear layers of the same shape as one (K, out, in) weight, applied to (K, B, in) inputs with a
+    single batched matmul.
+    """
+    def __init__(self, layers):
+        super(StackedLinear, self).__init__()
+        self.weight = nn.Parameter(torch.stack([layer.weight.data for layer in layers]))
+        self.bias = nn.Parameter(torch.stack([layer.bias.data for layer in layers]))
+
+    def forward(self, h):
+        return torch.baddbmm(self.bias.unsqueeze(1), h, self.weight.transpose(1, 2))
+
+
+class StackedNoise(nn.Module):
+    # GaussianNoise of K replicas, replica k drawing from its own generator
+    def __init__(self, sigma, generators):
+        super(StackedNoise, self).__init__()
+        self.sigma = sigma
+        self.generators = generators
+
+    def forward(self, h):
+        if self.training:
+            noise = torch.stack([torch.randn(h.shape[1:], generator=g, device=h.device, dtype=h.dtype)
+                                 for g in self.generators])
+            h = h + self.sigma * noise
+        return h
+
+
+def _stack_layers(sequentials, generators):
+    layers = []
+    for replica_layers in zip(*sequentials):
+        layer = replica_layers[0]
+        if isinstance(layer, nn.Linear):
+            layers.append(StackedLinear(replica_layers))
+        elif isinstance(layer, GaussianNoise):
+            layers.append(StackedNoise(layer.sigma, generators))
+        else:  # parameter-free activations act elementwise
+            layers.append(layer)
+    return nn.Sequential(*layers)
+
+
+class StackedAutoEncoder(nn.Module):
+    """
+    K AutoEncoder replicas with their parameters stacked along a leading replica dimension. Inputs, embeddings
+    and ZINB outputs are (K, B, ...) tensors; every layer is one batched matmul over the K replicas, and as
+    the replicas share no parameter, the gradients of the summed per-replica losses are those of K separate
+    trainings.
+    # Arguments
+        replicas: AutoEncoder instances with the same architecture (e.g. built under different seeds)
+        generators: per-replica generators of the noise layers (ReplicaStreams.noise)
+    """
+    def __init__(self, replicas, generators):
+        super(StackedAutoEncoder, self).__init__()
+        self.replicas = len(replicas)
+        self.input_dim = replicas[0].input_dim
+        self.z_dim = replicas[0].z_dim
+        self.encoder = _stack_layers([r.encoder for r in replicas], generators)
+        self.decoder = _stack_layers([r.decoder for r in replicas], generators)
+        self._enc_mu = StackedLinear([r._enc_mu for r in replicas])
+        self._dec_zinb = StackedLinear([r._dec_zinb.fc for r in replicas])
+        head = replicas[0]._dec_zinb
+        self.mean_act, self.disp_act, self.pi_act = head.mean_act, head.disp_act, head.pi_act
+
+    def forward(self, x):
+        z = self._enc_mu(self.encoder(x))
+        mean, disp, pi = torch.split(self._dec_zinb(self.decoder(z)), self.input_dim, dim=-1)
+        return z.float(), self.mean_act(mean), self.disp_act(disp), self.pi_act(pi)
+
+    def encode(self, x):
+        h = x
+        for layer in self.encoder:
+            if not isinstance(layer, StackedNoise):
+                h = layer(h)
+        return self._enc_mu(h).float()
+
+
+class StackedPrototype(nn.Module):
+    """
+    Prototype classifiers of K replicas, a (K, num_classes, D) weight applied to (K, B, D) embeddings.
+    """
+    def __init__(self, replicas):
+        super(StackedPrototype, self).__init__()
+        self.weight = nn.Parameter(torch.stack([r.fc.weight.data for r in replicas]))
+        self.tau = replicas[0].tau
+
+    def forward(self, z):
+        return torch.bmm(F.normalize(z, dim=-1), self.weight.transpose(1, 2)).float() / self.tau
+
+    def load_previous(self, weight_store):
+        # the normalized prototypes of the previous stage, (K, previous classes, D)
+        self.weight.data[:, :weight_store.shape[1]] = F.normalize(weight_store, dim=-1)
+
+    def label_weights(self, labels):
+        # prototype of the label of every cell, (K, B, D) for (K, B) labels
+        return self.weight[torch.arange(self.weight.shape[0], device=labels.device).unsqueeze(1), labels]
+
+
+def proxy_contrastive_loss(z, w, labels, temperature):
+    """
+    SupConLoss(contrast_mode='proxy') of the training scripts, for K replicas at once.
+    # Arguments
+        z: (K, B, D) embeddings, w: (K, B, D) prototypes of their labels, labels: (K, B)
+    # Return
+        the (K,) per-replica losses
+    """
+    z = z / (torch.norm(z, p=2, dim=2, keepdim=True) + 0.000001)
+    w = w / (torch.norm(w, p=2, dim=2, keepdim=True) + 0.000001)
+    logits = torch.bmm(z, w.transpose(1, 2)) / temperature
+    logits = logits - torch.max(logits, dim=2, keepdim=True)[0].detach()
+    mask = torch.eq(labels.unsqueeze(2), labels.unsqueeze(1)).float()
+    log_prob = logits - torch.log(torch.exp(logits).sum(2, keepdim=True))
+    return -((mask * log_prob).sum(2) / mask.sum(2)).mean(1)
+
+
+class StackedBatchLoader(object):
+    """
+    Training batches of K replicas in lockstep: replica k shuffles its own training rows rows[k] with its own
+    generator every epoch, and the K batches are gathered from `dataset` with one indexing call.
+    # Arguments
+        dataset: CellDataset (or DeviceCellDataset) holding the cells of all replicas
+        rows: (K, n) rows of `dataset` of every replica, the same number n for all
+        generators: per-replica sampler generators (ReplicaStreams.sampler), on the device of the rows
+    # Return
+        x, raw_x, sf, y batches shaped (K, batch_size, ...)
+    """
+    def __init__(self, dataset, rows, batch_size, generators, drop_last=True):
+        self.dataset = dataset
+        self.generators = generators
+        self.rows = torch.as_tensor(np.asarray(rows, dtype=np.int64), device=generators[0].device)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def __len__(self):
+        n = self.rows.shape[1]
+        return n // self.batch_size if self.drop_last else (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = self.rows.shape[1]
+        order = torch.stack([self.rows[k][torch.randperm(n, generator=g, device=self.rows.device)]
+                             for k, g in enumerate(self.generators)])
+        replicas = order.shape[0]
+        for batch in range(len(self)):
+            index = order[:, batch * self.batch_size:(batch + 1) * self.batch_size].reshape(-1)
+            data = self.dataset[index]
+            yield tuple(t.reshape((replicas, -1) + tuple(t.shape[1:])) for t in data[:4])
+
+
+def stacked_embeddings(model, dataset, rows, batch_size, device):
+    # (K, len(rows), z_dim) embeddings of the cells `rows` by every replica, and their labels
+    model.eval()
+    z, labels = [], []
+    with torch.no_grad():
+        for start in range(0, len(rows), batch_size):
+            data = dataset[rows[start:start + batch_size]]
+            x = data[0].to(device)
+            z.append(model.encode(x.unsqueeze(0).expand(model.replicas, -1, -1)))
+            labels.append(data[3].to(device))
+    return torch.cat(z, dim=1), torch.cat(labels)
+
+
+def stacked_confusions(model, proto_net, dataset, rows, batch_size, num_classes, device):
+    """
+    metrics.ConfusionMatrix of every replica on the cells `rows` of dataset; each batch is encoded and
+    classified by the K replicas at once.
+    """
+    model.eval()
+    proto_net.eval()
+    confusions = [ConfusionMatrix(num_classes, device) for _ in range(model.replicas)]
+    with torch.no_grad():
+        for start in range(0, len(rows), batch_size):
+            data = dataset[rows[start:start + batch_size]]
+            x, y = data[0].to(device), data[3].to(device)
+            preds = proto_net(model.encode(x.unsqueeze(0).expand(model.replicas, -1, -1))).argmax(2)
+            for confusion, pred in zip(confusions, preds):
+                confusion.update(y, pred)
+    return confusions
+
+
+def stacked_exemplars(model, dataset, rows, top_k, batch_size, device):
+    """
+    Exemplar selection of the replay scripts for every replica: for each class of the cells `rows`, the
+    min(top_k, class size) cells closest (cosine) to the class center in the embedding of the replica.
+    # Return
+        (K, memory size) selected rows of dataset per replica, the same count for all replicas
+    """
+    z, labels = stacked_embeddings(model, dataset, rows, batch_size, device)
+    classes = torch.unique(labels)
+    centers = torch.stack([z[:, labels == c].mean(dim=1) for c in classes], dim=1)
+    distances = torch.bmm(F.normalize(z, dim=2), F.normalize(centers, dim=2).transpose(1, 2))
+    selected = [torch.topk(distances[:, :, j], k=min(int((labels == c).sum()), top_k), dim=1)[1]
+                for j, c in enumerate(classes)]
+    return np.asarray(rows)[torch.cat(selected, dim=1).cpu().numpy()]
@@ -0,0 +1,223 @@
+import copy
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import torch.nn as nn
+from dataset import DeviceCellDataset, DeviceBatchLoader, cell_dataloader
+from metrics import ConfusionMatrix, SampledAccuracy
+
+
+def inference_batch_size(model, num_features, memory_budget=512 << 20, count_bytes=8):
+    """
+    Rows per evaluation batch such that a batch fits in memory_budget bytes: the dense fp32 x and raw count
+    rows (count_bytes per count, int64 at most) that CellDataset materializes for every batch, the fp32 input
+    on the device and the encoder activations. Inference keeps no autograd state, so this is usually far
+    above the training batch size.
+    """
+    widths = [layer.out_features for layer in model.encoder if isinstance(layer, nn.Linear)]
+    row_bytes = (4 + count_bytes + 4) * num_features + 4 * (sum(widths) + model.z_dim)
+    return max(1, int(memory_budget // row_bytes))
+
+
+def predict(model, proto_net, dataloader, device, embeddings=True, confusion=None):
+    """
+    Prototype predictions for every cell of dataloader.dataset (model.encode, then proto_net). Labels,
+    predictions, confidences and embeddings are written at their dataset index into tensors preallocated
+    on `device`, and copied to the host once at the end. A metrics.ConfusionMatrix passed as `confusion`
+    is updated batch by batch on the device.
+    # Return
+        targets, preds, confs, embeddings (None unless `embeddings`) as numpy arrays in dataset order
+    """
+    n = len(dataloader.dataset)
+    model.eval()
+    proto_net.eval()
+    targets = torch.empty(n, dtype=torch.long, device=device)
+    preds = torch.empty(n, dtype=torch.long, device=device)
+    confs = torch.empty(n, dtype=torch.float32, device=device)
+    z = torch.empty((n, model.z_dim), dtype=torch.float32, device=device) if embeddings else None
+    with torch.no_grad():
+        for data in dataloader:
+            x_t, label_t, index_t = data[0].to(device), data[3].to(device), data[4].to(device)
+            z_t = model.encode(x_t)
+            conf, pred = proto_net(z_t).max(1)
+            targets[index_t] = label_t.long()
+            preds[index_t] = pred
+            confs[index_t] = conf.float()
+            if confusion is not None:
+                confusion.update(label_t, pred)
+            if embeddings:
+                z[index_t] = z_t
+    out = [targets.cpu().numpy(), preds.cpu().numpy(), confs.cpu().numpy()]
+    return out + [z.cpu().numpy() if embeddings else None]
+
+
+def extract(model, dataloader, device):
+    """
+    Embeddings (model.encode) and labels of every cell of dataloader.dataset, in dataset order.
+    """
+    n = len(dataloader.dataset)
+    model.eval()
+    labels = torch.empty(n, dtype=torch.long, device=device)
+    z = torch.empty((n, model.z_dim), dtype=torch.float32, device=device)
+    with torch.no_grad():
+        for data in dataloader:
+            x_t, label_t, index_t = data[0].to(device), data[3].to(device), data[4].to(device)
+            z[index_t] = model.encode(x_t)
+            labels[index_t] = label_t.long()
+    return z.cpu().numpy(), labels.cpu().numpy()
+
+
+class EvalPolicy(object):
+    """
+    Evaluation schedule of one stage. The final epoch is always evaluated on the full test sets. Every
+    `interval` epochs before it, each test set is evaluated on a fixed stratified subsample of at most
+    `per_class` cells per class (the full set if per_class <= 0), and these intermediate evaluations are
+    skipped once they took `time_budget` seconds in total (no limit if <= 0).
+    # Arguments
+        batch_size: inference batch size of the subsample loaders
+        data_device: device of the evaluation datasets (--device-data) or None
+    """
+    def __init__(self, interval, final_epoch, batch_size, data_device=None, per_class=0, time_budget=0., seed=0):
+        self.interval = interval
+        self.final_epoch = final_epoch
+        self.batch_size = batch_size
+        self.data_device = data_device
+        self.per_class = per_class
+        self.time_budget = time_budget
+        self.seed = seed
+        self.spent = 0.
+        self.samples = {}
+
+    def due(self, epoch):
+        if epoch == self.final_epoch:
+            return True
+        return epoch % self.interval == 0 and (self.time_budget <= 0 or self.spent < self.time_budget)
+
+    def subsampled(self, epoch):
+        return epoch != self.final_epoch and self.per_class > 0
+
+    def _sample(self, dataloader):
+        # (loader of the subsample, labels of the full set), drawn once per test set
+        key = id(dataloader)
+        if key not in self.samples:
+            dataset = dataloader.dataset
+            if isinstance(dataset, DeviceCellDataset):
+                labels = dataset.tensors[3].cpu().numpy()
+            else:
+                labels = np.asarray(dataset.y)
+            rng = np.random.RandomState(self.seed)
+            rows = np.sort(np.concatenate([rng.permutation(np.where(labels == c)[0])[:self.per_class]
+                                           for c in np.unique(labels)]))
+            subset = dataset.subset(rows)
+            if isinstance(subset, DeviceCellDataset):
+                loader = DeviceBatchLoader(subset, self.batch_size)
+            else:
+                loader = cell_dataloader(subset, self.batch_size)
+            self.samples[key] = (loader, labels)
+        return self.samples[key]
+
+    def prepare(self, dataloader, epoch, num_classes):
+        """
+        (loader, population) of an evaluation at `epoch`: the full test set of `dataloader` (population None,
+        taken from the confusion matrix) or its subsample with the class sizes of the full set. Subsamples are
+        drawn and memoized here, on the training thread only.
+        """
+        if self.subsampled(epoch):
+            loader, labels = self._sample(dataloader)
+            return loader, np.bincount(labels, minlength=num_classes)
+        return dataloader, None
+
+    def evaluate(self, model, proto_net, dataloader, epoch, num_classes, device, embeddings=True):
+        """
+        predict() on the full test set of `dataloader` or on its subsample, depending on the epoch.
+        # Return
+            targets, preds, confs, embeddings of the evaluated cells (see predict), their ConfusionMatrix
+            and the SampledAccuracy estimate for the full test set
+        """
+        start = time.time()
+        loader, population = self.prepare(dataloader, epoch, num_classes)
+        out = evaluate_loader(model, proto_net, loader, population, num_classes, device, embeddings)
+        if epoch != self.final_epoch:
+            self.spent += time.time() - start
+        return out
+
+
+def evaluate_loader(model, proto_net, loader, population, num_classes, device, embeddings=True):
+    # predict() outputs, ConfusionMatrix and SampledAccuracy of one prepared loader (see EvalPolicy.prepare)
+    confusion = ConfusionMatrix(num_classes, device)
+    out = predict(model, proto_net, loader, device, embeddings=embeddings, confusion=confusion)
+    if population is None:
+        population = confusion.numpy().sum(axis=1)
+    return out + [confusion, SampledAccuracy(confusion, population)]
+
+
+class BackgroundEvaluator(object):
+    """
+    Runs the intermediate evaluations in a worker thread on snapshots of the model and prototypes, so that
+    training only pays for copying their state. Jobs run one at a time in submission order on a private copy
+    of the model (on CUDA in a side stream), results are tagged with stage and epoch and printed by poll()
+    and drain() from the training thread. The loaders are prepared by the policy at submission, on the
+    training thread; the worker does not touch the policy, and background evaluations, which overlap training,
+    are not charged to its time budget.
+    # Arguments
+        model: the AutoEncoder being trained, copied once here and refreshed from each snapshot
+    """
+    def __init__(self, model, device):
+        self.source = model
+        self.model = copy.deepcopy(model)
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
+
+    def submit(self, stage, epoch, proto_net, policy, num_classes, **loaders):
+        """
+        Evaluate the current weights on every named dataloader (e.g. test=..., last=...), on the loaders
+        policy.prepare gives for this epoch.
+        """
+        loaders = {name: policy.prepare(loader, epoch, num_classes) for name, loader in loaders.items()}
+        model_state = {k: v.detach().clone() for k, v in self.source.state_dict().items()}
+        proto = copy.deepcopy(proto_net)
+        ready = None
+        if self.stream is not None:
+            ready = torch.cuda.Event()
+            ready.record()
+        self.pending.append(self.executor.submit(self._run, stage, epoch, model_state, proto, num_classes,
+                                                 loaders, ready))
+
+    def _run(self, stage, epoch, model_state, proto, num_classes, loaders, ready):
+        if self.stream is not None:
+            self.stream.wait_event(ready)
+            with torch.cuda.stream(self.stream):
+                return self._evaluate(stage, epoch, model_state, proto, num_classes, loaders)
+        return self._evaluate(stage, epoch, model_state, proto, num_classes, loaders)
+
+    def _evaluate(self, stage, epoch, model_state, proto, num_classes, loaders):
+        self.model.load_state_dict(model_state)
+        estimates = {}
+        for name, (loader, population) in loaders.items():
+            estimates[name] = evaluate_loader(self.model, proto, loader, population, num_classes, self.device,
+                                              embeddings=False)[-1]
+        return stage, epoch, estimates
+
+    def _report(self, result):
+        stage, epoch, estimates = result
+        overall = None
+        for name, estimate in estimates.items():
+            overall = estimate if overall is None else overall + estimate
+            print("In the {}-th stage and {}-th epoch (background), Test acc on {} {:.4f} +/-{:.4f}".format(
+                stage, epoch, name, estimate.accuracy, estimate.interval()))
+        if len(estimates) > 1:
+            print("In the {}-th stage and {}-th epoch (background), Test acc overall {:.4f} +/-{:.4f}".format(
+                stage, epoch, overall.accuracy, overall.interval()))
+
+    def poll(self):
+        # report the finished evaluations, in submission order
+        while self.pending and self.pending[0].done():
+            self._report(self.pending.popleft().result())
+
+    def drain(self):
+        while self.pending:
+            self._report(self.pending.popleft().result())
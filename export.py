@@ -0,0 +1,105 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from data_cache import save_arrays, load_arrays
+
+FORMATS = ("npy", "parquet", "hdf5", "csv")
+
+
+def map_names(labels, names):
+    # cell type name of every label, one fancy-indexing pass instead of a loop over the unique labels
+    return np.asarray(names, dtype=object)[np.asarray(labels, dtype=np.int64)]
+
+
+def _prepare(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+def _write_table(frame, path, fmt):
+    _prepare(path)
+    if fmt == "npy":
+        # one .npy per column (see data_cache.save_arrays), readable with mmap
+        save_arrays(path, {column: frame[column].values for column in frame.columns},
+                    meta={"columns": list(frame.columns)})
+    elif fmt == "parquet":
+        frame.to_parquet(path + ".parquet")
+    elif fmt == "hdf5":
+        import h5py
+        with h5py.File(path + ".h5", "w") as f:
+            for column in frame.columns:
+                values = frame[column].values
+                if values.dtype == object:
+                    values = values.astype(str).astype(h5py.string_dtype())
+                f.create_dataset(column, data=values)
+    else:
+        frame.to_csv(path + ".csv")
+
+
+def _write_embeddings(embeddings, path, fmt):
+    _prepare(path)
+    embeddings = np.ascontiguousarray(embeddings)
+    if fmt == "npy":
+        np.save(path + ".npy", embeddings)
+    elif fmt == "parquet":
+        pd.DataFrame(embeddings, columns=[str(i) for i in range(embeddings.shape[1])]).to_parquet(path + ".parquet")
+    elif fmt == "hdf5":
+        import h5py
+        with h5py.File(path + ".h5", "w") as f:
+            f.create_dataset("embeddings", data=embeddings)
+    else:
+        pd.DataFrame(embeddings).to_csv(path + ".csv")
+
+
+class StageExporter(object):
+    """
+    Writes the per-stage prediction tables and test embeddings in a background thread, in the chosen
+    format: "npy" (a directory of .npy columns for tables, a .npy for embeddings), "parquet", "hdf5" or
+    the former "csv". Paths are given without extension. Write errors are raised by close().
+    """
+    def __init__(self, fmt="npy"):
+        if fmt not in FORMATS:
+            raise ValueError("Unknown export format {}, expected one of {}".format(fmt, FORMATS))
+        if fmt == "parquet":
+            pd.io.parquet.get_engine("auto")  # fail now rather than in the writer thread
+        elif fmt == "hdf5":
+            import h5py  # noqa: F401
+        self.fmt = fmt
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    def table(self, frame, path):
+        self.pending.append(self.executor.submit(_write_table, frame, path, self.fmt))
+
+    def embeddings(self, embeddings, path):
+        self.pending.append(self.executor.submit(_write_embeddings, embeddings, path, self.fmt))
+
+    def close(self):
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        self.executor.shutdown()
+
+
+def load_export(path):
+    """
+    Read back a table or embeddings written by StageExporter (path without extension). npy exports are
+    memory-mapped without copying; a table is returned as a dict of columns, embeddings as an array.
+    """
+    if os.path.exists(path + ".npy"):
+        return np.load(path + ".npy", mmap_mode="r")
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return load_arrays(path, mmap=True)[0]
+    if os.path.exists(path + ".parquet"):
+        return pd.read_parquet(path + ".parquet")
+    if os.path.exists(path + ".h5"):
+        import h5py
+        with h5py.File(path + ".h5", "r") as f:
+            if list(f.keys()) == ["embeddings"]:
+                return f["embeddings"][()]
+            return {key: f[key][()] for key in f.keys()}
+    if os.path.exists(path + ".csv"):
+        return pd.read_csv(path + ".csv", index_col=0)
+    raise FileNotFoundError("No export found at {}".format(path))
@@ -0,0 +1,97 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+
+class GeneRegistry(object):
+    """
+    Reference gene vocabulary with a hash index (pandas.Index) from gene name to reference column id.
+    Datasets are mapped onto the reference with one vectorized lookup instead of per-gene list.index calls,
+    and the registry can be saved and extended when the genes of a new dataset have to be registered later.
+    # Arguments
+        genes: reference gene names, duplicated names keep their first position
+    """
+    def __init__(self, genes=()):
+        self.index = pd.Index(np.asarray(genes, dtype=object)).unique()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, gene):
+        return gene in self.index
+
+    @property
+    def genes(self):
+        return np.array(self.index, dtype=object)
+
+    @classmethod
+    def intersection(cls, gene_name_list):
+        # genes shared by all lists, in the order of the first one (as anndata.concat(join="inner"))
+        index = pd.Index(np.asarray(gene_name_list[0], dtype=object)).unique()
+        for gene_name in gene_name_list[1:]:
+            index = index.intersection(pd.Index(np.asarray(gene_name, dtype=object)), sort=False)
+        return cls(index)
+
+    def ids(self, genes, missing="raise"):
+        """
+        Reference column ids of `genes`, -1 for unknown genes unless missing="raise".
+        """
+        ids = self.index.get_indexer(np.asarray(genes, dtype=object))
+        if missing == "raise" and (ids < 0).any():
+            raise ValueError("Genes not found: {}".format(list(np.asarray(genes)[ids < 0][:10])))
+        return ids.astype(np.int64)
+
+    def positions(self, gene_name, missing="raise"):
+        """
+        For every reference gene, its column in a dataset with genes `gene_name` (first occurrence for
+        duplicated names), -1 for genes the dataset lacks unless missing="raise".
+        """
+        dataset_index = pd.Index(np.asarray(gene_name, dtype=object))
+        first = np.where(~dataset_index.duplicated())[0]
+        positions = dataset_index[first].get_indexer(self.index)
+        positions = np.where(positions >= 0, first[positions], -1)
+        if missing == "raise" and (positions < 0).any():
+            raise ValueError("Genes not found: {}".format(list(self.index[positions < 0][:10])))
+        return positions.astype(np.int64)
+
+    def align(self, X, gene_name):
+        """
+        Columns of the (cells x genes) matrix X reordered to the reference genes. Reference genes absent
+        from the dataset become zero columns, so a new dataset can be projected onto a trained gene space.
+        """
+        positions = self.positions(gene_name, missing="ignore")
+        found = positions >= 0
+        if found.all():
+            return X[:, positions]
+        target = np.where(found)[0]
+        if scipy.sparse.issparse(X):
+            X = scipy.sparse.csr_matrix(X)[:, positions[found]]
+            return scipy.sparse.csr_matrix((X.data, target[X.indices], X.indptr), shape=(X.shape[0], len(self)))
+        aligned = np.zeros((X.shape[0], len(self)), dtype=X.dtype)
+        aligned[:, target] = X[:, positions[found]]
+        return aligned
+
+    def extend(self, genes):
+        """
+        Register the unknown genes in `genes` at the end of the vocabulary, existing ids do not change.
+        # Return
+            the reference ids of `genes`
+        """
+        genes = pd.Index(np.asarray(genes, dtype=object))
+        new = genes[self.index.get_indexer(genes) < 0].unique()
+        if len(new):
+            self.index = self.index.append(new)
+        return self.ids(genes)
+
+    def save(self, path):
+        tmp_path = path + ".tmp.{}".format(os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump([str(gene) for gene in self.index], f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            return cls(json.load(f))
@@ -4,36 +4,62 @@ import torch.nn.functional as F
 import numpy as np
 
 
+def autocast(device, enabled=True):
+    """
+    bf16 autocast for the network GEMMs (--amp). Outputs of the activation heads and the losses stay fp32.
+    """
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=enabled)
+
+
 class ZINBLoss(nn.Module):
-    def __init__(self):
+    """
+    Zero-inflated negative binomial loss. The scale factors are broadcast instead of expanded with a matmul,
+    log/lgamma terms shared between the NB and zero cases are computed once, and the constant lgamma(x + 1)
+    of the integer counts is read from a table of log factorials when max_count is given (counts up to
+    max_count, the largest count of the dataset; larger tables fall back to lgamma).
+    Build one instance per dataset and reuse it for every batch. With `dim`, the mean is only taken over
+    these dimensions (e.g. one loss per replica of stacked models, see ensemble.py).
+    """
+    max_table_size = 1 << 20
+
+    def __init__(self, max_count=None):
         super(ZINBLoss, self).__init__()
-
-    def forward(self, x, mean, disp, pi, scale_factor, ridge_lambda=1.0):
+        if max_count is not None and max_count < self.max_table_size:
+            self.register_buffer("log_factorial", torch.lgamma(torch.arange(int(max_count) + 1, dtype=torch.float32) + 1.0))
+        else:
+            self.log_factorial = None
+
+    def lgamma_x1(self, x):
+        if self.log_factorial is not None:
+            return self.log_factorial[x.long()]
+        return torch.lgamma(x + 1.0)
+
+    def forward(self, x, mean, disp, pi, scale_factor, ridge_lambda=1.0, dim=None):
+        # the log/lgamma terms are computed in fp32 even when called under autocast
+        with torch.autocast(device_type=mean.device.type, enabled=False):
+            return self._forward(x.float(), mean.float(), disp.float(), pi.float(), scale_factor.float(),
+                                 ridge_lambda, dim)
+
+    def _forward(self, x, mean, disp, pi, scale_factor, ridge_lambda, dim=None):
         eps = 1e-10
-        # scale_factor = scale_factor[:, None]
-        scale_factor = torch.matmul(scale_factor, torch.ones_like(torch.sum(mean, dim=0)).view(1, -1))
         mean = mean * scale_factor
-        
-        t1 = torch.lgamma(disp+eps) + torch.lgamma(x+1.0) - torch.lgamma(x+disp+eps)
-        t2 = (disp+x) * torch.log(1.0 + (mean/(disp+eps))) + (x * (torch.log(disp+eps) - torch.log(mean+eps)))
-        nb_final = t1 + t2
+        disp_eps = disp + eps
+        log_disp_eps = torch.log(disp_eps)
 
-        nb_final = torch.where(torch.isnan(nb_final), torch.zeros_like(nb_final) + np.inf, nb_final)
+        t1 = torch.lgamma(disp_eps) + self.lgamma_x1(x) - torch.lgamma(x + disp_eps)
+        t2 = (disp + x) * torch.log(1.0 + mean / disp_eps) + x * (log_disp_eps - torch.log(mean + eps))
+        nb_final = torch.nan_to_num(t1 + t2, nan=np.inf, posinf=np.inf, neginf=-np.inf)
 
-        nb_case = nb_final - torch.log(1.0-pi+eps)
-        zero_nb = torch.pow(disp/(disp+mean+eps), disp)
-        zero_case = -torch.log(pi + ((1.0-pi)*zero_nb)+eps)
-        result = torch.where(torch.le(x, 1e-8), zero_case, nb_case)
+        nb_case = nb_final - torch.log(1.0 - pi + eps)
+        zero_nb = torch.pow(disp / (disp + mean + eps), disp)
+        zero_case = -torch.log(pi + (1.0 - pi) * zero_nb + eps)
+        result = torch.where(x <= 1e-8, zero_case, nb_case)
 
         if ridge_lambda > 0:
-            ridge = ridge_lambda*torch.square(pi)
-            result += ridge
-
-        result = torch.mean(result)
+            result = result + ridge_lambda * torch.square(pi)
 
-        result = torch.where(torch.isnan(result), torch.zeros_like(result) + np.inf, result)
-
-        return result
+        result = torch.mean(result) if dim is None else torch.mean(result, dim=dim)
+        return torch.nan_to_num(result, nan=np.inf, posinf=np.inf, neginf=-np.inf)
 
 
 class GaussianNoise(nn.Module):
@@ -52,7 +78,7 @@ class MeanAct(nn.Module):
         super(MeanAct, self).__init__()
 
     def forward(self, x):
-        return torch.clamp(torch.exp(x), min=1e-5, max=1e6)
+        return torch.clamp(torch.exp(x.float()), min=1e-5, max=1e6)
 
 
 class DispAct(nn.Module):
@@ -60,5 +86,45 @@ class DispAct(nn.Module):
         super(DispAct, self).__init__()
 
     def forward(self, x):
-        return torch.clamp(F.softplus(x), min=1e-4, max=1e4)
+        return torch.clamp(F.softplus(x.float()), min=1e-4, max=1e4)
+
 
+class PiAct(nn.Module):
+    def __init__(self):
+        super(PiAct, self).__init__()
+
+    def forward(self, x):
+        return torch.sigmoid(x.float())
+
+
+
+class ZINBHead(nn.Module):
+    """
+    The mean, dispersion and dropout heads of the ZINB decoder as a single Linear to 3 * output_dim,
+    split into the MeanAct / DispAct / sigmoid outputs: one GEMM and one read of the hidden layer instead
+    of three. Initialized like three separate nn.Linear(input_dim, output_dim) heads.
+    """
+    def __init__(self, input_dim, output_dim):
+        super(ZINBHead, self).__init__()
+        self.output_dim = output_dim
+        self.fc = nn.Linear(input_dim, 3 * output_dim)
+        self.mean_act = MeanAct()
+        self.disp_act = DispAct()
+        self.pi_act = PiAct()
+
+    def forward(self, h):
+        mean, disp, pi = torch.split(self.fc(h), self.output_dim, dim=-1)
+        return self.mean_act(mean), self.disp_act(disp), self.pi_act(pi)
+
+
+def zinb_head_hook(name, heads=("_dec_mean.0", "_dec_disp.0", "_dec_pi.0")):
+    """
+    load_state_dict pre-hook for a module holding a ZINBHead as attribute `name`: the parameters of the
+    former three nn.Linear heads (`heads`) are concatenated into the fused layer, so old checkpoints load.
+    """
+    def hook(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        for param in ("weight", "bias"):
+            keys = [prefix + head + "." + param for head in heads]
+            if all(key in state_dict for key in keys):
+                state_dict[prefix + name + ".fc." + param] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+    return hook
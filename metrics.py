@@ -0,0 +1,129 @@
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+
+
+class ConfusionMatrix(object):
+    """
+    Confusion matrix (rows: true class, columns: predicted class) accumulated on the device, one bincount
+    per evaluation batch. All metrics are derived from the C x C counts, so they cost O(C^2) whatever the
+    number of cells; matrices of disjoint test sets add up with `+`.
+    # Arguments
+        num_classes: labels and predictions lie in [0, num_classes)
+        device: device of the label/prediction tensors passed to update()
+    """
+    def __init__(self, num_classes, device=None):
+        self.num_classes = int(num_classes)
+        self.counts = torch.zeros(self.num_classes * self.num_classes, dtype=torch.long, device=device)
+
+    def update(self, targets, preds):
+        self.counts += torch.bincount(targets.long() * self.num_classes + preds.long(),
+                                      minlength=self.num_classes * self.num_classes)
+
+    def __add__(self, other):
+        assert self.num_classes == other.num_classes
+        total = ConfusionMatrix(self.num_classes, self.counts.device)
+        total.counts = self.counts + other.counts
+        return total
+
+    def numpy(self):
+        return self.counts.view(self.num_classes, self.num_classes).cpu().numpy()
+
+    @staticmethod
+    def _rows(matrix, classes):
+        # true-class rows of `classes` (None for all, or a range / list of class ids)
+        return matrix if classes is None else matrix[np.asarray(list(classes), dtype=np.int64)]
+
+    def accuracy(self, classes=None):
+        """
+        Accuracy over the cells whose true class is in `classes` (all cells by default), 0 without cells.
+        """
+        matrix = self.numpy()
+        rows = self._rows(matrix, classes)
+        ids = np.arange(self.num_classes) if classes is None else np.asarray(list(classes), dtype=np.int64)
+        total = rows.sum()
+        return float(rows[np.arange(len(ids)), ids].sum() / total) if total else 0.
+
+    def per_class(self):
+        # recall of every class, nan for classes without test cells
+        matrix = self.numpy()
+        support = matrix.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(support > 0, np.diag(matrix) / support, np.nan)
+
+    def stage_accuracies(self, class_number_set):
+        """
+        Accuracy on the classes of every stage, class_number_set being the cumulative class counts
+        [0, n_1, n_2, ...] of the stages.
+        """
+        return [self.accuracy(range(class_number_set[i], class_number_set[i + 1]))
+                for i in range(len(class_number_set) - 1)]
+
+    def seen_unseen(self, labeled_num):
+        # accuracy on classes < labeled_num and on the others
+        return self.accuracy(range(labeled_num)), self.accuracy(range(labeled_num, self.num_classes))
+
+    def hungarian(self, classes=None):
+        """
+        Clustering accuracy (as cluster_acc) under the best one-to-one matching of predicted to true classes.
+        """
+        rows = self._rows(self.numpy(), classes)
+        total = rows.sum()
+        if not total:
+            return 0.
+        w = rows.T
+        row_ind, col_ind = linear_sum_assignment(w.max() - w)
+        return float(w[row_ind, col_ind].sum() / total)
+
+
+class SampledAccuracy(object):
+    """
+    Accuracy of a full test set estimated from the confusion matrix of a per-class (stratified) subsample.
+    Class accuracies are weighted by the class sizes of the full set, the variance includes the finite
+    population correction, so a subsample that holds every cell gives the exact accuracy with zero variance.
+    Estimates of disjoint test sets combine with `+`.
+    # Arguments
+        confusion: ConfusionMatrix of the subsample
+        population: number of cells of every class in the full test set
+    """
+    def __init__(self, confusion, population):
+        matrix = confusion.numpy()
+        sampled = matrix.sum(axis=1).astype(np.float64)
+        population = np.asarray(population, dtype=np.float64)
+        assert ((population > 0) <= (sampled > 0)).all(), "every class of the test set needs sampled cells"
+        self.size = population.sum()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p = np.where(sampled > 0, np.diag(matrix) / sampled, 0.)
+            fpc = np.where(population > 0, 1. - sampled / population, 0.)
+            class_var = np.where(sampled > 1, p * (1. - p) / (sampled - 1.), 0.) * fpc
+        weights = population / self.size if self.size else population
+        self.accuracy = float((weights * p).sum())
+        self.variance = float((weights ** 2 * class_var).sum())
+
+    def __add__(self, other):
+        total = object.__new__(SampledAccuracy)
+        total.size = self.size + other.size
+        a, b = (self.size / total.size, other.size / total.size) if total.size else (0., 0.)
+        total.accuracy = a * self.accuracy + b * other.accuracy
+        total.variance = a ** 2 * self.variance + b ** 2 * other.variance
+        return total
+
+    def interval(self, z=1.96):
+        # half width of the normal-approximation confidence interval (95% by default)
+        return z * np.sqrt(self.variance)
+
+
+def forgetting(stage_accuracy_history):
+    """
+    Average forgetting after the latest stage: for every earlier stage, its best accuracy before the latest
+    stage minus its accuracy now.
+    # Arguments
+        stage_accuracy_history: per trained stage t, the list of accuracies on the classes of stages 0..t
+            (see ConfusionMatrix.stage_accuracies)
+    """
+    if len(stage_accuracy_history) < 2:
+        return 0.
+    last = stage_accuracy_history[-1]
+    drops = [max(accs[i] for accs in stage_accuracy_history[:-1] if i < len(accs)) - last[i]
+             for i in range(len(stage_accuracy_history) - 1)]
+    return float(np.mean(drops))
@@ -9,6 +9,15 @@ import pandas as pd
 import scanpy.api as sc
 from sklearn.metrics.cluster import contingency_matrix
 import anndata
+import os
+import gc
+from concurrent.futures import ProcessPoolExecutor
+from data_cache import file_digest, config_key, cached_arrays, cached_store, ArrayWriter
+from gene_registry import GeneRegistry
+
+
+DATA_ROOT = "../scrna/data/"
+H5_DATANAMES = ["Quake_10x", "Cao", "Vento-Tormo_10x"]  # the other real datasets are stored as h5ad
 
 
 def read_clean(data):
@@ -32,18 +41,70 @@ def dict_from_group(group):
     return d
 
 
-def read_data(filename, sparsify=False, skip_exprs=False):
+def _read_csr_rows(group, rows, cols=None, max_nnz=1 << 25, max_gap=1 << 16):
+    # Read only the given (sorted) rows of a CSR group through its indptr. Runs of selected rows that are
+    # at most max_gap stored entries apart are fetched with one slice (bounded by max_nnz), the rows in
+    # between are dropped in memory together with the unselected columns.
+    indptr = group["indptr"][...]
+    n_cols = int(group["shape"][...][1])
+    out_cols = n_cols if cols is None else len(cols)
+    if len(rows) == 0:
+        return sp.sparse.csr_matrix((0, out_cols), dtype=group["data"].dtype)
+    # blocks as (first row position, end row position) in rows
+    blocks = []
+    start = 0
+    for i in range(1, len(rows)):
+        first, last, row = rows[start], rows[i - 1], rows[i]
+        if not (indptr[row] - indptr[last + 1] <= max_gap and indptr[row + 1] - indptr[first] <= max_nnz):
+            blocks.append((start, i))
+            start = i
+    blocks.append((start, len(rows)))
+    chunks = []
+    for start, end in blocks:
+        first, last = rows[start], rows[end - 1]
+        lo, hi = indptr[first], indptr[last + 1]
+        chunk = sp.sparse.csr_matrix((group["data"][lo:hi], group["indices"][lo:hi], indptr[first:last + 2] - lo),
+                                     shape=(last + 1 - first, n_cols))
+        chunk = chunk[rows[start:end] - first]
+        if cols is not None:
+            chunk = chunk[:, cols]
+        chunks.append(chunk)
+    return sp.sparse.vstack(chunks, format="csr")
+
+
+def gene_positions(gene_index, genes):
+    # positions of `genes` (a list or a GeneRegistry) in gene_index (first occurrence for duplicated names)
+    registry = genes if isinstance(genes, GeneRegistry) else GeneRegistry(genes)
+    return registry.positions(gene_index)
+
+
+def read_data(filename, sparsify=False, skip_exprs=False, obs_filter=None, genes=None):
+    # obs_filter: function of the obs DataFrame returning a boolean mask of the cells to load
+    # genes: optional list of var names, the columns of the returned matrix follow this order
     with h5py.File(filename, "r") as f:
         obs = pd.DataFrame(dict_from_group(f["obs"]), index=utils.decode(f["obs_names"][...]))
         var = pd.DataFrame(dict_from_group(f["var"]), index=utils.decode(f["var_names"][...]))
         uns = dict_from_group(f["uns"])
+        rows = None if obs_filter is None else np.where(np.asarray(obs_filter(obs)))[0]
+        cols = None if genes is None else gene_positions(var.index, genes)
+        if rows is not None:
+            obs = obs.iloc[rows]
+        if cols is not None:
+            var = var.iloc[cols]
         if not skip_exprs:
             exprs_handle = f["exprs"]
             if isinstance(exprs_handle, h5py.Group):
-                mat = sp.sparse.csr_matrix((exprs_handle["data"][...], exprs_handle["indices"][...],
-                                               exprs_handle["indptr"][...]), shape=exprs_handle["shape"][...])
+                if rows is None and cols is None:
+                    mat = sp.sparse.csr_matrix((exprs_handle["data"][...], exprs_handle["indices"][...],
+                                                   exprs_handle["indptr"][...]), shape=exprs_handle["shape"][...])
+                else:
+                    all_rows = np.arange(int(exprs_handle["shape"][...][0])) if rows is None else rows
+                    mat = _read_csr_rows(exprs_handle, all_rows, cols)
             else:
-                mat = exprs_handle[...].astype(np.float32)
+                mat = exprs_handle[...] if rows is None else exprs_handle[rows, :]
+                if cols is not None:
+                    mat = mat[:, cols]
+                mat = mat.astype(np.float32)
                 if sparsify:
                     mat = sp.sparse.csr_matrix(mat)
         else:
@@ -51,12 +112,31 @@ def read_data(filename, sparsify=False, skip_exprs=False):
     return mat, obs, var, uns
 
 
-def read_real_with_genes(filename, batch=True):
+def read_gene_names(filename, h5ad=False):
+    if h5ad:
+        adata = anndata.read_h5ad(data_file(filename, h5ad=True), backed="r")
+        gene_name = np.array(list(adata.var_names))
+        adata.file.close()
+        return gene_name
+    with h5py.File(data_file(filename), "r") as f:
+        return np.array(list(utils.decode(f["var_names"][...])))
+
+
+def class_filter(class_set):
+    if class_set is None:
+        return None
+    return lambda obs: np.isin(np.array(obs["cell_ontology_class"]), class_set)
+
+
+def read_real_with_genes(filename, batch=True, sparse=True, class_set=None, genes=None):
+    # class_set / genes restrict the cells / genes that are read from the store
     # data_path = "/data/public/scrna/data/" + filename + "/data.h5"
-    data_path = "../scrna/data/" + filename + "/data.h5"
-    # data_path = "../scrna/data/" + filename + "/data.h5"
-    mat, obs, var, uns = read_data(data_path, sparsify=False, skip_exprs=False)
-    if isinstance(mat, np.ndarray):
+    data_path = DATA_ROOT + filename + "/data.h5"
+    mat, obs, var, uns = read_data(data_path, sparsify=sparse, skip_exprs=False, obs_filter=class_filter(class_set),
+                                   genes=genes)
+    if sparse:
+        X = sp.sparse.csr_matrix(mat)
+    elif isinstance(mat, np.ndarray):
         X = np.array(mat)
     else:
         X = np.array(mat.toarray())
@@ -76,13 +156,28 @@ def read_real_with_genes(filename, batch=True):
         return X, cell_name, gene_name
 
 
-def read_real_with_genes_new(filename, batch=False):
-    data_path = "../scrna/data/" + filename + "/data.h5ad"
-    adata = anndata.read_h5ad(data_path)
-    mat = adata.X
-    obs = adata.obs
-    var = adata.var
-    if isinstance(mat, np.ndarray):
+def read_real_with_genes_new(filename, batch=False, sparse=True, class_set=None, genes=None):
+    data_path = DATA_ROOT + filename + "/data.h5ad"
+    if class_set is None and genes is None:
+        adata = anndata.read_h5ad(data_path)
+        mat = adata.X
+        obs = adata.obs
+        var = adata.var
+    else:
+        # backed mode only reads obs/var up front, X is then read for the selected rows only
+        adata = anndata.read_h5ad(data_path, backed="r")
+        rows = np.arange(adata.n_obs) if class_set is None else np.where(class_filter(class_set)(adata.obs))[0]
+        mat = adata.X[rows]
+        obs = adata.obs.iloc[rows]
+        var = adata.var
+        if genes is not None:
+            cols = gene_positions(var.index, genes)
+            mat = mat[:, cols]
+            var = var.iloc[cols]
+        adata.file.close()
+    if sparse:
+        X = sp.sparse.csr_matrix(mat)
+    elif isinstance(mat, np.ndarray):
         X = np.array(mat)
     else:
         X = np.array(mat.toarray())
@@ -174,13 +269,36 @@ def class_splitting_single(dataname):
     return class_set
 
 
-def normalize(adata, highly_genes = None, size_factors=True, normalize_input=True, logtrans_input=True):
+def sparse_mean_std(X):
+    # column statistics as used by sc.pp.scale (unbiased variance, zero std -> 1e-12)
+    mean = np.asarray(X.mean(axis=0), dtype=np.float64).ravel()
+    mean_sq = np.asarray(X.multiply(X).mean(axis=0), dtype=np.float64).ravel()
+    var = (mean_sq - mean ** 2) * (X.shape[0] / max(X.shape[0] - 1, 1))
+    std = np.sqrt(np.maximum(var, 0))
+    std[std == 0] = 1e-12
+    return mean, std
+
+
+def get_scaler(adata):
+    # (mean, std) to apply per minibatch when normalize() was run with lazy_scale, otherwise None
+    if not adata.uns.get("lazy_scale", False):
+        return None
+    return np.array(adata.var["mean"], dtype=np.float32), np.array(adata.var["std"], dtype=np.float32)
+
+
+def normalize(adata, highly_genes = None, size_factors=True, normalize_input=True, logtrans_input=True, lazy_scale=False,
+              keep_raw=True):
+    # lazy_scale: keep a sparse adata.X sparse and only record the scaling statistics in adata.var["mean"/"std"],
+    # the centering is then done per minibatch by dataset.CellDataset
+    # keep_raw=False skips the adata.raw copy of the filtered counts
+
     sc.pp.filter_genes(adata, min_counts=10)
     sc.pp.filter_cells(adata, min_counts=1)
-    if size_factors or normalize_input or logtrans_input:
-        adata.raw = adata.copy()
-    else:
-        adata.raw = adata
+    if keep_raw:
+        if size_factors or normalize_input or logtrans_input:
+            adata.raw = adata.copy()
+        else:
+            adata.raw = adata
 
     if size_factors:
         sc.pp.normalize_per_cell(adata)
@@ -196,7 +314,456 @@ def normalize(adata, highly_genes = None, size_factors=True, normalize_input=Tru
     # sc.pp.highly_variable_genes(adata, min_mean=0.0125, max_mean=3, min_disp=0.5, subset=True)
 
     if normalize_input:
-        sc.pp.scale(adata)
+        if lazy_scale and sp.sparse.issparse(adata.X):
+            adata.var["mean"], adata.var["std"] = sparse_mean_std(adata.X)
+            adata.uns["lazy_scale"] = True
+        else:
+            sc.pp.scale(adata)
 
     return adata
 
+
+class RunningMoments(object):
+    # per-column mean / unbiased variance merged chunk by chunk (Chan et al. form of Welford's update)
+    def __init__(self, n_cols):
+        self.n = 0
+        self.mean = np.zeros(n_cols)
+        self.m2 = np.zeros(n_cols)
+
+    def update(self, chunk):
+        n_b = chunk.shape[0]
+        if n_b == 0:
+            return
+        mean_b = np.asarray(chunk.mean(axis=0), dtype=np.float64).ravel()
+        if sp.sparse.issparse(chunk):
+            m2_b = np.asarray(chunk.multiply(chunk).sum(axis=0), dtype=np.float64).ravel() - n_b * mean_b ** 2
+        else:
+            m2_b = ((chunk - mean_b) ** 2).sum(axis=0)
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta * n_b / n
+        self.m2 = self.m2 + m2_b + delta ** 2 * self.n * n_b / n
+        self.n = n
+
+    @property
+    def var(self):
+        return self.m2 / max(self.n - 1, 1)
+
+
+def seurat_hvg(mean, var, n_top_genes, n_bins=20):
+    # sc.pp.highly_variable_genes(flavor="seurat", n_top_genes=...) from the per-gene mean/variance of expm1(X)
+    mean = mean.copy()
+    mean[mean == 0] = 1e-12
+    dispersion = var / mean
+    dispersion[dispersion == 0] = np.nan
+    dispersion = np.log(dispersion)
+    mean = np.log1p(mean)
+    df = pd.DataFrame({"means": mean, "dispersions": dispersion})
+    df["mean_bin"] = pd.cut(df["means"], bins=n_bins)
+    disp_grouped = df.groupby("mean_bin")["dispersions"]
+    disp_mean_bin = disp_grouped.mean()
+    disp_std_bin = disp_grouped.std(ddof=1)
+    one_gene_per_bin = disp_std_bin.isnull()
+    disp_std_bin[one_gene_per_bin.values] = disp_mean_bin[one_gene_per_bin.values].values
+    disp_mean_bin[one_gene_per_bin.values] = 0
+    dispersion_norm = (df["dispersions"].values - disp_mean_bin[df["mean_bin"].values].values) \
+                      / disp_std_bin[df["mean_bin"].values].values
+    ranked = np.sort(dispersion_norm[~np.isnan(dispersion_norm)].astype(np.float32))[::-1]
+    cut_off = ranked[min(n_top_genes, len(ranked)) - 1]
+    return np.nan_to_num(dispersion_norm) >= cut_off
+
+
+class RowChunkReader(object):
+    """
+    Row-chunked access to one h5/h5ad store, restricted to the cells of class_set and to genes.
+    Only obs/var are read up front, the expression matrix is read chunk by chunk.
+    """
+    def __init__(self, filename, h5ad=False, class_set=None, genes=None):
+        self.h5ad = h5ad
+        self.path = data_file(filename, h5ad=h5ad)
+        if h5ad:
+            adata = anndata.read_h5ad(self.path, backed="r")
+            obs, var_names = adata.obs, np.array(list(adata.var_names))
+            adata.file.close()
+        else:
+            with h5py.File(self.path, "r") as f:
+                obs = pd.DataFrame(dict_from_group(f["obs"]), index=utils.decode(f["obs_names"][...]))
+                var_names = np.array(list(utils.decode(f["var_names"][...])))
+        self.rows = np.arange(obs.shape[0]) if class_set is None else np.where(class_filter(class_set)(obs))[0]
+        self.cols = None if genes is None else gene_positions(var_names, genes)
+        cell_name = np.array(obs["cell_ontology_class"])[self.rows]
+        cell_name[cell_name == ""] = "unknown_class"
+        self.cell_name = cell_name
+        self.gene_name = var_names if self.cols is None else var_names[self.cols]
+        self.shape = (len(self.rows), len(self.gene_name))
+
+    def chunks(self, chunk_size):
+        if self.h5ad:
+            handle = anndata.read_h5ad(self.path, backed="r")
+            exprs = handle.X
+        else:
+            handle = h5py.File(self.path, "r")
+            exprs = handle["exprs"]
+        try:
+            for start in range(0, len(self.rows), chunk_size):
+                rows = self.rows[start:start + chunk_size]
+                if isinstance(exprs, h5py.Group):
+                    chunk = _read_csr_rows(exprs, rows, self.cols)
+                else:
+                    chunk = sp.sparse.csr_matrix(exprs[rows])
+                    if self.cols is not None:
+                        chunk = chunk[:, self.cols]
+                yield chunk
+        finally:
+            if self.h5ad:
+                handle.file.close()
+            else:
+                handle.close()
+
+
+class ChainedReader(object):
+    # row-wise concatenation of readers sharing the same genes
+    def __init__(self, readers):
+        self.readers = readers
+        self.cell_name = np.concatenate([reader.cell_name for reader in readers])
+        self.gene_name = readers[0].gene_name
+        assert all(np.array_equal(reader.gene_name, self.gene_name) for reader in readers)
+        self.shape = (len(self.cell_name), len(self.gene_name))
+        self.cell_number_list = [int(n) for n in np.cumsum([reader.shape[0] for reader in readers])]
+
+    def chunks(self, chunk_size):
+        for reader in self.readers:
+            for chunk in reader.chunks(chunk_size):
+                yield chunk
+
+
+def normalize_chunked(reader, path, highly_genes=None, size_factors=True, normalize_input=True, logtrans_input=True,
+                      lazy_scale=True, chunk_size=10000, min_gene_counts=10, min_cell_counts=1, meta=None):
+    """
+    Out-of-core version of read -> normalize() -> HVG count slicing. Gene/cell totals, size factors,
+    HVG and scaling statistics are computed in passes over row chunks of `reader`, then the HVG matrices
+    are written chunk by chunk into the cache entry `path` (load with data_cache.load_arrays). Memory is
+    bounded by the chunk size and a few per-gene vectors.
+    """
+    n_obs, n_vars = reader.shape
+
+    # pass 1: sc.pp.filter_genes(min_counts)
+    gene_counts = np.zeros(n_vars)
+    for chunk in reader.chunks(chunk_size):
+        gene_counts += np.asarray(chunk.sum(axis=0)).ravel()
+    gene_mask = gene_counts >= min_gene_counts
+
+    # pass 2: sc.pp.filter_cells(min_counts) and the counts of normalize_per_cell
+    n_counts = np.zeros(n_obs)
+    start = 0
+    for chunk in reader.chunks(chunk_size):
+        n_counts[start:start + chunk.shape[0]] = np.asarray(chunk[:, gene_mask].sum(axis=1)).ravel()
+        start += chunk.shape[0]
+    cell_mask = n_counts >= min_cell_counts
+    cell_index = np.where(cell_mask)[0]
+    median = np.median(n_counts[cell_mask]) if size_factors else 1.0
+
+    def kept_chunks():
+        # (raw counts, transformed) of the kept cells and genes; both share the same sparsity structure
+        start = 0
+        for chunk in reader.chunks(chunk_size):
+            keep = cell_mask[start:start + chunk.shape[0]]
+            counts = n_counts[start:start + chunk.shape[0]][keep]
+            start += chunk.shape[0]
+            raw = sp.sparse.csr_matrix(chunk[keep][:, gene_mask])
+            raw.eliminate_zeros()
+            transformed = raw.astype(np.float64)
+            if size_factors:
+                transformed.data *= np.repeat(median / counts, np.diff(transformed.indptr))
+            if logtrans_input:
+                transformed.data = np.log1p(transformed.data)
+            yield raw, transformed
+
+    # pass 3: per-gene moments of expm1(X) for the seurat HVG flavour and of X for scaling
+    hvg_moments = RunningMoments(int(gene_mask.sum()))
+    scale_moments = RunningMoments(int(gene_mask.sum()))
+    gene_nnz = np.zeros(int(gene_mask.sum()), dtype=np.int64)
+    max_count = 0
+    for raw, transformed in kept_chunks():
+        hvg_moments.update(transformed.expm1())
+        scale_moments.update(transformed)
+        gene_nnz += raw.getnnz(axis=0)
+        if raw.nnz:
+            max_count = max(max_count, raw.data.max())
+    if highly_genes != None:
+        hvg = seurat_hvg(hvg_moments.mean, hvg_moments.var, highly_genes)
+    else:
+        hvg = np.ones(int(gene_mask.sum()), dtype=bool)
+    hvg_index = np.where(hvg)[0]
+    mean = scale_moments.mean[hvg]
+    std = np.sqrt(np.maximum(scale_moments.var[hvg], 0))
+    std[std == 0] = 1e-12
+
+    # pass 4: write the HVG matrices
+    shape = (len(cell_index), len(hvg_index))
+    nnz = int(gene_nnz[hvg].sum())
+    writer = ArrayWriter(path)
+    count_data, count_indices, count_indptr = writer.csr("count_X", shape, nnz, utils.count_dtype(max_count))
+    dense = normalize_input and not lazy_scale
+    if dense:
+        x_dense = writer.dense("X", shape, np.float32)
+    else:
+        x_data, x_indices, x_indptr = writer.csr("X", shape, nnz, np.float32)
+        x_indptr[0] = 0
+    count_indptr[0] = 0
+    row, pos = 0, 0
+    for raw, transformed in kept_chunks():
+        raw = raw[:, hvg_index]
+        transformed = transformed[:, hvg_index]
+        n, chunk_nnz = raw.shape[0], raw.nnz
+        count_data[pos:pos + chunk_nnz] = raw.data
+        count_indices[pos:pos + chunk_nnz] = raw.indices
+        count_indptr[row + 1:row + n + 1] = pos + raw.indptr[1:]
+        if dense:
+            x_dense[row:row + n] = ((transformed.toarray() - mean) / std).astype(np.float32)
+        else:
+            x_data[pos:pos + chunk_nnz] = transformed.data
+            x_indices[pos:pos + chunk_nnz] = transformed.indices
+            x_indptr[row + 1:row + n + 1] = pos + transformed.indptr[1:]
+        row += n
+        pos += chunk_nnz
+    assert row == shape[0] and pos == nnz
+
+    if size_factors:
+        size_factor = (n_counts[cell_mask] / median).reshape(-1, 1).astype(np.float32)
+    else:
+        size_factor = np.ones((len(cell_index), 1), dtype=np.float32)
+    writer.save("size_factor", size_factor)
+    writer.save("cell_name", reader.cell_name[cell_index])
+    writer.save("gene_name", reader.gene_name[np.where(gene_mask)[0][hvg_index]])
+    writer.save("cell_index", cell_index)
+    if normalize_input and lazy_scale:
+        writer.save("scaler_mean", mean.astype(np.float32))
+        writer.save("scaler_std", std.astype(np.float32))
+    meta = dict(meta if meta is not None else {})
+    if hasattr(reader, "cell_number_list"):
+        meta["cell_number_list"] = [int(np.sum(cell_index < n)) for n in reader.cell_number_list]
+    print("after preprocessing, the cell number is {} and the gene dimension is {}".format(shape[0], shape[1]))
+    writer.close(meta)
+
+
+def data_file(filename, h5ad=False):
+    return DATA_ROOT + filename + ("/data.h5ad" if h5ad else "/data.h5")
+
+
+def _finish_preprocessing(adata, count_X, highly_genes, size_factors, normalize_input, logtrans_input, lazy_scale):
+    # positions into count_X, carried through the cell/gene filtering and the HVG subsetting
+    adata.obs["cell_index"] = np.arange(adata.n_obs)
+    adata.var["gene_index"] = np.arange(adata.n_vars)
+    adata = normalize(adata, highly_genes=highly_genes, size_factors=size_factors, normalize_input=normalize_input,
+                      logtrans_input=logtrans_input, lazy_scale=lazy_scale, keep_raw=False)
+    X = adata.X.astype(np.float32)
+    scaler = get_scaler(adata)
+    cell_name = np.array(adata.obs["cellname"])
+    gene_name = np.array(adata.var.index)
+    print("after preprocessing, the cell number is {} and the gene dimension is {}".format(len(cell_name), X.shape[1]))
+
+    count_X = count_X[np.array(adata.obs["cell_index"])]
+    count_X = count_X[:, np.array(adata.var["gene_index"])]
+    assert X.shape == count_X.shape
+    count_X = utils.compact_counts(count_X)
+    size_factor = np.array(adata.obs.size_factors).reshape(-1, 1).astype(np.float32)
+    arrays = {"X": X, "count_X": count_X, "cell_name": cell_name, "gene_name": gene_name, "size_factor": size_factor,
+              "cell_index": np.array(adata.obs["cell_index"])}
+    if scaler is not None:
+        arrays["scaler_mean"], arrays["scaler_std"] = scaler
+    return arrays
+
+
+def _unpack(arrays):
+    scaler = None
+    if "scaler_mean" in arrays:
+        scaler = (arrays["scaler_mean"], arrays["scaler_std"])
+    return arrays["X"], arrays["count_X"], arrays["cell_name"], arrays["gene_name"], arrays["size_factor"], scaler
+
+
+def load_single_data(filename, highly_genes=None, size_factors=True, normalize_input=True, logtrans_input=True,
+                     lazy_scale=True, cache_dir=None, chunk_size=None):
+    """
+    Read, class-filter and normalize one dataset of the "single" series. The result is cached in
+    cache_dir, keyed by the data file content and the preprocessing configuration. With chunk_size
+    the out-of-core normalize_chunked is used instead of scanpy.
+    # Return
+        X, count_X, cell_name, gene_name, size_factor, scaler
+    """
+    class_set = class_splitting_single(filename)
+    config = {"kind": "single", "files": [file_digest(data_file(filename), cache_dir)] if cache_dir else [],
+              "class_set": class_set, "highly_genes": highly_genes, "size_factors": size_factors,
+              "normalize_input": normalize_input, "logtrans_input": logtrans_input, "lazy_scale": lazy_scale,
+              "counts": "compact"}
+
+    def build():
+        X, cell_name, gene_name = read_real_with_genes(filename, batch=False, class_set=class_set)
+        count_X = utils.compact_counts(X)
+        adata = sc.AnnData(X, var=pd.DataFrame(index=list(gene_name)))
+        adata.obs["cellname"] = cell_name
+        return _finish_preprocessing(adata, count_X, highly_genes, size_factors, normalize_input, logtrans_input,
+                                     lazy_scale), {}
+
+    if chunk_size:
+        if not cache_dir:
+            raise ValueError("chunked preprocessing writes its result into cache_dir")
+        config["chunked"] = True
+
+        def write(path, config):
+            reader = RowChunkReader(filename, class_set=class_set)
+            normalize_chunked(reader, path, highly_genes=highly_genes, size_factors=size_factors,
+                              normalize_input=normalize_input, logtrans_input=logtrans_input, lazy_scale=lazy_scale,
+                              chunk_size=chunk_size, meta={"config": config})
+
+        arrays, _ = cached_store(config, write, cache_dir)
+    else:
+        arrays, _ = cached_arrays(config, build, cache_dir)
+    return _unpack(arrays)
+
+
+def common_genes(datanames, cache_dir=None):
+    """
+    GeneRegistry of the genes shared by all datasets, in the order anndata.concat(join="inner") gives them.
+    With cache_dir the registry is kept on disk, keyed by the data file contents.
+    """
+    path = None
+    if cache_dir:
+        files = [file_digest(data_file(dataname, h5ad=dataname not in H5_DATANAMES), cache_dir) for dataname in datanames]
+        path = os.path.join(cache_dir, "genes-{}.json".format(config_key({"kind": "common_genes", "files": files})))
+        if os.path.exists(path):
+            return GeneRegistry.load(path)
+    registry = GeneRegistry.intersection([read_gene_names(dataname, h5ad=dataname not in H5_DATANAMES)
+                                          for dataname in datanames])
+    if path is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        registry.save(path)
+    return registry
+
+
+def read_real_dataset(dataname, class_set=None, genes=None):
+    if dataname in H5_DATANAMES:
+        return read_real_with_genes(dataname, batch=False, class_set=class_set, genes=genes)
+    return read_real_with_genes_new(dataname, batch=False, class_set=class_set, genes=genes)
+
+
+def _read_real_dataset_shared(dataname, class_set, genes):
+    # process pool worker: the CSR buffers go back through shared memory blocks, only their names are pickled
+    from multiprocessing import shared_memory, resource_tracker
+    X, cell_name, gene_name = read_real_dataset(dataname, class_set=class_set, genes=genes)
+    X = sp.sparse.csr_matrix(X)
+    blocks = []
+    for arr in (X.data, X.indices, X.indptr):
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        blocks.append((shm.name, arr.shape, arr.dtype.str))
+        shm.close()
+        # the parent process owns (and unlinks) the block from now on
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return blocks, X.shape, cell_name, gene_name
+
+
+def read_real_datasets(datanames, class_set_list, genes=None, workers=1):
+    """
+    Read and class-filter several datasets of the "real" series, in a pool of `workers` processes when
+    workers > 1. Each worker returns its expression matrix through shared memory.
+    # Return
+        list of (X, cell_name, gene_name) and the list of shared memory blocks backing the matrices,
+        to be released with release_shared() once the matrices are no longer referenced
+    """
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:  # python < 3.8
+        workers = 1
+    if workers <= 1 or len(datanames) == 1:
+        return [read_real_dataset(dataname, class_set=class_set, genes=genes)
+                for dataname, class_set in zip(datanames, class_set_list)], []
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(datanames))) as pool:
+        futures = [pool.submit(_read_real_dataset_shared, dataname, class_set, genes)
+                   for dataname, class_set in zip(datanames, class_set_list)]
+        results = [future.result() for future in futures]
+    datasets, shms = [], []
+    for blocks, shape, cell_name, gene_name in results:
+        buffers = []
+        for name, block_shape, dtype in blocks:
+            shm = shared_memory.SharedMemory(name=name)
+            shms.append(shm)
+            buffers.append(np.ndarray(block_shape, dtype=np.dtype(dtype), buffer=shm.buf))
+        X = sp.sparse.csr_matrix(tuple(buffers), shape=shape, copy=False)
+        datasets.append((X, cell_name, gene_name))
+    return datasets, shms
+
+
+def release_shared(shms):
+    gc.collect()  # AnnData objects holding views of the blocks may sit in reference cycles
+    for shm in shms:
+        try:
+            shm.close()
+        except BufferError:  # still referenced, the mapping goes away with the last reference
+            pass
+        shm.unlink()
+
+
+def load_real_data(datanames, highly_genes=None, size_factors=True, normalize_input=True, logtrans_input=True,
+                   lazy_scale=True, join="inner", cache_dir=None, chunk_size=None, workers=1):
+    """
+    Read, class-filter, concatenate (on the common genes) and normalize the datasets of the "real" series.
+    The result is cached in cache_dir, keyed by the data file contents and the preprocessing configuration.
+    With chunk_size the out-of-core normalize_chunked is used instead of scanpy (inner join only).
+    With workers > 1 the datasets are read in parallel processes (see read_real_datasets).
+    # Return
+        X, count_X, cell_name, gene_name, size_factor, scaler, cell_number_list, class_set_list
+    """
+    class_set_list = [class_splitting_single(dataname) for dataname in datanames]
+    files = [data_file(dataname, h5ad=dataname not in H5_DATANAMES) for dataname in datanames]
+    config = {"kind": "real", "files": [file_digest(f, cache_dir) for f in files] if cache_dir else [],
+              "class_set": class_set_list, "highly_genes": highly_genes, "size_factors": size_factors,
+              "normalize_input": normalize_input, "logtrans_input": logtrans_input, "lazy_scale": lazy_scale,
+              "counts": "compact", "join": join}
+
+    def build():
+        # only the genes shared by all datasets are read
+        genes = common_genes(datanames, cache_dir) if join == "inner" else None
+        datasets, shms = read_real_datasets(datanames, class_set_list, genes=genes, workers=workers)
+        try:
+            adatas = []
+            cell_number_list = []
+            for dataname, (X1, cell_name1, gene_name1) in zip(datanames, datasets):
+                print("for {} dataset, its cell number is {} and gene number is {}".format(dataname, X1.shape[0],
+                                                                                           len(gene_name1)))
+                adata1 = anndata.AnnData(X1, var=pd.DataFrame(index=list(gene_name1)))
+                adata1.obs["cellname"] = cell_name1
+                adatas.append(adata1)
+                cell_number_list.append(X1.shape[0] + (cell_number_list[-1] if cell_number_list else 0))
+
+            adata = anndata.concat(adatas, join=join)
+            del datasets, adatas, adata1, X1
+        finally:
+            release_shared(shms)
+        count_X = utils.compact_counts(adata.X)
+        print("for mixed dataset, its cell number is {} and gene number is {}".format(count_X.shape[0], count_X.shape[1]))
+        arrays = _finish_preprocessing(adata, count_X, highly_genes, size_factors, normalize_input, logtrans_input, lazy_scale)
+        # dataset boundaries after the cells removed by sc.pp.filter_cells
+        cell_number_list = [int(np.sum(arrays["cell_index"] < n)) for n in cell_number_list]
+        return arrays, {"cell_number_list": cell_number_list}
+
+    if chunk_size:
+        if not cache_dir or join != "inner":
+            raise ValueError("chunked preprocessing needs a cache_dir and join='inner'")
+        config["chunked"] = True
+
+        def write(path, config):
+            genes = common_genes(datanames, cache_dir)
+            reader = ChainedReader([RowChunkReader(dataname, h5ad=dataname not in H5_DATANAMES, class_set=class_set,
+                                                   genes=genes)
+                                    for dataname, class_set in zip(datanames, class_set_list)])
+            normalize_chunked(reader, path, highly_genes=highly_genes, size_factors=size_factors,
+                              normalize_input=normalize_input, logtrans_input=logtrans_input, lazy_scale=lazy_scale,
+                              chunk_size=chunk_size, meta={"config": config})
+
+        arrays, meta = cached_store(config, write, cache_dir)
+    else:
+        arrays, meta = cached_arrays(config, build, cache_dir)
+    return _unpack(arrays) + (meta["cell_number_list"], class_set_list)
@@ -0,0 +1,94 @@
+import os
+import sys
+import runpy
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+STRATEGIES = ("indi", "join", "play", "prca", "punif")
+
+
+def script_option(script_args, name):
+    # value of `name` among the script arguments, None if absent
+    for i, arg in enumerate(script_args):
+        if arg == name and i + 1 < len(script_args):
+            return script_args[i + 1]
+        if arg.startswith(name + "="):
+            return arg.split("=", 1)[1]
+    return None
+
+
+def run_script(script, script_args, log_path=None):
+    """
+    Run a training script in this process as `python script script_args...` would, its output going to
+    log_path if given.
+    # Return
+        the script's final result_list as a DataFrame (one row per stage or per dataset order)
+    """
+    argv, stdout, stderr = sys.argv, sys.stdout, sys.stderr
+    log = open(log_path, "w", buffering=1) if log_path else None
+    sys.argv = [script] + list(script_args)
+    if log is not None:
+        sys.stdout = sys.stderr = log
+    try:
+        result_list = runpy.run_path(script, run_name="__main__")["result_list"]
+    finally:
+        sys.argv, sys.stdout, sys.stderr = argv, stdout, stderr
+        if log is not None:
+            log.close()
+    return pd.DataFrame(result_list)
+
+
+def _run_strategy(job):
+    strategy, script, script_args, log_path = job
+    return strategy, run_script(script, script_args, log_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='run several incremental strategies on the same data and pretraining',
+                                     epilog='arguments after "--" are passed to every training script')
+    parser.add_argument('--series', type=str, default='single', choices=['single', 'real'])
+    parser.add_argument('--strategies', type=str, nargs='+', default=list(STRATEGIES), choices=STRATEGIES)
+    parser.add_argument('--workers', type=int, default=0,
+                        help='worker processes, 0 to run the strategies one after the other in this process')
+    parser.add_argument('--encoder-cache', type=str, default='cache/encoders',
+                        help='pretrained encoder cache shared by the strategies, unless given to the scripts')
+    parser.add_argument('--cache-dir', type=str, default='cache',
+                        help='preprocessed data cache shared by the strategies, unless given to the scripts')
+    parser.add_argument('--log-dir', type=str, default='logs')
+    parser.add_argument('--output', type=str, default='',
+                        help='csv file for the results of all strategies')
+    args, script_args = parser.parse_known_args()
+    script_args = [a for a in script_args if a != '--']
+    if script_option(script_args, '--encoder-cache') is None:
+        script_args += ['--encoder-cache', args.encoder_cache]
+    if script_option(script_args, '--cache-dir') is None:
+        script_args += ['--cache-dir', args.cache_dir]
+
+    jobs = []
+    for strategy in args.strategies:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "train_{}_incle_{}.py".format(args.series, strategy))
+        log_path = os.path.join(args.log_dir, "{}_{}.log".format(args.series, strategy)) if args.workers > 0 else None
+        jobs.append((strategy, script, script_args, log_path))
+
+    # In one process the preprocessed data is loaded once (data_cache keeps it) and the first strategy
+    # pretrains the encoder the others start from. Worker processes map the same data cache files and
+    # wait on the encoder cache entry while one of them pretrains.
+    if args.workers > 0:
+        os.makedirs(args.log_dir, exist_ok=True)
+        # executor workers are not daemonic, the scripts may start their own loader processes
+        with ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = list(pool.map(_run_strategy, jobs))
+    else:
+        results = [_run_strategy(job) for job in jobs]
+
+    tables = []
+    for strategy, result in results:
+        result.insert(0, "strategy", strategy)
+        tables.append(result)
+    table = pd.concat(tables, ignore_index=True)
+    print(table.to_string())
+    if args.output:
+        table.to_csv(args.output)
@@ -288,6 +288,152 @@ def densify(arr):
     return arr
 
 
+class RowView(object):
+    """
+    Rows `rows` of a base matrix (numpy array or scipy sparse matrix) without copying them. Indexing a view
+    gives another view of the same base, the rows are only gathered by take() or dataset.dense_rows.
+    """
+    def __init__(self, base, rows):
+        if isinstance(base, RowView):
+            base, rows = base.base, base.rows[rows]
+        self.base = base
+        self.rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+
+    @property
+    def shape(self):
+        return (len(self.rows),) + tuple(self.base.shape[1:])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return RowView(self.base, self.rows[index])
+
+    def take(self, index=slice(None)):
+        return self.base[self.rows[index]]
+
+
+class GrowableArray(object):
+    """
+    Append-only array with capacity doubling, so appending a stage costs amortized O(its size). `data` is a
+    view of the filled rows and is consumed without copying (np.asarray, torch.from_numpy, CellDataset);
+    views taken before later appends stay valid. The dtype is promoted if an append needs it (e.g. longer
+    strings).
+    """
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.size = 0
+        self._data = None
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, size, dtype):
+        if self._data is not None and size <= len(self._data) and dtype == self._data.dtype:
+            return
+        capacity = self.capacity if self._data is None else len(self._data)
+        while capacity < size:
+            capacity *= 2
+        data = np.empty((capacity,) + self.row_shape, dtype=dtype)
+        if self._data is not None:
+            data[:self.size] = self._data[:self.size]
+        self._data = data
+
+    def append(self, arr):
+        arr = np.asarray(arr)
+        if self._data is None:
+            self.row_shape = arr.shape[1:]
+            dtype = arr.dtype
+        else:
+            assert arr.shape[1:] == self.row_shape
+            dtype = np.promote_types(self._data.dtype, arr.dtype)
+        self._reserve(self.size + len(arr), dtype)
+        self._data[self.size:self.size + len(arr)] = arr
+        self.size += len(arr)
+
+    @property
+    def data(self):
+        if self._data is None:
+            return np.empty((0,))
+        return self._data[:self.size]
+
+
+class GrowableRows(object):
+    # GrowableArray of RowView rows, all over the same base matrix
+    def __init__(self, capacity=1024):
+        self.base = None
+        self.rows = GrowableArray(capacity)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, view):
+        assert isinstance(view, RowView)
+        if self.base is None:
+            self.base = view.base
+        assert view.base is self.base
+        self.rows.append(view.rows)
+
+    @property
+    def data(self):
+        return RowView(self.base, self.rows.data)
+
+
+class StageBuffer(object):
+    """
+    Struct of arrays accumulated stage by stage (seen data, replay memory): one GrowableArray per field,
+    or GrowableRows for RowView fields. views(*names) returns the current contents without copying.
+    """
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.columns = collections.OrderedDict()
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def append(self, **fields):
+        for name, arr in fields.items():
+            if name not in self.columns:
+                self.columns[name] = GrowableRows(self.capacity) if isinstance(arr, RowView) \
+                    else GrowableArray(self.capacity)
+            self.columns[name].append(arr)
+        assert len(set(len(column) for column in self.columns.values())) == 1
+
+    def views(self, *names):
+        return tuple(self.columns[name].data for name in names)
+
+
+def concatenate(arrays, axis=0):  # np.concatenate that also stacks scipy sparse rows and row views
+    if all(isinstance(arr, RowView) for arr in arrays) and len(set(id(arr.base) for arr in arrays)) == 1:
+        assert axis == 0
+        return RowView(arrays[0].base, np.concatenate([arr.rows for arr in arrays]))
+    arrays = [arr.take() if isinstance(arr, RowView) else arr for arr in arrays]
+    if any(scipy.sparse.issparse(arr) for arr in arrays):
+        assert axis == 0
+        return scipy.sparse.vstack(arrays, format="csr")
+    return np.concatenate(arrays, axis=axis)
+
+
+def count_dtype(max_count):
+    # narrowest unsigned type holding the raw counts
+    if max_count <= np.iinfo(np.uint16).max:
+        return np.uint16
+    if max_count <= np.iinfo(np.uint32).max:
+        return np.uint32
+    return np.int64
+
+
+def compact_counts(count_X):
+    """
+    Raw count matrix (numpy or scipy sparse) in the narrowest unsigned integer type of its largest entry.
+    Counts stay compact in storage and in the datasets, dataset.widen_counts turns a batch into floats.
+    """
+    data = count_X.data if scipy.sparse.issparse(count_X) else count_X
+    max_count = data.max() if data.size else 0
+    assert data.size == 0 or data.min() >= 0
+    return count_X.astype(count_dtype(max_count))
+
+
 def empty_safe(fn, dtype):
     def _fn(x):
         if x.size:
@@ -0,0 +1,99 @@
+import os
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+from run_strategies import STRATEGIES, run_script, script_option
+
+
+def plan(orders):
+    """
+    Prefix-sharing schedule of dataset orders. The orders are visited in depth-first order of their prefix
+    trie (lexicographic order); each run resumes from the checkpoint of its longest prefix shared with an
+    earlier run, which is trained by the first run having that prefix.
+    # Return
+        list of (order, number of shared stages, index of the run it waits for or None), and the number of
+        distinct prefixes, i.e. of stages actually trained
+    """
+    first_with_prefix = {}
+    runs = []
+    for order in sorted(set(tuple(order) for order in orders)):
+        shared, parent = 0, None
+        for k in range(len(order) - 1, 0, -1):
+            if order[:k] in first_with_prefix:
+                shared, parent = k, first_with_prefix[order[:k]]
+                break
+        for k in range(1, len(order) + 1):
+            first_with_prefix.setdefault(order[:k], len(runs))
+        runs.append((list(order), shared, parent))
+    return runs, len(first_with_prefix)
+
+
+def _run_order(job):
+    index, script, script_args, log_path = job
+    return index, run_script(script, script_args, log_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='train dataset orders of the real series, sharing common stage prefixes',
+                                     epilog='arguments after "--" are passed to the training script')
+    parser.add_argument('--strategy', type=str, default='prca', choices=STRATEGIES)
+    parser.add_argument('--datasets', type=str, nargs='+', default=[],
+                        help='train all the orders of these datasets')
+    parser.add_argument('--order', type=str, nargs='+', action='append', default=[],
+                        help='dataset order to train (repeatable)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='worker processes, 0 to train the orders one after the other in this process')
+    parser.add_argument('--checkpoint-dir', type=str, default='checkpoints',
+                        help='stage checkpoints, unless given to the script')
+    parser.add_argument('--log-dir', type=str, default='logs')
+    parser.add_argument('--output', type=str, default='',
+                        help='csv file for the results of all orders')
+    args, script_args = parser.parse_known_args()
+    script_args = [a for a in script_args if a != '--']
+    if script_option(script_args, '--checkpoint-dir') is None:
+        script_args += ['--checkpoint-dir', args.checkpoint_dir]
+    if '--resume' not in script_args:
+        script_args.append('--resume')
+
+    orders = [list(order) for order in itertools.permutations(args.datasets)] + args.order
+    if not orders:
+        parser.error("give --datasets or --order")
+    runs, trained = plan(orders)
+    print("{} orders, {} stages to train instead of {}".format(len(runs), trained, sum(len(r[0]) for r in runs)))
+    for order, shared, parent in runs:
+        print("{} shares {} stages with run {}".format(order, shared, parent))
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "train_real_incle_{}.py".format(args.strategy))
+    jobs = []
+    for index, (order, _, _) in enumerate(runs):
+        log_path = None
+        if args.workers > 0:
+            log_path = os.path.join(args.log_dir, "{}_{}.log".format(args.strategy, "-".join(order)))
+        jobs.append((index, script, script_args + ['--order'] + order, log_path))
+
+    results = {}
+    if args.workers > 0:
+        # a run starts once the run training its shared prefix has finished
+        os.makedirs(args.log_dir, exist_ok=True)
+        with ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            pending, running = list(range(len(runs))), set()
+            while pending or running:
+                for index in [i for i in pending if runs[i][2] is None or runs[i][2] in results]:
+                    pending.remove(index)
+                    running.add(pool.submit(_run_order, jobs[index]))
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, result = future.result()
+                    results[index] = result
+    else:
+        # depth-first, so every prefix is checkpointed before the runs branching from it
+        for job in jobs:
+            index, result = _run_order(job)
+            results[index] = result
+
+    table = pd.concat([results[index] for index in range(len(runs))], ignore_index=True)
+    print(table.to_string())
+    if args.output:
+        table.to_csv(args.output)
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+
+def stage_class_sets(class_set, stage_number):
+    # consecutive slices of class_set, the last stage takes the remainder
+    step = len(class_set) // stage_number
+    return [class_set[step * i:step * (i + 1)] if i != stage_number - 1 else class_set[step * i:]
+            for i in range(stage_number)]
+
+
+def _labeled_mask(n, labeled_ratio, random_seed):
+    # the same draws as np.random.seed(random_seed) followed by n calls of np.random.rand()
+    return np.random.RandomState(random_seed).random_sample(n) < labeled_ratio
+
+
+def single_stage_split(cellname, class_set, stage_number, labeled_ratio=0.5, random_seed=8888):
+    """
+    Class-incremental train/test split of one dataset in a single vectorized pass per stage. A stage holds the
+    cells of its slice of class_set, the cells of a stage are labeled (train) with probability labeled_ratio
+    using the draws of a RandomState seeded with random_seed, in cell order, as the original per-cell loop did.
+    # Return
+        list of (train_index, test_index, train_Y, test_Y) per stage; indexes are rows of cellname and
+        Y is the position of the cell type in class_set
+    """
+    class_index = pd.Index(class_set)
+    assert class_index.is_unique
+    codes = class_index.get_indexer(np.asarray(cellname, dtype=object)).astype(np.int64)
+    step = len(class_set) // stage_number
+    splits = []
+    for i in range(stage_number):
+        low, high = step * i, (step * (i + 1) if i != stage_number - 1 else len(class_set))
+        index = np.where((codes >= low) & (codes < high))[0]
+        labeled = _labeled_mask(len(index), labeled_ratio, random_seed)
+        train_index, test_index = index[labeled], index[~labeled]
+        splits.append((train_index, test_index, codes[train_index], codes[test_index]))
+    return splits
+
+
+def real_stage_split(cellname, cell_number_list, class_set_list, labeled_ratio=0.5, random_seed=8888):
+    """
+    Train/test split of concatenated datasets, one dataset per stage (rows up to cell_number_list[i]).
+    Every cell of a dataset is labeled with probability labeled_ratio, the draws restart from random_seed
+    for each dataset. Cell types are numbered in order of first appearance over class_set_list.
+    # Return
+        list of (train_index, test_index, train_Y, test_Y) per stage with indexes into the rows of cellname,
+        and the list of cell types (unique_class_set_list)
+    """
+    unique_class_set_list = list(pd.unique(np.concatenate([np.asarray(class_set, dtype=object)
+                                                           for class_set in class_set_list])))
+    class_index = pd.Index(unique_class_set_list)
+    cellname = np.asarray(cellname, dtype=object)
+    splits = []
+    for i, class_set in enumerate(class_set_list):
+        start = cell_number_list[i - 1] if i > 0 else 0
+        names = cellname[start:cell_number_list[i]]
+        # cells outside the class set of their dataset keep label 0
+        Y = np.where(np.isin(names, np.asarray(class_set, dtype=object)),
+                     class_index.get_indexer(names), 0).astype(np.int64)
+        labeled = _labeled_mask(len(names), labeled_ratio, random_seed)
+        train_local, test_local = np.where(labeled)[0], np.where(~labeled)[0]
+        splits.append((start + train_local, start + test_local, Y[train_local], Y[test_local]))
+    return splits, unique_class_set_list
+
+
+def dataset_order(cell_number_list, class_set_list, datanames, order):
+    """
+    Present concatenated datasets, loaded in the order `datanames`, in the order `order` (the same names
+    permuted), so that all orders of the same datasets share one preprocessed matrix and gene space.
+    # Return
+        rows of the loaded cells in the new order, and the cell_number_list and class_set_list of that order
+    """
+    starts = [0] + list(cell_number_list[:-1])
+    positions = [list(datanames).index(name) for name in order]
+    blocks = [np.arange(starts[i], cell_number_list[i]) for i in positions]
+    rows = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.int64)
+    return rows, [int(n) for n in np.cumsum([len(block) for block in blocks])], [class_set_list[i] for i in positions]
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import itertools
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from data_cache import config_key
+from run_strategies import run_script
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def expand_grid(grid, permutations=None):
+    """
+    Configs of the cartesian product of `grid` ({argument name: list of values}), each combined with
+    every order of `permutations` (as an "order" argument) if given.
+    """
+    axes = dict(grid)
+    if permutations:
+        axes["order"] = [list(order) for order in itertools.permutations(permutations)]
+    names = sorted(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*[axes[name] for name in names])]
+
+
+def config_args(config):
+    # command line of a config, list values (e.g. a dataset order) as several arguments
+    args = []
+    for name, value in sorted(config.items()):
+        args.append("--" + name.replace("_", "-"))
+        args.extend([str(v) for v in value] if isinstance(value, (list, tuple)) else [str(value)])
+    return args
+
+
+class ResultStore(object):
+    """
+    Results of a sweep in a sqlite database: the table `runs` has one row per finished config (its key,
+    script, config and arguments as json, and duration); the table `results` has one row per row of the
+    script's result_list, with a column per config argument (json for list values) and the result
+    values in columns r0, r1, ...; columns are added as new arguments appear.
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS runs (key TEXT PRIMARY KEY, script TEXT, config TEXT, "
+                        "args TEXT, seconds REAL, finished TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT, script TEXT, row INTEGER)")
+        self.db.commit()
+
+    def finished(self):
+        return set(key for key, in self.db.execute("SELECT key FROM runs"))
+
+    def _columns(self, names):
+        existing = set(row[1] for row in self.db.execute("PRAGMA table_info(results)"))
+        for name in names:
+            if name not in existing:
+                self.db.execute('ALTER TABLE results ADD COLUMN "{}"'.format(name))
+
+    def add(self, key, script, config, script_args, seconds, result):
+        values = {name: json.dumps(value) if isinstance(value, (list, tuple)) else value
+                  for name, value in config.items()}
+        rows = []
+        for i, row in enumerate(result.values.tolist()):
+            record = dict(values, key=key, script=script, row=i)
+            record.update({"r{}".format(j): value for j, value in enumerate(row)})
+            rows.append(record)
+        names = sorted(set(name for record in rows for name in record))
+        self._columns(names)
+        for record in rows:
+            self.db.execute('INSERT INTO results ({}) VALUES ({})'.format(
+                ", ".join('"{}"'.format(name) for name in record), ", ".join("?" * len(record))),
+                [value if isinstance(value, (int, float, str)) or value is None else str(value)
+                 for value in record.values()])
+        self.db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, script, json.dumps(config, sort_keys=True), json.dumps(script_args), seconds,
+                         time.strftime("%Y-%m-%d %H:%M:%S")))
+        self.db.commit()
+
+    def table(self, query="SELECT * FROM results"):
+        return pd.read_sql_query(query, self.db)
+
+
+# cores of the idle slots, shared by the worker processes
+_slots = None
+
+
+def _init_worker(slots):
+    global _slots
+    _slots = slots
+
+
+def _pin(cores):
+    # the run takes its own cores; the intra-op threads of torch match them (the BLAS thread counts are set
+    # in the environment the workers start with, see main)
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    import torch
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+
+
+def _run_job(job):
+    key, script, config, script_args, log_path = job
+    cores = _slots.get()
+    start = time.time()
+    try:
+        _pin(cores)
+        result = run_script(script, script_args, log_path)
+    except BaseException:
+        return key, None, traceback.format_exc(), time.time() - start
+    finally:
+        _slots.put(cores)
+    return key, result, None, time.time() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='parallel sweep of a training script over configs',
+                                     epilog='arguments after "--" are passed to every run')
+    parser.add_argument('--script', type=str, default='train_single_incle_prca.py')
+    parser.add_argument('--grid', type=str, nargs='+', default=[],
+                        help='argument=value1,value2,... axes of the grid, e.g. random_seed=1,2,3 ra=0.3,0.5')
+    parser.add_argument('--permutations', type=str, nargs='+', default=[],
+                        help='also sweep over all orders of these datasets (real series)')
+    parser.add_argument('--configs', type=str, default='',
+                        help='json file with a list of configs ({argument: value}), instead of --grid')
+    parser.add_argument('--threads', type=int, default=2, help='threads per run')
+    parser.add_argument('--jobs', type=int, default=0, help='parallel runs, 0 for cores / threads')
+    parser.add_argument('--results', type=str, default='sweeps/results.sqlite')
+    parser.add_argument('--log-dir', type=str, default='sweeps/logs')
+    args, script_args = parser.parse_known_args()
+    script_args = [a for a in script_args if a != '--']
+
+    if args.configs:
+        with open(args.configs, "r") as f:
+            configs = json.load(f)
+    else:
+        grid = {}
+        for axis in args.grid:
+            name, values = axis.split("=", 1)
+            grid[name.lstrip("-").replace("-", "_")] = values.split(",")
+        configs = expand_grid(grid, args.permutations)
+
+    store = ResultStore(args.results)
+    finished = store.finished()
+    script = os.path.basename(args.script)
+    jobs = []
+    for config in configs:
+        run_args = script_args + config_args(config)
+        key = config_key({"script": script, "config": config, "args": script_args})
+        if key in finished:
+            continue
+        finished.add(key)
+        log_path = os.path.join(args.log_dir, "{}-{}.log".format(os.path.splitext(script)[0], key[:12]))
+        jobs.append((key, args.script, config, run_args, log_path))
+    print("{} configs, {} finished before, {} to run".format(len(configs), len(configs) - len(jobs), len(jobs)))
+
+    cores = available_cores()
+    threads = max(1, min(args.threads, len(cores)))
+    workers = args.jobs if args.jobs > 0 else max(1, len(cores) // threads)
+    workers = max(1, min(workers, len(jobs)))
+    if jobs:
+        os.makedirs(args.log_dir, exist_ok=True)
+        # read by numpy / torch when they are first imported, i.e. by the spawned workers on start
+        for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+            os.environ[name] = str(threads)
+        context = multiprocessing.get_context("spawn")
+        slots = context.Queue()
+        for i in range(workers):
+            slots.put([cores[(i * threads + j) % len(cores)] for j in range(threads)])
+        configs_by_key = {job[0]: job for job in jobs}
+        # executor workers, unlike multiprocessing.Pool ones, are not daemonic, so a run may start its own
+        # processes (e.g. --load-workers of the real series); from python 3.11 every config also starts in a
+        # fresh interpreter on its cores
+        options = {"max_tasks_per_child": 1} if sys.version_info >= (3, 11) else {}
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(slots,),
+                                 **options) as pool:
+            futures = [pool.submit(_run_job, job) for job in jobs]
+            for future in as_completed(futures):
+                key, result, error, seconds = future.result()
+                _, _, config, run_args, log_path = configs_by_key[key]
+                if error is not None:
+                    print("failed after {:.0f}s: {} (see {})\n{}".format(seconds, config, log_path, error))
+                    continue
+                store.add(key, script, config, script_args, seconds, result)
+                print("finished in {:.0f}s: {}".format(seconds, config))
+
+    print(store.table().to_string())
@@ -7,7 +7,14 @@ import torch.nn.functional as F
 import torch.optim as optim
 from collections import Counter
 from torch.utils.data import DataLoader, TensorDataset, WeightedRandomSampler
-from layers import ZINBLoss, MeanAct, DispAct, GaussianNoise
+from layers import ZINBLoss, ZINBHead, zinb_head_hook, MeanAct, DispAct, PiAct, GaussianNoise, autocast
+from dataset import CellDataset, cell_dataloader, widen_counts
+from sc_utils import concatenate, RowView, StageBuffer
+from stage_split import real_stage_split, dataset_order
+from evaluation import inference_batch_size, predict, extract, EvalPolicy, BackgroundEvaluator
+from metrics import forgetting
+from checkpoint import StageCheckpointer, EncoderCache, run_directory, set_rng_state
+from data_cache import array_digest, matrix_digest
 import numpy as np
 from sklearn.cluster import KMeans
 import math, os
@@ -15,6 +22,7 @@ from sklearn import metrics
 from preprocessing import *
 import argparse
 import random
+import time
 from itertools import cycle
 from scipy.optimize import linear_sum_assignment
 from sklearn.preprocessing import OneHotEncoder
@@ -68,8 +76,7 @@ def cluster_acc(y_pred, y_true):
     assert y_pred.size == y_true.size
     D = max(y_pred.max(), y_true.max()) + 1
     w = np.zeros((D, D), dtype=np.int64)
-    for i in range(y_pred.size):
-        w[y_pred[i], y_true[i]] += 1
+    w += np.bincount(y_pred.astype(np.int64) * D + y_true, minlength=D * D).reshape(D, D)
     row_ind, col_ind = linear_sum_assignment(w.max() - w)
     return w[row_ind, col_ind].sum() / y_pred.size
 
@@ -121,7 +128,7 @@ class Prototype(nn.Module):
 
     def forward(self, x):
         x = F.normalize(x)
-        x = self.fc(x) / self.tau
+        x = self.fc(x).float() / self.tau
         return x
 
     def weight_norm(self):
@@ -178,41 +185,24 @@ class AutoEncoder(nn.Module):
         self.encoder = buildNetwork([self.input_dim] + encodeLayer, activation=activation, noise=True, batchnorm=False)
         self.decoder = buildNetwork([self.z_dim] + decodeLayer, activation=activation, batchnorm=False)
         self._enc_mu = nn.Linear(encodeLayer[-1], self.z_dim)
-        self._dec_mean = nn.Sequential(nn.Linear(decodeLayer[-1], self.input_dim), MeanAct())
-        self._dec_disp = nn.Sequential(nn.Linear(decodeLayer[-1], self.input_dim), DispAct())
-        self._dec_pi = nn.Sequential(nn.Linear(decodeLayer[-1], self.input_dim), nn.Sigmoid())
+        self._dec_zinb = ZINBHead(decodeLayer[-1], self.input_dim)
+        # state dicts with the former _dec_mean / _dec_disp / _dec_pi heads still load
+        self._register_load_state_dict_pre_hook(zinb_head_hook("_dec_zinb"))
 
     def forward(self, x):
         h = self.encoder(x)
         z = self._enc_mu(h)
         h = self.decoder(z)
-        mean = self._dec_mean(h)
-        disp = self._dec_disp(h)
-        pi = self._dec_pi(h)
-        return z, mean, disp, pi
+        mean, disp, pi = self._dec_zinb(h)
+        return z.float(), mean, disp, pi
 
-
-def extractor(model, test_loader, device):
-    model.eval()
-    test_embedding = []
-    test_label = []
-    test_index = []
-    with torch.no_grad():
-        for _, data in enumerate(test_loader):
-            x_t, label_t, index_t = data[0].to(device), data[3].to(device), data[4].to(device)
-            z_t, _, _, _ = model(x_t)
-            test_embedding.append(z_t.detach())
-            test_label.append(label_t)
-            test_index.append(index_t)
-    test_embedding = torch.cat(test_embedding, dim=0)
-    test_label = torch.cat(test_label)
-    test_index = torch.cat(test_index)
-    _, test_indexes = torch.sort(test_index, descending=False)
-    test_embedding = test_embedding[test_indexes]
-    test_label = test_label[test_indexes]
-    test_embedding = test_embedding.cpu().numpy()
-    test_label = test_label.cpu().numpy()
-    return test_embedding, test_label
+    def encode(self, x):
+        # embedding only, for evaluation and exemplar selection: no noise layers, no decoder
+        h = x
+        for layer in self.encoder:
+            if not isinstance(layer, GaussianNoise):
+                h = layer(h)
+        return self._enc_mu(h).float()
 
 
 def test(model, labeled_num, device, test_loader, cluster_mapping, epoch):
@@ -260,74 +250,19 @@ def test(model, labeled_num, device, test_loader, cluster_mapping, epoch):
 
 
 def dataset_spliting(X, count_X, cellname, size_factor, cell_number_list, class_set_list, labeled_ratio=0.5, random_seed=8888):
-    train_X_set = []
-    train_count_X_set = []
-    train_cellname_set = []
-    train_size_factor_set = []
-    train_Y_set = []
-    test_X_set = []
-    test_count_X_set = []
-    test_cellname_set = []
-    test_size_factor_set = []
-    test_Y_set = []
-    unique_class_set_list = []
-
-    for i in range(len(cell_number_list)):
-        if i == 0:
-            X1 = X[:cell_number_list[i]]
-            count_X1 = count_X[:cell_number_list[i]]
-            cellname1 = cellname[:cell_number_list[i]]
-            size_factor1 = size_factor[:cell_number_list[i]]
-        else:
-            X1 = X[cell_number_list[i-1]:cell_number_list[i]]
-            count_X1 = count_X[cell_number_list[i-1]:cell_number_list[i]]
-            cellname1 = cellname[cell_number_list[i-1]:cell_number_list[i]]
-            size_factor1 = size_factor[cell_number_list[i-1]:cell_number_list[i]]
-        train_index1 = []
-        test_index1 = []
-        np.random.seed(random_seed)
-
-        for j in range(X1.shape[0]):
-            if np.random.rand() < labeled_ratio:
-                train_index1.append(j)
-            else:
-                test_index1.append(j)
-
-        train_X1 = X1[train_index1]
-        train_count_X1 = count_X1[train_index1]
-        train_cellname1 = cellname1[train_index1]
-        train_size_factor1 = size_factor1[train_index1]
-        test_X1 = X1[test_index1]
-        test_count_X1 = count_X1[test_index1]
-        test_cellname1 = cellname1[test_index1]
-        test_size_factor1 = size_factor1[test_index1]
-        train_Y1 = np.array([0] * len(train_cellname1))
-        test_Y1 = np.array([0] * len(test_cellname1))
-
-        current_class_set = class_set_list[i]
-        for k in range(len(current_class_set)):
-            if current_class_set[k] in unique_class_set_list:
-                train_Y1[train_cellname1 == current_class_set[k]] = unique_class_set_list.index(current_class_set[k])
-                test_Y1[test_cellname1 == current_class_set[k]] = unique_class_set_list.index(current_class_set[k])
-            else:
-                unique_class_set_list.append(current_class_set[k])
-                train_Y1[train_cellname1 == current_class_set[k]] = len(unique_class_set_list) - 1
-                test_Y1[test_cellname1 == current_class_set[k]] = len(unique_class_set_list) - 1
+    # index arrays per stage from one vectorized pass, X and count_X are passed on as row views of the
+    # base matrices instead of copies
+    splits, unique_class_set_list = real_stage_split(cellname, cell_number_list, class_set_list,
+                                                     labeled_ratio=labeled_ratio, random_seed=random_seed)
+    for i, (_, _, train_Y1, test_Y1) in enumerate(splits):
         print("For the {}-th stage, the train cell class number is {} and the test class number "
               "is {}".format(i + 1, len(np.unique(train_Y1)), len(np.unique(test_Y1))))
-        train_X_set.append(train_X1)
-        train_count_X_set.append(train_count_X1)
-        train_cellname_set.append(train_cellname1)
-        train_size_factor_set.append(train_size_factor1)
-        train_Y_set.append(train_Y1)
-        test_X_set.append(test_X1)
-        test_count_X_set.append(test_count_X1)
-        test_cellname_set.append(test_cellname1)
-        test_size_factor_set.append(test_size_factor1)
-        test_Y_set.append(test_Y1)
+    train_index_set, test_index_set, train_Y_set, test_Y_set = [list(item) for item in zip(*splits)]
 
-    return train_X_set, train_count_X_set, train_cellname_set, train_size_factor_set, train_Y_set, \
-           test_X_set, test_count_X_set, test_cellname_set, test_size_factor_set, test_Y_set
+    return [RowView(X, index) for index in train_index_set], [RowView(count_X, index) for index in train_index_set], \
+           [cellname[index] for index in train_index_set], [size_factor[index] for index in train_index_set], train_Y_set, \
+           [RowView(X, index) for index in test_index_set], [RowView(count_X, index) for index in test_index_set], \
+           [cellname[index] for index in test_index_set], [size_factor[index] for index in test_index_set], test_Y_set
 
 
 if __name__ == "__main__":
@@ -346,6 +281,30 @@ if __name__ == "__main__":
     parser.add_argument('--lr', type=float, default=0.0001)
     parser.add_argument('--top-k', type=int, default=20)
     parser.add_argument('--structure', type=int, default=1)
+    parser.add_argument('--cache-dir', type=str, default='',
+                        help='directory of the preprocessed data cache, no caching by default')
+    parser.add_argument('--chunk-size', type=int, default=0)
+    parser.add_argument('--device-data', action='store_true',
+                        help='keep each stage on the training device and sample batches there')
+    parser.add_argument('--amp', action='store_true',
+                        help='train the encoder, decoder and prototypes under bf16 autocast')
+    parser.add_argument('--eval-memory', type=int, default=512,
+                        help='memory budget (MB) that bounds the inference batch size of the evaluations')
+    parser.add_argument('--eval-per-class', type=int, default=200,
+                        help='cells per class evaluated before the last epoch of a stage, 0 for all')
+    parser.add_argument('--eval-budget', type=float, default=0,
+                        help='seconds per stage for the evaluations before its last epoch, 0 for no limit')
+    parser.add_argument('--background-eval', action='store_true',
+                        help='run the evaluations before the last epoch of a stage in a worker thread')
+    parser.add_argument('--checkpoint-dir', type=str, default='',
+                        help='save a checkpoint at the end of every stage under this directory')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume from the last stage checkpoint of the same run in --checkpoint-dir')
+    parser.add_argument('--encoder-cache', type=str, default='',
+                        help='directory of ZINB-pretrained encoders shared by the strategy scripts')
+    parser.add_argument('--order', type=str, nargs='+', action='append',
+                        help='dataset order to train (repeatable), instead of the built-in orders')
+    parser.add_argument('--load-workers', type=int, default=4)
 
     args = parser.parse_args()
     torch.manual_seed(args.random_seed)
@@ -355,6 +314,7 @@ if __name__ == "__main__":
     torch.backends.cudnn.deterministic = True
 
     device = torch.device('cuda' if torch.cuda.is_available() else "cpu", args.gpu_id)
+    data_device = device if args.device_data else None
 
     # filename_set = [["Cao_2020_Eye", "Cao_2020_Intestine", "Cao_2020_Pancreas", "Cao_2020_Stomach"],
     #                 ["Cao_2020_Intestine", "Cao_2020_Pancreas", "Cao_2020_Stomach", "Cao_2020_Eye"],
@@ -365,127 +325,28 @@ if __name__ == "__main__":
                     ["Madissoon_Lung", "Stewart_Fetal", "Vento-Tormo_10x", "He_Lone_Bone"],
                     ["Stewart_Fetal", "Vento-Tormo_10x", "He_Lone_Bone", "Madissoon_Lung"],
                     ["Vento-Tormo_10x", "He_Lone_Bone", "Madissoon_Lung", "Stewart_Fetal"]]
+    if args.order:
+        filename_set = args.order
 
     result_list = []
 
     for i in range(len(filename_set)):
-        cell_number_list = []
-        class_set_list = []
         filename = filename_set[i]
-        dataname1 = filename[0]
-        if dataname1 in ["Quake_10x", "Cao", "Vento-Tormo_10x"]:
-            X1, cell_name1, gene_name1 = read_real_with_genes(dataname1, batch=False)
-        else:
-            X1, cell_name1, gene_name1 = read_real_with_genes_new(dataname1, batch=False)
-        print(gene_name1)
-        class_set1 = class_splitting_single(dataname1)
-        index1 = []
-        for i in range(len(cell_name1)):
-            if cell_name1[i] in class_set1:
-                index1.append(i)
-        X1 = X1[index1]
-        cell_name1 = cell_name1[index1]
-        count_X1 = X1.astype(np.int)
-        cell_number1 = X1.shape[0]
-        print("for {} dataset, its cell number is {} and gene number is {}".format(dataname1, cell_number1,
-                                                                                   len(gene_name1)))
-        adata1 = anndata.AnnData(X1, var=pd.DataFrame(index=list(gene_name1)))
-        adata1.obs["cellname"] = cell_name1
-        cell_number_list.append(cell_number1)
-        class_set_list.append(class_set1)
-
-        dataname2 = filename[1]
-        if dataname2 in ["Quake_10x", "Cao", "Vento-Tormo_10x"]:
-            X2, cell_name2, gene_name2 = read_real_with_genes(dataname2, batch=False)
-        else:
-            X2, cell_name2, gene_name2 = read_real_with_genes_new(dataname2, batch=False)
-        print(gene_name2)
-        class_set2 = class_splitting_single(dataname2)
-        index2 = []
-        for i in range(len(cell_name2)):
-            if cell_name2[i] in class_set2:
-                index2.append(i)
-        X2 = X2[index2]
-        cell_name2 = cell_name2[index2]
-        count_X2 = X2.astype(np.int)
-        cell_number2 = X2.shape[0]
-        print("for {} dataset, its cell number is {} and gene number is {}".format(dataname2, cell_number2,
-                                                                                   len(gene_name2)))
-        adata2 = anndata.AnnData(X2, var=pd.DataFrame(index=list(gene_name2)))
-        adata2.obs["cellname"] = cell_name2
-        cell_number_list.append(cell_number1 + cell_number2)
-        class_set_list.append(class_set2)
-
-        dataname3 = filename[2]
-        if dataname3 in ["Quake_10x", "Cao", "Vento-Tormo_10x"]:
-            X3, cell_name3, gene_name3 = read_real_with_genes(dataname3, batch=False)
-        else:
-            X3, cell_name3, gene_name3 = read_real_with_genes_new(dataname3, batch=False)
-        print(gene_name3)
-        class_set3 = class_splitting_single(dataname3)
-        index3 = []
-        for i in range(len(cell_name3)):
-            if cell_name3[i] in class_set3:
-                index3.append(i)
-        X3 = X3[index3]
-        cell_name3 = cell_name3[index3]
-        count_X3 = X3.astype(np.int)
-        cell_number3 = X3.shape[0]
-        print("for {} dataset, its cell number is {} and gene number is {}".format(dataname3, cell_number3,
-                                                                                   len(gene_name3)))
-        adata3 = anndata.AnnData(X3, var=pd.DataFrame(index=list(gene_name3)))
-        adata3.obs["cellname"] = cell_name3
-        cell_number_list.append(cell_number1 + cell_number2 + cell_number3)
-        class_set_list.append(class_set3)
-
-        dataname4 = filename[3]
-        if dataname4 in ["Quake_10x", "Cao", "Vento-Tormo_10x"]:
-            X4, cell_name4, gene_name4 = read_real_with_genes(dataname4, batch=False)
-        else:
-            X4, cell_name4, gene_name4 = read_real_with_genes_new(dataname4, batch=False)
-        print(gene_name4)
-        class_set4 = class_splitting_single(dataname4)
-        index4 = []
-        for i in range(len(cell_name4)):
-            if cell_name4[i] in class_set4:
-                index4.append(i)
-        X4 = X4[index4]
-        cell_name4 = cell_name4[index4]
-        count_X4 = X4.astype(np.int)
-        cell_number4 = X4.shape[0]
-        print("for {} dataset, its cell number is {} and gene number is {}".format(dataname4, cell_number4,
-                                                                                   len(gene_name4)))
-        adata4 = anndata.AnnData(X4, var=pd.DataFrame(index=list(gene_name4)))
-        adata4.obs["cellname"] = cell_name4
-        cell_number_list.append(cell_number1 + cell_number2 + cell_number3 + cell_number4)
-        class_set_list.append(class_set4)
-
-        adata = anndata.concat([adata1, adata2, adata3, adata4], join="inner")
-        count_X = adata.X.astype(np.int)
-        print("for mixed dataset, its cell number is {} and gene number is {}".format(count_X.shape[0], count_X.shape[1]))
-        adata = normalize(adata, highly_genes=args.highly_genes, size_factors=True, normalize_input=True,
-                          logtrans_input=True)
-        X = adata.X.astype(np.float32)
-        cell_name = np.array(adata.obs["cellname"])
-        print("after preprocessing, the cell number is {} and the gene dimension is {}".format(len(cell_name), X.shape[1]))
-
-        if args.highly_genes != None:
-            adata_index = list(np.array(adata.var.index))
-            high_variable = list(np.array(adata.var.highly_variable.index))
-            index = []
-            for i in range(len(high_variable)):
-                index.append(adata_index.index(high_variable[i]))
-            index = np.array(index, dtype=np.int)
-            count_X = count_X[:, index]
-        assert X.shape == count_X.shape
-        size_factor = np.array(adata.obs.size_factors).reshape(-1, 1).astype(np.float32)
+        # loaded in one canonical order shared by all orders of the same datasets
+        X, count_X, cell_name, gene_name, size_factor, scaler, cell_number_list, class_set_list = load_real_data(
+            sorted(filename), highly_genes=args.highly_genes, size_factors=True, normalize_input=True,
+            logtrans_input=True, lazy_scale=True, join="inner", cache_dir=args.cache_dir, chunk_size=args.chunk_size,
+            workers=args.load_workers)
+        rows, cell_number_list, class_set_list = dataset_order(cell_number_list, class_set_list,
+                                                             sorted(filename), filename)
 
         labeled_ratio = args.ra  # 0.5
+        zinb_loss = ZINBLoss(max_count=int(count_X.max())).to(device)
         stage_number = args.stage
         source_X_set, source_count_X_set, source_cellname_set, source_size_factor_set, source_Y_set, \
         target_X_set, target_count_X_set, target_cellname_set, target_size_factor_set, target_Y_set \
-            = dataset_spliting(X, count_X, cell_name, size_factor, cell_number_list, class_set_list,
-                               labeled_ratio=labeled_ratio, random_seed=args.random_seed)
+            = dataset_spliting(RowView(X, rows), RowView(count_X, rows), cell_name[rows], size_factor[rows],
+                               cell_number_list, class_set_list, labeled_ratio=labeled_ratio, random_seed=args.random_seed)
         print("we have finished the dataset splitting process!!!")
 
         if args.structure == 0:
@@ -493,9 +354,21 @@ if __name__ == "__main__":
         else:
             model = AutoEncoder(X.shape[1], 128, encodeLayer=[512, 256], decodeLayer=[256, 512], activation="relu")
         model = model.to(device)
+        eval_batch_size = inference_batch_size(model, X.shape[1], args.eval_memory << 20)
+        background = BackgroundEvaluator(model, device) if args.background_eval else None
 
         class_number_set = [0]
+        stage_accuracy_history = []
+        checkpointer, resume_state = None, None
+        if args.checkpoint_dir:
+            checkpointer = StageCheckpointer(run_directory(args.checkpoint_dir, __file__, args, data=sorted(filename)),
+                                             stage_keys=filename)
+            if args.resume:
+                resume_state = checkpointer.latest(device)
+        memory_indexes = []
         current_result = filename
+        target_history = StageBuffer()
+        source_memory = StageBuffer()
         for current_stage in range(stage_number):
             source_x = source_X_set[current_stage]
             source_raw_x = source_count_X_set[current_stage]
@@ -510,11 +383,10 @@ if __name__ == "__main__":
             target_y = target_Y_set[current_stage]
 
             if current_stage == 0:
-                unified_target_x = target_x
-                unified_target_raw_x = target_raw_x
-                unified_target_cellname = target_cellname
-                unified_target_sf = target_sf
-                unified_target_y = target_y
+                target_history.append(x=target_x, raw_x=target_raw_x, cellname=target_cellname, sf=target_sf,
+                                      y=target_y)
+                unified_target_x, unified_target_raw_x, unified_target_cellname, unified_target_sf, unified_target_y = \
+                    target_history.views("x", "raw_x", "cellname", "sf", "y")
                 class_number_set.append(len(np.unique(unified_target_y)))
                 print("the class set is {}".format(class_number_set))
             else:
@@ -524,18 +396,17 @@ if __name__ == "__main__":
                 last_target_sf = unified_target_sf
                 last_target_y = unified_target_y
 
-                unified_target_x = np.concatenate((unified_target_x, target_x), axis=0)
-                unified_target_raw_x = np.concatenate((unified_target_raw_x, target_raw_x), axis=0)
-                unified_target_sf = np.concatenate((unified_target_sf, target_sf), axis=0)
-                unified_target_cellname = np.concatenate((unified_target_cellname, target_cellname))
-                unified_target_y = np.concatenate((unified_target_y, target_y))
+                target_history.append(x=target_x, raw_x=target_raw_x, cellname=target_cellname, sf=target_sf,
+                                      y=target_y)
+                unified_target_x, unified_target_raw_x, unified_target_cellname, unified_target_sf, unified_target_y = \
+                    target_history.views("x", "raw_x", "cellname", "sf", "y")
                 class_number_set.append(len(np.unique(unified_target_y)))
                 print("the class set is {}".format(class_number_set))
 
             current_classes = len(np.unique(unified_target_y))
             if current_stage > 0:
-                unified_source_x = np.concatenate((source_x, source_x_memory), axis=0)
-                unified_source_raw_x = np.concatenate((source_raw_x, source_raw_x_memory), axis=0)
+                unified_source_x = concatenate((source_x, source_x_memory), axis=0)
+                unified_source_raw_x = concatenate((source_raw_x, source_raw_x_memory), axis=0)
                 unified_source_cellname = np.concatenate((source_cellname, source_cellname_memory))
                 unified_source_sf = np.concatenate((source_sf, source_sf_memory), axis=0)
                 unified_source_y = np.concatenate((source_y, source_y_memory))
@@ -549,6 +420,25 @@ if __name__ == "__main__":
             if source_x.shape[0] < args.batch_size:
                 args.batch_size = source_x.shape[0]
 
+            if resume_state is not None and current_stage <= resume_state["stage"]:
+                # stages up to the checkpoint only redo their bookkeeping
+                select_indexes = list(resume_state["memory_indexes"][current_stage])
+                memory_indexes.append(select_indexes)
+                source_memory.append(x=source_x[select_indexes], raw_x=source_raw_x[select_indexes],
+                                     cellname=source_cellname[select_indexes], sf=source_sf[select_indexes],
+                                     y=source_y[select_indexes])
+                source_x_memory, source_raw_x_memory, source_cellname_memory, source_sf_memory, source_y_memory = \
+                    source_memory.views("x", "raw_x", "cellname", "sf", "y")
+                if current_stage == resume_state["stage"]:
+                    assert class_number_set == resume_state["class_number_set"]
+                    model.load_state_dict(resume_state["model"])
+                    prototype_weight_store = resume_state["proto_net"]["fc.weight"]
+                    stage_accuracy_history = resume_state["stage_accuracy_history"]
+                    current_result.extend(resume_state["current_result"][len(current_result):])
+                    set_rng_state(resume_state["rng"])
+                    print("In the {}-th stage, we have resumed from the checkpoint".format(current_stage))
+                continue
+
             if args.structure == 0:
                 proto_net = Prototype(current_classes, 32, tau=args.tau)
             else:
@@ -560,23 +450,18 @@ if __name__ == "__main__":
                 proto_net.load_state_dict(state_dict)
                 print("In the {}-th state, we have loaded the prototype weight in the last stage successfully".format(current_stage))
 
-            source_dataset = TensorDataset(torch.tensor(unified_source_x), torch.tensor(unified_source_raw_x), torch.tensor(unified_source_sf),
-                                           torch.tensor(unified_source_y), torch.arange(unified_source_x.shape[0]))
-            source_dataloader = DataLoader(source_dataset, batch_size=args.batch_size, shuffle=True, drop_last=True)
-            target_dataset = TensorDataset(torch.tensor(unified_target_x), torch.tensor(unified_target_raw_x), torch.tensor(unified_target_sf),
-                                           torch.tensor(unified_target_y), torch.arange(unified_target_x.shape[0]))
-            target_dataloader = DataLoader(target_dataset, batch_size=args.batch_size, shuffle=True, drop_last=True)
-            train_dataset = TensorDataset(torch.tensor(source_x), torch.tensor(source_raw_x), torch.tensor(source_sf),
-                                           torch.tensor(source_y), torch.arange(source_x.shape[0]))
-            train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=False)
-            test_dataset = TensorDataset(torch.tensor(target_x), torch.tensor(target_raw_x), torch.tensor(target_sf),
-                                           torch.tensor(target_y), torch.arange(target_x.shape[0]))
-            test_dataloader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False)
+            source_dataset = CellDataset(unified_source_x, unified_source_raw_x, unified_source_sf, unified_source_y, scaler=scaler)
+            source_dataloader = cell_dataloader(source_dataset, args.batch_size, shuffle=True, drop_last=True, device=data_device)
+            target_dataset = CellDataset(unified_target_x, unified_target_raw_x, unified_target_sf, unified_target_y, scaler=scaler)
+            target_dataloader = cell_dataloader(target_dataset, args.batch_size, shuffle=True, drop_last=True, device=data_device)
+            train_dataset = CellDataset(source_x, source_raw_x, source_sf, source_y, scaler=scaler)
+            train_dataloader = cell_dataloader(train_dataset, eval_batch_size, shuffle=False, device=data_device)
+            test_dataset = CellDataset(target_x, target_raw_x, target_sf, target_y, scaler=scaler)
+            test_dataloader = cell_dataloader(test_dataset, eval_batch_size, shuffle=False, device=data_device)
 
             if current_stage > 0:
-                last_test_dataset = TensorDataset(torch.tensor(last_target_x), torch.tensor(last_target_raw_x), torch.tensor(last_target_sf),
-                                                   torch.tensor(last_target_y), torch.arange(last_target_x.shape[0]))
-                last_test_dataloader = DataLoader(last_test_dataset, batch_size=args.batch_size, shuffle=False)
+                last_test_dataset = CellDataset(last_target_x, last_target_raw_x, last_target_sf, last_target_y, scaler=scaler)
+                last_test_dataloader = cell_dataloader(last_test_dataset, eval_batch_size, shuffle=False, device=data_device)
 
             optimizer = optim.Adam(itertools.chain(model.parameters(), proto_net.parameters()), lr=args.lr, amsgrad=True)
 
@@ -584,106 +469,113 @@ if __name__ == "__main__":
             ce = nn.CrossEntropyLoss().to(device)
 
             if current_stage == 0:
-                for epoch in range(args.pretrain + args.finetune + 1):
-                    if epoch % args.interval == 0:
-                        model.eval()
-                        proto_net.eval()
-                        preds = np.array([])
-                        targets = np.array([])
-                        confs = np.array([])
-                        with torch.no_grad():
-                            for _, data in enumerate(test_dataloader):
-                                x_t, label_t, index_t = data[0].to(device), data[3].to(device), data[4].to(device)
-                                z_t, _, _, _ = model(x_t)
-                                output_t = proto_net(z_t)
-                                conf, pred = output_t.max(1)
-                                targets = np.append(targets, label_t.cpu().numpy())
-                                preds = np.append(preds, pred.cpu().numpy())
-                                confs = np.append(confs, conf.cpu().numpy())
-                        targets = targets.astype(int)
-                        preds = preds.astype(int)
-                        overall_acc = accuracy(preds, targets)
-                        print("In the {}-th stage and {}-th epoch, Test overall acc for this stage {:.4f}".format(current_stage, epoch, overall_acc))
+                encoder_cache = None
+                if args.encoder_cache and args.pretrain > 0:
+                    encoder_cache = EncoderCache(args.encoder_cache, data=array_digest(source_cellname, source_y),
+                                                 expression=matrix_digest(X, count_X, size_factor, scaler),
+                                                 highly_genes=args.highly_genes,
+                                                 dataset=sorted(filename), genes=X.shape[1], structure=args.structure,
+                                                 seed=args.random_seed, pretrain=args.pretrain, lr=args.lr,
+                                                 batch_size=args.batch_size, device_data=args.device_data, amp=args.amp)
+                first_epoch = args.pretrain if encoder_cache is not None and encoder_cache.restore(model, optimizer, device) else 0
+                eval_policy = EvalPolicy(args.interval, args.pretrain + args.finetune, eval_batch_size, data_device,
+                                         args.eval_per_class, args.eval_budget, args.random_seed)
+                try:
+                    for epoch in range(first_epoch, args.pretrain + args.finetune + 1):
+                        if encoder_cache is not None and epoch == args.pretrain and first_epoch == 0:
+                            encoder_cache.store(model, optimizer)
+                        if background is not None and eval_policy.due(epoch) and epoch != eval_policy.final_epoch:
+                            background.poll()
+                            background.submit(current_stage, epoch, proto_net, eval_policy, current_classes,
+                                              test=test_dataloader)
+                        elif eval_policy.due(epoch):
+                            model.eval()
+                            proto_net.eval()
+                            targets, preds, confs, _, confusion, estimate = eval_policy.evaluate(model, proto_net, test_dataloader,
+                                                                                                 epoch, current_classes, device, embeddings=False)
+                            overall_acc = estimate.accuracy
+                            print("In the {}-th stage and {}-th epoch, Test overall acc for this stage {:.4f}".format(current_stage, epoch, overall_acc))
+                            if eval_policy.subsampled(epoch):
+                                print("In the {}-th stage and {}-th epoch, stratified subsample estimate, 95% CI +/-{:.4f}".format(
+                                    current_stage, epoch, estimate.interval()))
+                            model.train()
+                            proto_net.train()
+                            if epoch == args.pretrain + args.finetune:
+                                current_result.extend([0., round(overall_acc, 4), round(overall_acc, 4)])
+                                stage_accuracy_history.append(confusion.stage_accuracies(class_number_set))
+                                print("In the {}-th stage, test acc per stage {}, forgetting {:.4f}".format(
+                                    current_stage, np.round(stage_accuracy_history[-1], 4), forgetting(stage_accuracy_history)))
+
+
+                        recon_losses = AverageMeter('recon_loss', ':.4e')
+                        ce_losses = AverageMeter('ce_loss', ':.4e')
                         model.train()
                         proto_net.train()
-                        if epoch == args.pretrain + args.finetune:
-                            current_result.extend([0., round(overall_acc, 4), round(overall_acc, 4)])
-
 
-                    recon_losses = AverageMeter('recon_loss', ':.4e')
-                    ce_losses = AverageMeter('ce_loss', ':.4e')
-                    model.train()
-                    proto_net.train()
-
-                    for batch_idx, (x_s, raw_x_s, sf_s, y_s, index_s) in enumerate(source_dataloader):
-                        x_s, raw_x_s, sf_s, y_s, index_s = x_s.to(device), raw_x_s.to(device), \
-                                                           sf_s.to(device), y_s.to(device), \
-                                                           index_s.to(device)
-                        z_s, mean_s, disp_s, pi_s = model(x_s)
-                        recon_loss = ZINBLoss().to(device)(x=raw_x_s, mean=mean_s, disp=disp_s, pi=pi_s,
-                                                           scale_factor=sf_s)
-                        output_s = proto_net(z_s)
-                        ce_loss = ce(output_s, y_s)
-                        if epoch < args.pretrain:
-                            loss = recon_loss
-                        else:
-                            loss = recon_loss + ce_loss
-                        recon_losses.update(recon_loss.item(), args.batch_size)
-                        ce_losses.update(ce_loss.item(), args.batch_size)
-                        optimizer.zero_grad()
-                        loss.backward()
-                        optimizer.step()
-                    print("In {}-th stage, Training {}/{}, zinb loss: {:.4f}, ce loss: {:.4f}".format(current_stage, epoch, args.pretrain + args.finetune + 1,
-                                                                                                                          recon_losses.avg, ce_losses.avg))
+                        epoch_start = time.time()
+                        for batch_idx, (x_s, raw_x_s, sf_s, y_s, index_s) in enumerate(source_dataloader):
+                            x_s, raw_x_s, sf_s, y_s, index_s = x_s.to(device), widen_counts(raw_x_s.to(device)), \
+                                                               sf_s.to(device), y_s.to(device), \
+                                                               index_s
+                            with autocast(device, args.amp):
+                                z_s, mean_s, disp_s, pi_s = model(x_s)
+                            recon_loss = zinb_loss(x=raw_x_s, mean=mean_s, disp=disp_s, pi=pi_s, scale_factor=sf_s)
+                            with autocast(device, args.amp):
+                                output_s = proto_net(z_s)
+                            ce_loss = ce(output_s, y_s)
+                            if epoch < args.pretrain:
+                                loss = recon_loss
+                            else:
+                                loss = recon_loss + ce_loss
+                            recon_losses.update(recon_loss.item(), args.batch_size)
+                            ce_losses.update(ce_loss.item(), args.batch_size)
+                            optimizer.zero_grad()
+                            loss.backward()
+                            optimizer.step()
+                        print("In {}-th stage, Training {}/{}, zinb loss: {:.4f}, ce loss: {:.4f}, time: {:.2f}s".format(current_stage, epoch, args.pretrain + args.finetune + 1,
+                                                                                                                              recon_losses.avg, ce_losses.avg, time.time() - epoch_start))
+                finally:
+                    if encoder_cache is not None:
+                        encoder_cache.release()
 
             else:
+                eval_policy = EvalPolicy(args.interval, args.finetune, eval_batch_size, data_device,
+                                         args.eval_per_class, args.eval_budget, args.random_seed)
                 for epoch in range(args.finetune + 1):
-                    if epoch % args.interval == 0:
+                    if background is not None and eval_policy.due(epoch) and epoch != eval_policy.final_epoch:
+                        background.poll()
+                        background.submit(current_stage, epoch, proto_net, eval_policy, current_classes,
+                                          test=test_dataloader, previous=last_test_dataloader)
+                    elif eval_policy.due(epoch):
                         model.eval()
                         proto_net.eval()
-                        preds = np.array([])
-                        targets = np.array([])
-                        confs = np.array([])
-                        with torch.no_grad():
-                            for _, data in enumerate(test_dataloader):
-                                x_t, label_t, index_t = data[0].to(device), data[3].to(device), data[4].to(device)
-                                z_t, _, _, _ = model(x_t)
-                                output_t = proto_net(z_t)
-                                conf, pred = output_t.max(1)
-                                targets = np.append(targets, label_t.cpu().numpy())
-                                preds = np.append(preds, pred.cpu().numpy())
-                                confs = np.append(confs, conf.cpu().numpy())
-                        targets = targets.astype(int)
-                        preds = preds.astype(int)
-                        acc = accuracy(preds, targets)
+                        targets, preds, confs, _, confusion, estimate = eval_policy.evaluate(model, proto_net, test_dataloader,
+                                                                                             epoch, current_classes, device, embeddings=False)
+                        acc = estimate.accuracy
                         print("In the {}-th stage and {}-th epoch, Test acc for this stage {:.4f}".format(current_stage, epoch, acc))
 
-                        last_preds = np.array([])
-                        last_targets = np.array([])
-                        with torch.no_grad():
-                            for _, data in enumerate(last_test_dataloader):
-                                x_t, label_t, index_t = data[0].to(device), data[3].to(device), data[4].to(device)
-                                z_t, _, _, _ = model(x_t)
-                                output_t = proto_net(z_t)
-                                conf, pred = output_t.max(1)
-                                last_targets = np.append(last_targets, label_t.cpu().numpy())
-                                last_preds = np.append(last_preds, pred.cpu().numpy())
-                        last_targets = last_targets.astype(int)
-                        last_preds = last_preds.astype(int)
-                        last_overall_acc = accuracy(last_preds, last_targets)
+                        last_targets, last_preds, _, _, last_confusion, last_estimate = eval_policy.evaluate(
+                            model, proto_net, last_test_dataloader, epoch, current_classes, device, embeddings=False)
+                        last_overall_acc = last_estimate.accuracy
                         print("In the {}-th stage and {}-th epoch, Test acc for previous stage {:.4f}".format(
                             current_stage, epoch, last_overall_acc))
 
-                        overall_targets = np.concatenate((targets, last_targets))
-                        overall_preds = np.concatenate((preds, last_preds))
-                        overall_acc = accuracy(overall_preds, overall_targets)
+                        overall_confusion = confusion + last_confusion
+                        overall_estimate = estimate + last_estimate
+                        overall_acc = overall_estimate.accuracy
                         print("In the {}-th stage and {}-th epoch, Test acc for overall stage {:.4f}".format(
                             current_stage, epoch, overall_acc))
 
+                        if eval_policy.subsampled(epoch):
+                            print("In the {}-th stage and {}-th epoch, stratified subsample estimates, 95% CI: this stage +/-{:.4f}, previous stage +/-{:.4f}, overall +/-{:.4f}".format(
+                                current_stage, epoch, estimate.interval(), last_estimate.interval(), overall_estimate.interval()))
                         model.train()
                         proto_net.train()
                         if epoch == args.finetune:
                             current_result.extend([round(last_overall_acc, 4), round(acc, 4), round(overall_acc, 4)])
+                            stage_accuracy_history.append(overall_confusion.stage_accuracies(class_number_set))
+                            print("In the {}-th stage, test acc per stage {}, forgetting {:.4f}".format(
+                                current_stage, np.round(stage_accuracy_history[-1], 4), forgetting(stage_accuracy_history)))
 
 
                     recon_losses = AverageMeter('recon_loss', ':.4e')
@@ -691,14 +583,16 @@ if __name__ == "__main__":
                     model.train()
                     proto_net.train()
 
+                    epoch_start = time.time()
                     for batch_idx, (x_s, raw_x_s, sf_s, y_s, index_s) in enumerate(source_dataloader):
-                        x_s, raw_x_s, sf_s, y_s, index_s = x_s.to(device), raw_x_s.to(device), \
+                        x_s, raw_x_s, sf_s, y_s, index_s = x_s.to(device), widen_counts(raw_x_s.to(device)), \
                                                            sf_s.to(device), y_s.to(device), \
-                                                           index_s.to(device)
-                        z_s, mean_s, disp_s, pi_s = model(x_s)
-                        recon_loss = ZINBLoss().to(device)(x=raw_x_s, mean=mean_s, disp=disp_s, pi=pi_s,
-                                                           scale_factor=sf_s)
-                        output_s = proto_net(z_s)
+                                                           index_s
+                        with autocast(device, args.amp):
+                            z_s, mean_s, disp_s, pi_s = model(x_s)
+                        recon_loss = zinb_loss(x=raw_x_s, mean=mean_s, disp=disp_s, pi=pi_s, scale_factor=sf_s)
+                        with autocast(device, args.amp):
+                            output_s = proto_net(z_s)
                         ce_loss = ce(output_s, y_s)
                         loss = recon_loss + ce_loss
                         recon_losses.update(recon_loss.item(), args.batch_size)
@@ -706,11 +600,13 @@ if __name__ == "__main__":
                         optimizer.zero_grad()
                         loss.backward()
                         optimizer.step()
-                    print("In {}-th stage, Training {}/{}, zinb loss: {:.4f}, ce loss: {:.4f}".format(current_stage, epoch, args.finetune + 1,
-                                                                                                                          recon_losses.avg, ce_losses.avg))
+                    print("In {}-th stage, Training {}/{}, zinb loss: {:.4f}, ce loss: {:.4f}, time: {:.2f}s".format(current_stage, epoch, args.finetune + 1,
+                                                                                                                          recon_losses.avg, ce_losses.avg, time.time() - epoch_start))
 
+            if background is not None:
+                background.drain()
             prototype_weight_store = proto_net.fc.weight.data
-            source_embeddings, source_labels = extractor(model, train_dataloader, device)
+            source_embeddings, source_labels = extract(model, train_dataloader, device)
             assert source_embeddings.shape[0] == source_x.shape[0]
             source_labels_unique = np.unique(source_labels)
             source_centers = np.zeros((len(source_labels_unique), source_embeddings.shape[1]))
@@ -728,18 +624,18 @@ if __name__ == "__main__":
                 else:
                     topk_index = torch.topk(source_scores, k=args.top_k)[1]
                 select_indexes.extend(list(topk_index.cpu().numpy()))
-            if current_stage == 0:
-                source_x_memory = source_x[select_indexes]
-                source_raw_x_memory = source_raw_x[select_indexes]
-                source_cellname_memory = source_cellname[select_indexes]
-                source_sf_memory = source_sf[select_indexes]
-                source_y_memory = source_y[select_indexes]
-            else:
-                source_x_memory = np.concatenate((source_x_memory, source_x[select_indexes]), axis=0)
-                source_raw_x_memory = np.concatenate((source_raw_x_memory, source_raw_x[select_indexes]), axis=0)
-                source_cellname_memory = np.concatenate((source_cellname_memory, source_cellname[select_indexes]))
-                source_sf_memory = np.concatenate((source_sf_memory, source_sf[select_indexes]), axis=0)
-                source_y_memory = np.concatenate((source_y_memory, source_y[select_indexes]))
+            memory_indexes.append(select_indexes)
+            source_memory.append(x=source_x[select_indexes], raw_x=source_raw_x[select_indexes],
+                                 cellname=source_cellname[select_indexes], sf=source_sf[select_indexes],
+                                 y=source_y[select_indexes])
+            source_x_memory, source_raw_x_memory, source_cellname_memory, source_sf_memory, source_y_memory = \
+                source_memory.views("x", "raw_x", "cellname", "sf", "y")
+            if checkpointer is not None:
+                checkpointer.save(current_stage, model=model.state_dict(), proto_net=proto_net.state_dict(),
+                                  optimizer=optimizer.state_dict(), class_number_set=class_number_set,
+                                  stage_accuracy_history=stage_accuracy_history,
+                                  memory_indexes=[np.asarray(index, dtype=np.int64) for index in memory_indexes],
+                                  current_result=current_result)
         result_list.append(current_result)
         print("current result list is {}".format(result_list))
     result_list = pd.DataFrame(np.array(result_list))
@@ -7,7 +7,15 @@ import torch.nn.functional as F
 import torch.optim as optim
 from collections import Counter
 from torch.utils.data import DataLoader, TensorDataset, WeightedRandomSampler
-from layers import ZINBLoss, MeanAct, DispAct, GaussianNoise
+from layers import ZINBLoss, ZINBHead, zinb_head_hook, MeanAct, DispAct, PiAct, GaussianNoise, autocast
+from dataset import CellDataset, cell_dataloader, widen_counts
+from sc_utils import concatenate, RowView, StageBuffer
+from stage_split import single_stage_split, stage_class_sets
+from evaluation import inference_batch_size, predict, extract, EvalPolicy, BackgroundEvaluator
+from metrics import forgetting
+from checkpoint import StageCheckpointer, EncoderCache, run_directory, set_rng_state
+from data_cache import array_digest, matrix_digest
+from export import StageExporter, map_names
 import numpy as np
 from sklearn.cluster import KMeans
 import math, os
@@ -15,6 +23,7 @@ from sklearn import metrics
 from preprocessing import *
 import argparse
 import random
+import time
 from itertools import cycle
 from scipy.optimize import linear_sum_assignment
 from sklearn.preprocessing import OneHotEncoder
@@ -67,8 +76,7 @@ def cluster_acc(y_pred, y_true):
     assert y_pred.size == y_true.size
     D = max(y_pred.max(), y_true.max()) + 1
     w = np.zeros((D, D), dtype=np.int64)
-    for i in range(y_pred.size):
-        w[y_pred[i], y_true[i]] += 1
+    w += np.bincount(y_pred.astype(np.int64) * D + y_true, minlength=D * D).reshape(D, D)
     row_ind, col_ind = linear_sum_assignment(w.max() - w)
     return w[row_ind, col_ind].sum() / y_pred.size
 
@@ -120,7 +128,7 @@ class Prototype(nn.Module):
 
     def forward(self, x):
         x = F.normalize(x)
-        x = self.fc(x) / self.tau
+        x = self.fc(x).float() / self.tau
         return x
 
     def weight_norm(self):
@@ -138,41 +146,24 @@ class AutoEncoder(nn.Module):
         self.encoder = buildNetwork([self.input_dim] + encodeLayer, activation=activation, noise=True, batchnorm=False)
         self.decoder = buildNetwork([self.z_dim] + decodeLayer, activation=activation, batchnorm=False)
         self._enc_mu = nn.Linear(encodeLayer[-1], self.z_dim)
-        self._dec_mean = nn.Sequential(nn.Linear(decodeLayer[-1], self.input_dim), MeanAct())
-        self._dec_disp = nn.Sequential(nn.Linear(decodeLayer[-1], self.input_dim), DispAct())
-        self._dec_pi = nn.Sequential(nn.Linear(decodeLayer[-1], self.input_dim), nn.Sigmoid())
+        self._dec_zinb = ZINBHead(decodeLayer[-1], self.input_dim)
+        # state dicts with the former _dec_mean / _dec_disp / _dec_pi heads still load
+        self._register_load_state_dict_pre_hook(zinb_head_hook("_dec_zinb"))
 
     def forward(self, x):
         h = self.encoder(x)
         z = self._enc_mu(h)
         h = self.decoder(z)
-        mean = self._dec_mean(h)
-        disp = self._dec_disp(h)
-        pi = self._dec_pi(h)
-        return z, mean, disp, pi
+        mean, disp, pi = self._dec_zinb(h)
+        return z.float(), mean, disp, pi
 
-
-def extractor(model, test_loader, device):
-    model.eval()
-    test_embedding = []
-    test_label = []
-    test_index = []
-    with torch.no_grad():
-        for _, data in enumerate(test_loader):
-            x_t, label_t, index_t = data[0].to(device), data[3].to(device), data[4].to(device)
-            z_t, _, _, _ = model(x_t)
-            test_embedding.append(z_t.detach())
-            test_label.append(label_t)
-            test_index.append(index_t)
-    test_embedding = torch.cat(test_embedding, dim=0)
-    test_label = torch.cat(test_label)
-    test_index = torch.cat(test_index)
-    _, test_indexes = torch.sort(test_index, descending=False)
-    test_embedding = test_embedding[test_indexes]
-    test_label = test_label[test_indexes]
-    test_embedding = test_embedding.cpu().numpy()
-    test_label = test_label.cpu().numpy()
-    return test_embedding, test_label
+    def encode(self, x):
+        # embedding only, for evaluation and exemplar selection: no noise layers, no decoder
+        h = x
+        for layer in self.encoder:
+            if not isinstance(layer, GaussianNoise):
+                h = layer(h)
+        return self._enc_mu(h).float()
 
 
 def test(model, labeled_num, device, test_loader, cluster_mapping, epoch):
@@ -220,66 +211,19 @@ def test(model, labeled_num, device, test_loader, cluster_mapping, epoch):
 
 
 def dataset_spliting(X, count_X, cellname, size_factor, class_set, stage_number, labeled_ratio=0.5, random_seed=8888):
-    train_X_set = []
-    train_count_X_set = []
-    train_cellname_set = []
-    train_size_factor_set = []
-    train_Y_set = []
-    test_X_set = []
-    test_count_X_set = []
-    test_cellname_set = []
-    test_size_factor_set = []
-    test_Y_set = []
-
-    for i in range(stage_number):
-        if i != stage_number - 1:
-            current_class_set = class_set[((len(class_set) // stage_number) * i):((len(class_set) // stage_number) * (i + 1))]
-            print("For the {}-th stage, the class set is {} and the class number is {}".format(i, current_class_set, len(current_class_set)))
-        else:
-            current_class_set = class_set[((len(class_set) // stage_number) * i):]
-            print("For the {}-th stage, the class set is {} and the class number is {}".format(i, current_class_set, len(current_class_set)))
-
-        train_index = []
-        test_index = []
-        np.random.seed(random_seed)
-
-        for j in range(X.shape[0]):
-            if cellname[j] in current_class_set:
-                if np.random.rand() < labeled_ratio:
-                    train_index.append(j)
-                else:
-                    test_index.append(j)
-
-        train_X = X[train_index]
-        train_count_X = count_X[train_index]
-        train_cellname = cellname[train_index]
-        train_size_factor = size_factor[train_index]
-        test_X = X[test_index]
-        test_count_X = count_X[test_index]
-        test_cellname = cellname[test_index]
-        test_size_factor = size_factor[test_index]
-        train_Y = np.array([0] * len(train_cellname))
-        test_Y = np.array([0] * len(test_cellname))
-
-        for k in range(len(class_set)):
-            if class_set[k] in current_class_set:
-                train_Y[train_cellname == class_set[k]] = k
-                test_Y[test_cellname == class_set[k]] = k
+    # index arrays per stage from one vectorized pass, X and count_X are passed on as row views of the
+    # base matrices instead of copies
+    splits = single_stage_split(cellname, class_set, stage_number, labeled_ratio=labeled_ratio, random_seed=random_seed)
+    for i, (current_class_set, (_, _, train_Y, test_Y)) in enumerate(zip(stage_class_sets(class_set, stage_number), splits)):
+        print("For the {}-th stage, the class set is {} and the class number is {}".format(i, current_class_set, len(current_class_set)))
         print("For the {}-th stage, the train cell class number is {} and the test class number "
               "is {}".format(i, len(np.unique(train_Y)), len(np.unique(test_Y))))
-        train_X_set.append(train_X)
-        train_count_X_set.append(train_count_X)
-        train_cellname_set.append(train_cellname)
-        train_size_factor_set.append(train_size_factor)
-        train_Y_set.append(train_Y)
-        test_X_set.append(test_X)
-        test_count_X_set.append(test_count_X)
-        test_cellname_set.append(test_cellname)
-        test_size_factor_set.append(test_size_factor)
-        test_Y_set.append(test_Y)
+    train_index_set, test_index_set, train_Y_set, test_Y_set = [list(item) for item in zip(*splits)]
 
-    return train_X_set, train_count_X_set, train_cellname_set, train_size_factor_set, train_Y_set, \
-           test_X_set, test_count_X_set, test_cellname_set, test_size_factor_set, test_Y_set
+    return [RowView(X, index) for index in train_index_set], [RowView(count_X, index) for index in train_index_set], \
+           [cellname[index] for index in train_index_set], [size_factor[index] for index in train_index_set], train_Y_set, \
+           [RowView(X, index) for index in test_index_set], [RowView(count_X, index) for index in test_index_set], \
+           [cellname[index] for index in test_index_set], [size_factor[index] for index in test_index_set], test_Y_set
 
 
 if __name__ == "__main__":
@@ -298,6 +242,29 @@ if __name__ == "__main__":
     parser.add_argument('--lr', type=float, default=0.0001)
     parser.add_argument('--top-k', type=int, default=20)
     parser.add_argument('--structure', type=int, default=1)
+    parser.add_argument('--cache-dir', type=str, default='',
+                        help='directory of the preprocessed data cache, no caching by default')
+    parser.add_argument('--chunk-size', type=int, default=0)
+    parser.add_argument('--device-data', action='store_true',
+                        help='keep each stage on the training device and sample batches there')
+    parser.add_argument('--amp', action='store_true',
+                        help='train the encoder, decoder and prototypes under bf16 autocast')
+    parser.add_argument('--eval-memory', type=int, default=512,
+                        help='memory budget (MB) that bounds the inference batch size of the evaluations')
+    parser.add_argument('--eval-per-class', type=int, default=200,
+                        help='cells per class evaluated before the last epoch of a stage, 0 for all')
+    parser.add_argument('--eval-budget', type=float, default=0,
+                        help='seconds per stage for the evaluations before its last epoch, 0 for no limit')
+    parser.add_argument('--background-eval', action='store_true',
+                        help='run the evaluations before the last epoch of a stage in a worker thread')
+    parser.add_argument('--export-format', type=str, default='npy', choices=['npy', 'parquet', 'hdf5', 'csv'],
+                        help='format of the per-stage prediction tables and test embeddings')
+    parser.add_argument('--checkpoint-dir', type=str, default='',
+                        help='save a checkpoint at the end of every stage under this directory')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume from the last stage checkpoint of the same run in --checkpoint-dir')
+    parser.add_argument('--encoder-cache', type=str, default='',
+                        help='directory of ZINB-pretrained encoders shared by the strategy scripts')
 
     args = parser.parse_args()
     torch.manual_seed(args.random_seed)
@@ -307,6 +274,8 @@ if __name__ == "__main__":
     torch.backends.cudnn.deterministic = True
 
     device = torch.device('cuda' if torch.cuda.is_available() else "cpu", args.gpu_id)
+    data_device = device if args.device_data else None
+    exporter = StageExporter(args.export_format)
 
     filename_set = ["Cao", "Quake_10x", "Quake_Smart-seq2", "Zeisel_2018"]
 
@@ -315,40 +284,14 @@ if __name__ == "__main__":
     for i in range(args.num, args.num + 1):
         filename = filename_set[i]
         dataname = filename
-        X, cell_name, gene_name = read_real_with_genes(filename, batch=False)
+        X, count_X, cell_name, gene_name, size_factor, scaler = load_single_data(
+            filename, highly_genes=args.highly_genes, size_factors=True, normalize_input=True, logtrans_input=True,
+            lazy_scale=True, cache_dir=args.cache_dir, chunk_size=args.chunk_size)
         class_set = class_splitting_single(filename)
         total_classes = len(class_set)
 
-        index = []
-        for i in range(len(cell_name)):
-            if cell_name[i] in class_set:
-                index.append(i)
-        X = X[index]
-        cell_name = cell_name[index]
-
-        count_X = X.astype(np.int)
-        adata = sc.AnnData(X)
-        adata.var["gene_id"] = gene_name
-        adata.obs["cellname"] = cell_name
-        adata = normalize(adata, highly_genes=args.highly_genes, size_factors=True, normalize_input=True,
-                          logtrans_input=True)
-        X = adata.X.astype(np.float32)
-        cell_name = np.array(adata.obs["cellname"])
-        gene_name = np.array(adata.var["gene_id"])
-        print("after preprocessing, the cell number is {} and the gene dimension is {}".format(len(cell_name), len(gene_name)))
-
-        if args.highly_genes != None:
-            high_variable = np.array(adata.var.highly_variable.index, dtype=np.int)
-            count_X = count_X[:, high_variable]
-        else:
-            select_genes = np.array(adata.var.index, dtype=np.int)
-            select_cells = np.array(adata.obs.index, dtype=np.int)
-            count_X = count_X[:, select_genes]
-            count_X = count_X[select_cells]
-        assert X.shape == count_X.shape
-        size_factor = np.array(adata.obs.size_factors).reshape(-1, 1).astype(np.float32)
-
         labeled_ratio = args.ra  # 0.5
+        zinb_loss = ZINBLoss(max_count=int(count_X.max())).to(device)
         stage_number = args.age
         source_X_set, source_count_X_set, source_cellname_set, source_size_factor_set, source_Y_set, \
         target_X_set, target_count_X_set, target_cellname_set, target_size_factor_set, target_Y_set \
@@ -360,9 +303,19 @@ if __name__ == "__main__":
         else:
             model = AutoEncoder(X.shape[1], 128, encodeLayer=[512, 256], decodeLayer=[256, 512], activation="relu")
         model = model.to(device)
+        eval_batch_size = inference_batch_size(model, X.shape[1], args.eval_memory << 20)
+        background = BackgroundEvaluator(model, device) if args.background_eval else None
 
         class_number_set = [0]
-
+        stage_accuracy_history = []
+        checkpointer, resume_state = None, None
+        if args.checkpoint_dir:
+            checkpointer = StageCheckpointer(run_directory(args.checkpoint_dir, __file__, args, data=dataname))
+            if args.resume:
+                resume_state = checkpointer.latest(device)
+
+        source_history = StageBuffer()
+        target_history = StageBuffer()
         for current_stage in range(stage_number):
             current_result = [filename]
             current_result.append(current_stage + 1)
@@ -388,33 +341,35 @@ if __name__ == "__main__":
                 print("the class set is {}".format(class_number_set))
 
             if current_stage > 0:
-                last_source_x = np.concatenate(source_X_set[:current_stage])
-                last_source_raw_x = np.concatenate(source_count_X_set[:current_stage])
-                last_source_cellname = np.concatenate(source_cellname_set[:current_stage])
-                last_source_sf = np.concatenate(source_size_factor_set[:current_stage])
-                last_source_y = np.concatenate(source_Y_set[:current_stage])
-
-                last_target_x = np.concatenate(target_X_set[:current_stage])
-                last_target_raw_x = np.concatenate(target_count_X_set[:current_stage])
-                last_target_cellname = np.concatenate(target_cellname_set[:current_stage])
-                last_target_sf = np.concatenate(target_size_factor_set[:current_stage])
-                last_target_y = np.concatenate(target_Y_set[:current_stage])
-
-            total_source_x = np.concatenate(source_X_set[:(current_stage + 1)])
-            total_source_raw_x = np.concatenate(source_count_X_set[:(current_stage + 1)])
-            total_source_cellname = np.concatenate(source_cellname_set[:(current_stage + 1)])
-            total_source_sf = np.concatenate(source_size_factor_set[:(current_stage + 1)])
-            total_source_y = np.concatenate(source_Y_set[:(current_stage + 1)])
-
-            total_target_x = np.concatenate(target_X_set[:(current_stage + 1)])
-            total_target_raw_x = np.concatenate(target_count_X_set[:(current_stage + 1)])
-            total_target_cellname = np.concatenate(target_cellname_set[:(current_stage + 1)])
-            total_target_sf = np.concatenate(target_size_factor_set[:(current_stage + 1)])
-            total_target_y = np.concatenate(target_Y_set[:(current_stage + 1)])
+                last_source_x, last_source_raw_x, last_source_cellname, last_source_sf, last_source_y = \
+                    source_history.views("x", "raw_x", "cellname", "sf", "y")
+
+                last_target_x, last_target_raw_x, last_target_cellname, last_target_sf, last_target_y = \
+                    target_history.views("x", "raw_x", "cellname", "sf", "y")
+            source_history.append(x=source_x, raw_x=source_raw_x, cellname=source_cellname, sf=source_sf, y=source_y)
+            target_history.append(x=target_x, raw_x=target_raw_x, cellname=target_cellname, sf=target_sf, y=target_y)
+
+            total_source_x, total_source_raw_x, total_source_cellname, total_source_sf, total_source_y = \
+                source_history.views("x", "raw_x", "cellname", "sf", "y")
+
+            total_target_x, total_target_raw_x, total_target_cellname, total_target_sf, total_target_y = \
+                target_history.views("x", "raw_x", "cellname", "sf", "y")
 
             if source_x.shape[0] < args.batch_size:
                 args.batch_size = source_x.shape[0]
 
+            if resume_state is not None and current_stage <= resume_state["stage"]:
+                # stages up to the checkpoint only redo their bookkeeping
+                if current_stage == resume_state["stage"]:
+                    assert class_number_set == resume_state["class_number_set"]
+                    model.load_state_dict(resume_state["model"])
+                    prototype_weight_store = resume_state["proto_net"]["fc.weight"]
+                    stage_accuracy_history = resume_state["stage_accuracy_history"]
+                    result_list.extend(resume_state["results"])
+                    set_rng_state(resume_state["rng"])
+                    print("In the {}-th stage, we have resumed from the checkpoint".format(current_stage))
+                continue
+
             if args.structure == 0:
                 proto_net = Prototype(current_classes, 32, tau=args.tau)
             else:
@@ -426,25 +381,19 @@ if __name__ == "__main__":
                 proto_net.load_state_dict(state_dict)
                 print("In the {}-th state, we have loaded the prototype weight in the last stage successfully".format(current_stage))
 
-            source_dataset = TensorDataset(torch.tensor(total_source_x), torch.tensor(total_source_raw_x), torch.tensor(total_source_sf),
-                                           torch.tensor(total_source_y), torch.arange(total_source_x.shape[0]))
-            source_dataloader = DataLoader(source_dataset, batch_size=args.batch_size, shuffle=True, drop_last=True)
-            target_dataset = TensorDataset(torch.tensor(total_target_x), torch.tensor(total_target_raw_x), torch.tensor(total_target_sf),
-                                           torch.tensor(total_target_y), torch.arange(total_target_x.shape[0]))
-            target_dataloader = DataLoader(target_dataset, batch_size=args.batch_size, shuffle=True, drop_last=True)
-            train_dataset = TensorDataset(torch.tensor(source_x), torch.tensor(source_raw_x), torch.tensor(source_sf),
-                                           torch.tensor(source_y), torch.arange(source_x.shape[0]))
-            train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=False)
-            test_dataset = TensorDataset(torch.tensor(target_x), torch.tensor(target_raw_x), torch.tensor(target_sf),
-                                           torch.tensor(target_y), torch.arange(target_x.shape[0]))
-            test_dataloader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False)
+            source_dataset = CellDataset(total_source_x, total_source_raw_x, total_source_sf, total_source_y, scaler=scaler)
+            source_dataloader = cell_dataloader(source_dataset, args.batch_size, shuffle=True, drop_last=True, device=data_device)
+            target_dataset = CellDataset(total_target_x, total_target_raw_x, total_target_sf, total_target_y, scaler=scaler)
+            target_dataloader = cell_dataloader(target_dataset, args.batch_size, shuffle=True, drop_last=True, device=data_device)
+            train_dataset = CellDataset(source_x, source_raw_x, source_sf, source_y, scaler=scaler)
+            train_dataloader = cell_dataloader(train_dataset, eval_batch_size, shuffle=False, device=data_device)
+            test_dataset = CellDataset(target_x, target_raw_x, target_sf, target_y, scaler=scaler)
+            test_dataloader = cell_dataloader(test_dataset, eval_batch_size, shuffle=False, device=data_device)
             if current_stage > 0:
-                last_train_dataset = TensorDataset(torch.tensor(last_source_x), torch.tensor(last_source_raw_x), torch.tensor(last_source_sf),
-                                              torch.tensor(last_source_y), torch.arange(last_source_x.shape[0]))
-                last_train_dataloader = DataLoader(last_train_dataset, batch_size=args.batch_size, shuffle=False)
-                last_test_dataset = TensorDataset(torch.tensor(last_target_x), torch.tensor(last_target_raw_x), torch.tensor(last_target_sf),
-                                                   torch.tensor(last_target_y), torch.arange(last_target_x.shape[0]))
-                last_test_dataloader = DataLoader(last_test_dataset, batch_size=args.batch_size, shuffle=False)
+                last_train_dataset = CellDataset(last_source_x, last_source_raw_x, last_source_sf, last_source_y, scaler=scaler)
+                last_train_dataloader = cell_dataloader(last_train_dataset, eval_batch_size, shuffle=False, device=data_device)
+                last_test_dataset = CellDataset(last_target_x, last_target_raw_x, last_target_sf, last_target_y, scaler=scaler)
+                last_test_dataloader = cell_dataloader(last_test_dataset, eval_batch_size, shuffle=False, device=data_device)
 
             optimizer = optim.Adam(itertools.chain(model.parameters(), proto_net.parameters()), lr=args.lr, amsgrad=True)
 
@@ -452,185 +401,141 @@ if __name__ == "__main__":
             ce = nn.CrossEntropyLoss().to(device)
 
             if current_stage == 0:
-                for epoch in range(args.pretrain + args.finetune + 1):
-                    if epoch % args.interval == 0:
-                        model.eval()
-                        proto_net.eval()
-                        preds = np.array([])
-                        targets = np.array([])
-                        confs = np.array([])
-
-                        test_embeddings = []
-                        test_indexes = []
-
-                        with torch.no_grad():
-                            for _, data in enumerate(test_dataloader):
-                                x_t, label_t, index_t = data[0].to(device), data[3].to(device), data[4].to(device)
-                                z_t, _, _, _ = model(x_t)
-                                output_t = proto_net(z_t)
-                                conf, pred = output_t.max(1)
-                                targets = np.append(targets, label_t.cpu().numpy())
-                                preds = np.append(preds, pred.cpu().numpy())
-                                confs = np.append(confs, conf.cpu().numpy())
-
-                                test_embeddings.append(z_t.detach())
-                                test_indexes.append(index_t)
-
-                        targets = targets.astype(int)
-                        preds = preds.astype(int)
-                        overall_acc = accuracy(preds, targets)
-                        print("In the {}-th stage and {}-th epoch, Test overall acc for this stage {:.4f}".format(
-                            current_stage, epoch, overall_acc))
+                encoder_cache = None
+                if args.encoder_cache and args.pretrain > 0:
+                    encoder_cache = EncoderCache(args.encoder_cache, data=array_digest(source_cellname, source_y),
+                                                 expression=matrix_digest(X, count_X, size_factor, scaler),
+                                                 highly_genes=args.highly_genes,
+                                                 dataset=dataname, genes=X.shape[1], structure=args.structure,
+                                                 seed=args.random_seed, pretrain=args.pretrain, lr=args.lr,
+                                                 batch_size=args.batch_size, device_data=args.device_data, amp=args.amp)
+                first_epoch = args.pretrain if encoder_cache is not None and encoder_cache.restore(model, optimizer, device) else 0
+                eval_policy = EvalPolicy(args.interval, args.pretrain + args.finetune, eval_batch_size, data_device,
+                                         args.eval_per_class, args.eval_budget, args.random_seed)
+                try:
+                    for epoch in range(first_epoch, args.pretrain + args.finetune + 1):
+                        if encoder_cache is not None and epoch == args.pretrain and first_epoch == 0:
+                            encoder_cache.store(model, optimizer)
+                        if background is not None and eval_policy.due(epoch) and epoch != eval_policy.final_epoch:
+                            background.poll()
+                            background.submit(current_stage, epoch, proto_net, eval_policy, current_classes,
+                                              test=test_dataloader)
+                        elif eval_policy.due(epoch):
+                            model.eval()
+                            proto_net.eval()
+                            targets, preds, confs, test_embeddings, confusion, estimate = eval_policy.evaluate(model, proto_net, test_dataloader,
+                                                                                                 epoch, current_classes, device)
+                            overall_acc = estimate.accuracy
+                            print("In the {}-th stage and {}-th epoch, Test overall acc for this stage {:.4f}".format(
+                                current_stage, epoch, overall_acc))
+                            if eval_policy.subsampled(epoch):
+                                print("In the {}-th stage and {}-th epoch, stratified subsample estimate, 95% CI +/-{:.4f}".format(
+                                    current_stage, epoch, estimate.interval()))
+                            model.train()
+                            proto_net.train()
+                            if epoch == args.pretrain + args.finetune:
+                                current_result.extend([0., round(overall_acc, 4), round(overall_acc, 4)])
+                                stage_accuracy_history.append(confusion.stage_accuracies(class_number_set))
+                                print("In the {}-th stage, test acc per stage {}, forgetting {:.4f}".format(
+                                    current_stage, np.round(stage_accuracy_history[-1], 4), forgetting(stage_accuracy_history)))
+
+                                test_true_labels = targets
+                                test_pred_labels = preds
+                                test_true_celltypes = target_cellname
+                                test_pred_celltypes = map_names(test_pred_labels, class_set)
+                                test_data_infor = pd.DataFrame(
+                                    {"true label": test_true_labels, "true cell type": test_true_celltypes,
+                                     "pred label": test_pred_labels, "pred cell type": test_pred_celltypes})
+                                exporter.table(test_data_infor,
+                                    "case/{}_stage_{}_test_data_joint_sankey_information".format(
+                                        dataname, current_stage))
+                                exporter.embeddings(test_embeddings,
+                                    "case/{}_stage_{}_test_data_joint_visualization_feature".format(
+                                        dataname, current_stage))
+
+                        recon_losses = AverageMeter('recon_loss', ':.4e')
+                        ce_losses = AverageMeter('ce_loss', ':.4e')
                         model.train()
                         proto_net.train()
-                        if epoch == args.pretrain + args.finetune:
-                            current_result.extend([0., round(overall_acc, 4), round(overall_acc, 4)])
-
-                            test_embeddings = torch.cat(test_embeddings, dim=0)
-                            test_indexes = torch.cat(test_indexes)
-                            _, test_indexes = torch.sort(test_indexes, descending=False)
-                            test_embeddings = test_embeddings[test_indexes].cpu().numpy()
-                            test_indexes = test_indexes.cpu().numpy()
-                            test_true_labels = targets[test_indexes]
-                            test_pred_labels = preds[test_indexes]
-                            test_true_celltypes = target_cellname
-                            test_pred_celltypes = target_cellname.copy()
-                            unique_test_preds = np.unique(test_pred_labels)
-                            for j in range(len(unique_test_preds)):
-                                test_pred_celltypes[test_pred_labels == unique_test_preds[j]] = class_set[
-                                    unique_test_preds[j]]
-                            test_data_infor = pd.DataFrame(
-                                {"true label": test_true_labels, "true cell type": test_true_celltypes,
-                                 "pred label": test_pred_labels, "pred cell type": test_pred_celltypes})
-                            test_data_infor.to_csv(
-                                "case/{}_stage_{}_test_data_joint_sankey_information.csv".format(
-                                    dataname, current_stage))
-                            pd.DataFrame(test_embeddings).to_csv(
-                                "case/{}_stage_{}_test_data_joint_visualization_feature.csv".format(
-                                    dataname, current_stage))
 
-                    recon_losses = AverageMeter('recon_loss', ':.4e')
-                    ce_losses = AverageMeter('ce_loss', ':.4e')
-                    model.train()
-                    proto_net.train()
-
-                    for batch_idx, (x_s, raw_x_s, sf_s, y_s, index_s) in enumerate(source_dataloader):
-                        x_s, raw_x_s, sf_s, y_s, index_s = x_s.to(device), raw_x_s.to(device), \
-                                                           sf_s.to(device), y_s.to(device), \
-                                                           index_s.to(device)
-                        z_s, mean_s, disp_s, pi_s = model(x_s)
-                        recon_loss = ZINBLoss().to(device)(x=raw_x_s, mean=mean_s, disp=disp_s, pi=pi_s,
-                                                           scale_factor=sf_s)
-                        output_s = proto_net(z_s)
-                        ce_loss = ce(output_s, y_s)
-                        if epoch < args.pretrain:
-                            loss = recon_loss
-                        else:
-                            loss = recon_loss + ce_loss
-                        recon_losses.update(recon_loss.item(), args.batch_size)
-                        ce_losses.update(ce_loss.item(), args.batch_size)
-                        optimizer.zero_grad()
-                        loss.backward()
-                        optimizer.step()
-                    print("In {}-th stage, Training {}/{}, zinb loss: {:.4f}, ce loss: {:.4f}".format(current_stage, epoch, args.pretrain + args.finetune + 1,
-                                                                                      recon_losses.avg, ce_losses.avg))
+                        epoch_start = time.time()
+                        for batch_idx, (x_s, raw_x_s, sf_s, y_s, index_s) in enumerate(source_dataloader):
+                            x_s, raw_x_s, sf_s, y_s, index_s = x_s.to(device), widen_counts(raw_x_s.to(device)), \
+                                                               sf_s.to(device), y_s.to(device), \
+                                                               index_s
+                            with autocast(device, args.amp):
+                                z_s, mean_s, disp_s, pi_s = model(x_s)
+                            recon_loss = zinb_loss(x=raw_x_s, mean=mean_s, disp=disp_s, pi=pi_s, scale_factor=sf_s)
+                            with autocast(device, args.amp):
+                                output_s = proto_net(z_s)
+                            ce_loss = ce(output_s, y_s)
+                            if epoch < args.pretrain:
+                                loss = recon_loss
+                            else:
+                                loss = recon_loss + ce_loss
+                            recon_losses.update(recon_loss.item(), args.batch_size)
+                            ce_losses.update(ce_loss.item(), args.batch_size)
+                            optimizer.zero_grad()
+                            loss.backward()
+                            optimizer.step()
+                        print("In {}-th stage, Training {}/{}, zinb loss: {:.4f}, ce loss: {:.4f}, time: {:.2f}s".format(current_stage, epoch, args.pretrain + args.finetune + 1,
+                                                                                          recon_losses.avg, ce_losses.avg, time.time() - epoch_start))
+                finally:
+                    if encoder_cache is not None:
+                        encoder_cache.release()
 
             else:
+                eval_policy = EvalPolicy(args.interval, args.finetune, eval_batch_size, data_device,
+                                         args.eval_per_class, args.eval_budget, args.random_seed)
                 for epoch in range(args.finetune + 1):
-                    if epoch % args.interval == 0:
+                    if background is not None and eval_policy.due(epoch) and epoch != eval_policy.final_epoch:
+                        background.poll()
+                        background.submit(current_stage, epoch, proto_net, eval_policy, current_classes,
+                                          test=test_dataloader, previous=last_test_dataloader)
+                    elif eval_policy.due(epoch):
                         model.eval()
                         proto_net.eval()
-                        preds = np.array([])
-                        targets = np.array([])
-                        confs = np.array([])
-
-                        test_embeddings = []
-                        test_indexes = []
-
-                        with torch.no_grad():
-                            for _, data in enumerate(test_dataloader):
-                                x_t, label_t, index_t = data[0].to(device), data[3].to(device), data[4].to(device)
-                                z_t, _, _, _ = model(x_t)
-                                output_t = proto_net(z_t)
-                                conf, pred = output_t.max(1)
-                                targets = np.append(targets, label_t.cpu().numpy())
-                                preds = np.append(preds, pred.cpu().numpy())
-                                confs = np.append(confs, conf.cpu().numpy())
-
-                                test_embeddings.append(z_t.detach())
-                                test_indexes.append(index_t)
-
-                        targets = targets.astype(int)
-                        preds = preds.astype(int)
-                        current_acc = accuracy(preds, targets)
+                        targets, preds, confs, test_embeddings, confusion, estimate = eval_policy.evaluate(model, proto_net, test_dataloader,
+                                                                                             epoch, current_classes, device)
+                        current_acc = estimate.accuracy
                         print("In the {}-th stage and {}-th epoch, Test acc for this stage {:.4f}".format(current_stage,
                                                                                                           epoch,
                                                                                                           current_acc))
 
-                        last_preds = np.array([])
-                        last_targets = np.array([])
-
-                        last_test_embeddings = []
-                        last_test_indexes = []
-
-                        with torch.no_grad():
-                            for _, data in enumerate(last_test_dataloader):
-                                x_t, label_t, index_t = data[0].to(device), data[3].to(device), data[4].to(device)
-                                z_t, _, _, _ = model(x_t)
-                                output_t = proto_net(z_t)
-                                conf, pred = output_t.max(1)
-                                last_targets = np.append(last_targets, label_t.cpu().numpy())
-                                last_preds = np.append(last_preds, pred.cpu().numpy())
-
-                                last_test_embeddings.append(z_t.detach())
-                                last_test_indexes.append(index_t)
-
-                        last_targets = last_targets.astype(int)
-                        last_preds = last_preds.astype(int)
-                        last_overall_acc = accuracy(last_preds, last_targets)
+                        last_targets, last_preds, _, last_test_embeddings, last_confusion, last_estimate = eval_policy.evaluate(
+                            model, proto_net, last_test_dataloader, epoch, current_classes, device)
+                        last_overall_acc = last_estimate.accuracy
                         print("In the {}-th stage and {}-th epoch, Test acc for previous stage {:.4f}".format(
                             current_stage, epoch,
                             last_overall_acc))
 
-                        overall_targets = np.concatenate((targets, last_targets))
-                        overall_preds = np.concatenate((preds, last_preds))
-                        overall_acc = accuracy(overall_preds, overall_targets)
+                        overall_confusion = confusion + last_confusion
+                        overall_estimate = estimate + last_estimate
+                        overall_acc = overall_estimate.accuracy
                         print("In the {}-th stage and {}-th epoch, Test acc for overall stage {:.4f}".format(
                             current_stage, epoch,
                             overall_acc))
+                        if eval_policy.subsampled(epoch):
+                            print("In the {}-th stage and {}-th epoch, stratified subsample estimates, 95% CI: this stage +/-{:.4f}, previous stage +/-{:.4f}, overall +/-{:.4f}".format(
+                                current_stage, epoch, estimate.interval(), last_estimate.interval(), overall_estimate.interval()))
                         model.train()
                         proto_net.train()
                         if epoch == args.finetune:
                             current_result.extend(
                                 [round(last_overall_acc, 4), round(current_acc, 4), round(overall_acc, 4)])
+                            stage_accuracy_history.append(overall_confusion.stage_accuracies(class_number_set))
+                            print("In the {}-th stage, test acc per stage {}, forgetting {:.4f}".format(
+                                current_stage, np.round(stage_accuracy_history[-1], 4), forgetting(stage_accuracy_history)))
 
-                            test_embeddings = torch.cat(test_embeddings, dim=0)
-                            test_indexes = torch.cat(test_indexes)
-                            _, test_indexes = torch.sort(test_indexes, descending=False)
-                            test_embeddings = test_embeddings[test_indexes].cpu().numpy()
-                            test_indexes = test_indexes.cpu().numpy()
-                            test_true_labels = targets[test_indexes]
-                            test_pred_labels = preds[test_indexes]
+                            test_true_labels = targets
+                            test_pred_labels = preds
                             test_true_celltypes = target_cellname
-                            test_pred_celltypes = target_cellname.copy()
-                            unique_test_preds = np.unique(test_pred_labels)
-                            for j in range(len(unique_test_preds)):
-                                test_pred_celltypes[test_pred_labels == unique_test_preds[j]] = class_set[
-                                    unique_test_preds[j]]
-
-                            last_test_embeddings = torch.cat(last_test_embeddings, dim=0)
-                            last_test_indexes = torch.cat(last_test_indexes)
-                            _, last_test_indexes = torch.sort(last_test_indexes, descending=False)
-                            last_test_embeddings = last_test_embeddings[last_test_indexes].cpu().numpy()
-                            last_test_indexes = last_test_indexes.cpu().numpy()
-                            last_test_true_labels = last_targets[last_test_indexes]
-                            last_test_pred_labels = last_preds[last_test_indexes]
+                            test_pred_celltypes = map_names(test_pred_labels, class_set)
+
+                            last_test_true_labels = last_targets
+                            last_test_pred_labels = last_preds
                             last_test_true_celltypes = last_target_cellname
-                            last_test_pred_celltypes = last_target_cellname.copy()
-                            unique_last_test_preds = np.unique(last_test_pred_labels)
-                            for j in range(len(unique_last_test_preds)):
-                                last_test_pred_celltypes[last_test_pred_labels == unique_last_test_preds[j]] = \
-                                class_set[unique_last_test_preds[j]]
+                            last_test_pred_celltypes = map_names(last_test_pred_labels, class_set)
 
                             overall_test_embeddings = np.concatenate((last_test_embeddings, test_embeddings), axis=0)
                             overall_test_true_labels = np.concatenate((last_test_true_labels, test_true_labels))
@@ -642,11 +547,11 @@ if __name__ == "__main__":
                             overall_test_data_infor = pd.DataFrame(
                                 {"true label": overall_test_true_labels, "true cell type": overall_test_true_celltypes,
                                  "pred label": overall_test_pred_labels, "pred cell type": overall_test_pred_celltypes})
-                            overall_test_data_infor.to_csv(
-                                "case/{}_stage_{}_test_data_joint_sankey_information.csv".format(
+                            exporter.table(overall_test_data_infor,
+                                "case/{}_stage_{}_test_data_joint_sankey_information".format(
                                     dataname, current_stage))
-                            pd.DataFrame(overall_test_embeddings).to_csv(
-                                "case/{}_stage_{}_test_data_joint_visualization_feature.csv".format(
+                            exporter.embeddings(overall_test_embeddings,
+                                "case/{}_stage_{}_test_data_joint_visualization_feature".format(
                                     dataname, current_stage))
 
                         model.train()
@@ -657,13 +562,16 @@ if __name__ == "__main__":
                     model.train()
                     proto_net.train()
 
+                    epoch_start = time.time()
                     for batch_idx, (x_s, raw_x_s, sf_s, y_s, index_s) in enumerate(source_dataloader):
-                        x_s, raw_x_s, sf_s, y_s, index_s = x_s.to(device), raw_x_s.to(device), \
+                        x_s, raw_x_s, sf_s, y_s, index_s = x_s.to(device), widen_counts(raw_x_s.to(device)), \
                                                                     sf_s.to(device), y_s.to(device), \
-                                                                    index_s.to(device)
-                        z_s, mean_s, disp_s, pi_s = model(x_s)
-                        recon_loss = ZINBLoss().to(device)(x=raw_x_s, mean=mean_s, disp=disp_s, pi=pi_s, scale_factor=sf_s)
-                        output_s = proto_net(z_s)
+                                                                    index_s
+                        with autocast(device, args.amp):
+                            z_s, mean_s, disp_s, pi_s = model(x_s)
+                        recon_loss = zinb_loss(x=raw_x_s, mean=mean_s, disp=disp_s, pi=pi_s, scale_factor=sf_s)
+                        with autocast(device, args.amp):
+                            output_s = proto_net(z_s)
                         ce_loss = ce(output_s, y_s)
                         loss = recon_loss + ce_loss
                         recon_losses.update(recon_loss.item(), args.batch_size)
@@ -671,9 +579,18 @@ if __name__ == "__main__":
                         optimizer.zero_grad()
                         loss.backward()
                         optimizer.step()
-                    print("In {}-th stage, Training {}/{}, zinb loss: {:.4f}, ce loss: {:.4f}".format(current_stage, epoch, args.finetune + 1,
-                                                                                                      recon_losses.avg, ce_losses.avg))
+                    print("In {}-th stage, Training {}/{}, zinb loss: {:.4f}, ce loss: {:.4f}, time: {:.2f}s".format(current_stage, epoch, args.finetune + 1,
+                                                                                                      recon_losses.avg, ce_losses.avg, time.time() - epoch_start))
 
+            if background is not None:
+                background.drain()
             prototype_weight_store = proto_net.fc.weight.data
             result_list.append(current_result)
+            if checkpointer is not None:
+                checkpointer.save(current_stage, model=model.state_dict(), proto_net=proto_net.state_dict(),
+                                  optimizer=optimizer.state_dict(), class_number_set=class_number_set,
+                                  stage_accuracy_history=stage_accuracy_history,
+                                  results=result_list[-(current_stage + 1):])
             print("The result list is {}".format(result_list))
+
+    exporter.close()
@@ -0,0 +1,183 @@
+import torch
+import itertools
+import torch.optim as optim
+from layers import ZINBLoss, autocast
+from dataset import CellDataset, widen_counts
+from stage_split import single_stage_split, stage_class_sets
+from evaluation import inference_batch_size
+from ensemble import ReplicaStreams, StackedAutoEncoder, StackedPrototype, StackedBatchLoader, \
+    proxy_contrastive_loss, stacked_confusions, stacked_exemplars
+from train_single_incle_prca import AutoEncoder, Prototype
+import numpy as np
+from preprocessing import *
+import argparse
+import random
+import time
+import pandas as pd
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='replay and proxy training of several seeds in lockstep')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[8888, 1, 2, 3, 4, 5, 6, 7, 8, 9],
+                        help='one replica of the model per seed, trained together with batched weights')
+    parser.add_argument('--split-seed', type=int, default=8888,
+                        help='seed of the train/test split, shared by all replicas')
+    parser.add_argument('--gpu-id', default='1', type=int)
+    parser.add_argument('--num', default=0, type=int)
+    parser.add_argument('--ra', type=float, default=0.5)
+    parser.add_argument('--age', default=2, type=int)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--highly-genes', type=int, default=2000)
+    parser.add_argument('--tau', type=float, default=1.0)
+    parser.add_argument('--pretrain', type=int, default=200)
+    parser.add_argument('--finetune', type=int, default=200)
+    parser.add_argument('--interval', type=int, default=10)
+    parser.add_argument('--lr', type=float, default=0.0001)
+    parser.add_argument('--top-k', type=int, default=20)
+    parser.add_argument('--structure', type=int, default=1)
+    parser.add_argument('--cache-dir', type=str, default='',
+                        help='directory of the preprocessed data cache, no caching by default')
+    parser.add_argument('--chunk-size', type=int, default=0)
+    parser.add_argument('--device-data', action='store_true',
+                        help='keep the dataset on the training device and sample batches there')
+    parser.add_argument('--amp', action='store_true',
+                        help='train the encoder, decoder and prototypes under bf16 autocast')
+    parser.add_argument('--eval-memory', type=int, default=512,
+                        help='memory budget (MB) that bounds the inference batch size of the evaluations')
+
+    args = parser.parse_args()
+    np.random.seed(args.split_seed)
+    random.seed(args.split_seed)
+    torch.backends.cudnn.deterministic = True
+
+    device = torch.device('cuda' if torch.cuda.is_available() else "cpu", args.gpu_id)
+    data_device = device if args.device_data else None
+    streams = ReplicaStreams(args.seeds, device, data_device)
+    replicas = len(streams)
+
+    filename_set = ["Cao", "Quake_10x", "Quake_Smart-seq2", "Zeisel_2018"]
+
+    result_list = []
+
+    for i in range(args.num, args.num + 1):
+        filename = filename_set[i]
+        dataname = filename
+        X, count_X, cell_name, gene_name, size_factor, scaler = load_single_data(
+            filename, highly_genes=args.highly_genes, size_factors=True, normalize_input=True, logtrans_input=True,
+            lazy_scale=True, cache_dir=args.cache_dir, chunk_size=args.chunk_size)
+        class_set = class_splitting_single(filename)
+
+        zinb_loss = ZINBLoss(max_count=int(count_X.max())).to(device)
+        stage_number = args.age
+        splits = single_stage_split(cell_name, class_set, stage_number, labeled_ratio=args.ra, random_seed=args.split_seed)
+        for j, current_class_set in enumerate(stage_class_sets(class_set, stage_number)):
+            print("For the {}-th stage, the class set is {} and the class number is {}".format(j, current_class_set, len(current_class_set)))
+        print("we have finished the dataset splitting process!!!")
+
+        # all replicas sample their batches from one dataset of every cell; the rows of a stage are the
+        # split indexes, labels the positions in class_set
+        labels = pd.Index(class_set).get_indexer(np.asarray(cell_name, dtype=object)).astype(np.int64)
+        dataset = CellDataset(X, count_X, size_factor, labels, scaler=scaler)
+        if data_device is not None:
+            dataset = dataset.to_device(data_device)
+
+        z_dim = 32 if args.structure == 0 else 128
+        models = []
+        for k in range(replicas):
+            with streams.init(k):
+                if args.structure == 0:
+                    models.append(AutoEncoder(X.shape[1], 32, encodeLayer=[256, 64], decodeLayer=[64, 256], activation="relu"))
+                else:
+                    models.append(AutoEncoder(X.shape[1], 128, encodeLayer=[512, 256], decodeLayer=[256, 512], activation="relu"))
+        eval_batch_size = max(1, inference_batch_size(models[0], X.shape[1], args.eval_memory << 20) // replicas)
+        model = StackedAutoEncoder(models, streams.noise).to(device)
+        del models
+
+        class_number_set = [0]
+        memory_rows = np.zeros((replicas, 0), dtype=np.int64)
+        previous_test_index = np.zeros(0, dtype=np.int64)
+        for current_stage in range(stage_number):
+            train_index, test_index, _, target_y = splits[current_stage]
+            current_classes = len(np.unique(target_y)) + class_number_set[-1]
+            class_number_set.append(current_classes)
+            print("the class set is {}".format(class_number_set))
+
+            if len(train_index) < args.batch_size:
+                args.batch_size = len(train_index)
+
+            proto_nets = []
+            for k in range(replicas):
+                with streams.init(k):
+                    proto_nets.append(Prototype(current_classes, z_dim, tau=args.tau))
+            proto_net = StackedPrototype(proto_nets).to(device)
+            if current_stage > 0:
+                proto_net.load_previous(prototype_weight_store)
+                print("In the {}-th state, we have loaded the prototype weight in the last stage successfully".format(current_stage))
+
+            # the current training cells followed by the exemplars each replica selected in earlier stages
+            source_rows = np.concatenate((np.tile(train_index, (replicas, 1)), memory_rows), axis=1)
+            source_dataloader = StackedBatchLoader(dataset, source_rows, args.batch_size, streams.sampler, drop_last=True)
+
+            # amsgrad is elementwise, so one optimizer over the stacked parameters steps every replica independently
+            optimizer = optim.Adam(itertools.chain(model.parameters(), proto_net.parameters()), lr=args.lr, amsgrad=True)
+
+            pretrain = args.pretrain if current_stage == 0 else 0
+            final_epoch = pretrain + args.finetune
+            for epoch in range(final_epoch + 1):
+                if epoch % args.interval == 0 or epoch == final_epoch:
+                    confusions = stacked_confusions(model, proto_net, dataset, test_index, eval_batch_size,
+                                                    current_classes, device)
+                    current_acc = np.array([confusion.accuracy() for confusion in confusions])
+                    if current_stage > 0:
+                        last_confusions = stacked_confusions(model, proto_net, dataset, previous_test_index,
+                                                             eval_batch_size, current_classes, device)
+                        last_acc = np.array([confusion.accuracy() for confusion in last_confusions])
+                        overall_acc = np.array([(c + l).accuracy() for c, l in zip(confusions, last_confusions)])
+                    else:
+                        last_acc, overall_acc = np.zeros(replicas), current_acc
+                    print("In the {}-th stage and {}-th epoch, Test acc for this stage {:.4f} +/- {:.4f}, previous stage "
+                          "{:.4f} +/- {:.4f}, overall {:.4f} +/- {:.4f}".format(current_stage, epoch, current_acc.mean(),
+                                                                               current_acc.std(), last_acc.mean(), last_acc.std(),
+                                                                               overall_acc.mean(), overall_acc.std()))
+                    if epoch == final_epoch:
+                        for k, seed in enumerate(streams.seeds):
+                            result_list.append([filename, current_stage + 1, seed, round(last_acc[k], 4),
+                                                round(current_acc[k], 4), round(overall_acc[k], 4)])
+
+                model.train()
+                proto_net.train()
+                # per-replica loss sums stay on the device, read once per epoch
+                recon_sum = torch.zeros(replicas, device=device)
+                pcr_sum = torch.zeros(replicas, device=device)
+                epoch_start = time.time()
+                for x_s, raw_x_s, sf_s, y_s in source_dataloader:
+                    x_s, raw_x_s, sf_s, y_s = x_s.to(device), widen_counts(raw_x_s.to(device)), sf_s.to(device), y_s.to(device)
+                    with autocast(device, args.amp):
+                        z_s, mean_s, disp_s, pi_s = model(x_s)
+                    recon_loss = zinb_loss(x=raw_x_s, mean=mean_s, disp=disp_s, pi=pi_s, scale_factor=sf_s, dim=(1, 2))
+                    pcr_loss = proxy_contrastive_loss(z_s, proto_net.label_weights(y_s), y_s, args.tau)
+
+                    # replicas share no parameter: the gradient of the sum is every replica's own gradient
+                    if epoch < pretrain:
+                        loss = recon_loss.sum()
+                    else:
+                        loss = (recon_loss + pcr_loss).sum()
+                    recon_sum += recon_loss.detach()
+                    pcr_sum += pcr_loss.detach()
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+                batches = max(1, len(source_dataloader))
+                recon_avg, pcr_avg = (recon_sum / batches).cpu().numpy(), (pcr_sum / batches).cpu().numpy()
+                print("In {}-th stage, Training {}/{}, zinb loss: {:.4f} +/- {:.4f}, pcr loss: {:.4f} +/- {:.4f}, time: {:.2f}s".format(
+                    current_stage, epoch, final_epoch + 1, recon_avg.mean(), recon_avg.std(), pcr_avg.mean(), pcr_avg.std(),
+                    time.time() - epoch_start))
+
+            prototype_weight_store = proto_net.weight.data
+            memory_rows = np.concatenate(
+                (memory_rows, stacked_exemplars(model, dataset, train_index, args.top_k, eval_batch_size, device)), axis=1)
+            previous_test_index = np.concatenate((previous_test_index, test_index))
+
+        results = pd.DataFrame(result_list, columns=["dataset", "stage", "seed", "last", "current", "overall"])
+        print(results.groupby(["dataset", "stage"])[["last", "current", "overall"]].agg(["mean", "std"]).round(4).to_string())
+    print("The result list is {}".format(result_list))